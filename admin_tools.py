@@ -14,14 +14,35 @@ load_dotenv()
 
 # 引数パーサーの設定
 parser = argparse.ArgumentParser(description='ライフプランシミュレーター管理者ツール')
-parser.add_argument('command', choices=['init-db', 'create-admin', 'list-users', 'delete-user', 'backup', 'restore', 'init-master-data'], help='実行するコマンド')
-parser.add_argument('--username', help='ユーザー名（create-admin, delete-userコマンド用）')
+parser.add_argument('command', choices=['init-db', 'create-admin', 'list-users', 'delete-user', 'backup', 'restore', 'init-master-data', 'convert-results', 'resimulate', 'index-dependencies', 'update-education-cost', 'rollover', 'backfill-final-assets', 'explain'], help='実行するコマンド')
+parser.add_argument('--username', help='ユーザー名（create-admin, delete-user, resimulateコマンド用）')
 parser.add_argument('--email', help='メールアドレス（create-adminコマンド用）')
 parser.add_argument('--password', help='パスワード（create-adminコマンド用）')
 parser.add_argument('--file', help='ファイルパス（backup, restoreコマンド用）')
+parser.add_argument('--storage', choices=['rows', 'columnar'], help='変換先の保存形式（convert-resultsコマンド用）')
+parser.add_argument('--plan-ids', help='対象のプランID（カンマ区切り、resimulateコマンド用）')
+parser.add_argument('--updated-before', help='この日時より前に更新されたプランだけを対象にする（YYYY-MM-DD[THH:MM]、resimulateコマンド用）')
+parser.add_argument('--chunk-size', type=int, help='1回にまとめて書き込むプラン数（resimulate, rolloverコマンド用）')
+parser.add_argument('--workers', type=int, help='計算のプロセス数（resimulate, rolloverコマンド用）')
+parser.add_argument('--state-file', help='中断時の再開位置を記録するファイル（既定: instance/<コマンド名>.state.json、resimulate, rollover, update-education-costコマンド用）')
+parser.add_argument('--restart', action='store_true', help='再開位置を無視して最初から実行（resimulate, rollover, update-education-costコマンド用）')
+parser.add_argument('--start-year', type=int, help='新しい開始年（既定: 今年、rolloverコマンド用）')
+parser.add_argument('--pause-ratio', type=float, help='書き込みにかかった時間の何倍だけ待つか（rolloverコマンド用）')
+parser.add_argument('--education', action='append', help='この教育費用（例: 高校/私立, 大学/私立/理系）を使用するプランだけを対象にする（resimulateコマンド用、複数指定可）')
+parser.add_argument('--expense-item-ids', help='この支出項目（カンマ区切りのID）を使用するプランだけを対象にする（resimulateコマンド用）')
+parser.add_argument('--education-type', help='学校種類（update-education-costコマンド用）')
+parser.add_argument('--institution-type', help='国公立/私立（update-education-costコマンド用）')
+parser.add_argument('--academic-field', help='文系/理系（大学のみ、update-education-costコマンド用）')
+parser.add_argument('--annual-cost', type=int, help='年間費用（万円、update-education-costコマンド用）')
+parser.add_argument('--plans', type=int, default=5000, help='監査用に作成するプラン数（explainコマンド用）')
+parser.add_argument('--verbose', action='store_true', help='全件走査のないクエリのプランも表示（explainコマンド用）')
 
 args = parser.parse_args()
 
+# 再開位置はコマンドごとに別のファイルに記録する（他のコマンドの中断した実行を上書きしない）
+if args.state_file is None and args.command in ('resimulate', 'rollover', 'update-education-cost'):
+    args.state_file = f'instance/{args.command}.state.json'
+
 # データベースパスの設定
 DB_PATH = os.environ.get('DATABASE_URL', 'sqlite:///instance/lifeplan.db')
 if DB_PATH.startswith('sqlite:///'):
@@ -86,9 +107,14 @@ def init_db():
             expense_loan INTEGER DEFAULT 0,
             expense_entertainment INTEGER DEFAULT 0,
             expense_transportation INTEGER DEFAULT 0,
+            result_generation INTEGER NOT NULL DEFAULT 0,
+            final_assets INTEGER,
             FOREIGN KEY (user_id) REFERENCES users (id)
         )
         ''')
+        c.execute('CREATE INDEX ix_lifeplans_user_updated_at ON lifeplans (user_id, updated_at, id)')
+        c.execute('CREATE INDEX ix_lifeplans_user_name ON lifeplans (user_id, name, id)')
+        c.execute('CREATE INDEX ix_lifeplans_user_final_assets ON lifeplans (user_id, final_assets, id)')
         
         # life_eventsテーブル作成
         c.execute('''
@@ -104,12 +130,14 @@ def init_db():
             FOREIGN KEY (lifeplan_id) REFERENCES lifeplans (id) ON DELETE CASCADE
         )
         ''')
+        c.execute('CREATE INDEX ix_life_events_plan_year ON life_events (lifeplan_id, event_year)')
         
         # simulation_resultsテーブル作成
         c.execute('''
         CREATE TABLE simulation_results (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             lifeplan_id INTEGER NOT NULL,
+            generation INTEGER NOT NULL DEFAULT 0,
             year INTEGER NOT NULL,
             age INTEGER NOT NULL,
             income INTEGER DEFAULT 0,
@@ -121,6 +149,83 @@ def init_db():
             FOREIGN KEY (lifeplan_id) REFERENCES lifeplans (id) ON DELETE CASCADE
         )
         ''')
+        c.execute('CREATE INDEX ix_simulation_results_plan_generation_year ON simulation_results (lifeplan_id, generation, year)')
+        
+        # simulation_result_setsテーブル作成
+        c.execute('''
+        CREATE TABLE simulation_result_sets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            lifeplan_id INTEGER NOT NULL,
+            generation INTEGER NOT NULL,
+            first_year INTEGER,
+            n_years INTEGER NOT NULL DEFAULT 0,
+            payload BLOB NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (lifeplan_id) REFERENCES lifeplans (id) ON DELETE CASCADE,
+            CONSTRAINT uq_simulation_result_sets_plan_generation UNIQUE (lifeplan_id, generation)
+        )
+        ''')
+        
+        # simulation_checkpointsテーブル作成
+        c.execute('''
+        CREATE TABLE simulation_checkpoints (
+            lifeplan_id INTEGER PRIMARY KEY,
+            start_year INTEGER NOT NULL,
+            first_year INTEGER NOT NULL,
+            savings_state BLOB NOT NULL,
+            investments_state BLOB NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (lifeplan_id) REFERENCES lifeplans (id) ON DELETE CASCADE
+        )
+        ''')
+        
+        # simulation_cacheテーブル作成
+        c.execute('''
+        CREATE TABLE simulation_cache (
+            fingerprint VARCHAR(64) PRIMARY KEY,
+            payload BLOB NOT NULL,
+            size_bytes INTEGER NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        c.execute('CREATE INDEX ix_simulation_cache_last_used_at ON simulation_cache (last_used_at)')
+        
+        # simulation_jobsテーブル作成
+        c.execute('''
+        CREATE TABLE simulation_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            lifeplan_id INTEGER NOT NULL,
+            from_year INTEGER,
+            state VARCHAR(20) NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            coalesced INTEGER NOT NULL DEFAULT 0,
+            run_after TIMESTAMP,
+            worker_id VARCHAR(100),
+            lease_expires_at TIMESTAMP,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            FOREIGN KEY (lifeplan_id) REFERENCES lifeplans (id) ON DELETE CASCADE
+        )
+        ''')
+        c.execute('CREATE INDEX ix_simulation_jobs_lifeplan_id ON simulation_jobs (lifeplan_id)')
+        c.execute('CREATE INDEX ix_simulation_jobs_state_id ON simulation_jobs (state, id)')
+        
+        # plan_dependenciesテーブル作成
+        c.execute('''
+        CREATE TABLE plan_dependencies (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            lifeplan_id INTEGER NOT NULL,
+            kind VARCHAR(20) NOT NULL,
+            key VARCHAR(100) NOT NULL,
+            FOREIGN KEY (lifeplan_id) REFERENCES lifeplans (id) ON DELETE CASCADE
+        )
+        ''')
+        c.execute('CREATE INDEX ix_plan_dependencies_lifeplan_id ON plan_dependencies (lifeplan_id)')
+        c.execute('CREATE INDEX ix_plan_dependencies_kind_key ON plan_dependencies (kind, key)')
         
         # 支出カテゴリテーブル作成
         c.execute('''
@@ -151,6 +256,7 @@ def init_db():
             FOREIGN KEY (item_id) REFERENCES expense_items (id) ON DELETE CASCADE
         )
         ''')
+        c.execute('CREATE INDEX ix_expense_values_plan_item ON expense_values (lifeplan_id, item_id)')
         
         # 教育費用テーブル作成
         c.execute('''
@@ -163,17 +269,33 @@ def init_db():
         )
         ''')
         
+        # 子供テーブル作成
+        c.execute('''
+        CREATE TABLE children (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            lifeplan_id INTEGER NOT NULL,
+            name VARCHAR(50),
+            birth_year INTEGER NOT NULL,
+            FOREIGN KEY (lifeplan_id) REFERENCES lifeplans (id) ON DELETE CASCADE
+        )
+        ''')
+        c.execute('CREATE INDEX ix_children_lifeplan_id ON children (lifeplan_id)')
+        
         # 教育費用選択テーブル作成
         c.execute('''
         CREATE TABLE education_selections (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             lifeplan_id INTEGER NOT NULL,
+            child_id INTEGER NOT NULL,
             education_type VARCHAR(20) NOT NULL,
             institution_type VARCHAR(20) NOT NULL,
             academic_field VARCHAR(20),
-            FOREIGN KEY (lifeplan_id) REFERENCES lifeplans (id) ON DELETE CASCADE
+            FOREIGN KEY (lifeplan_id) REFERENCES lifeplans (id) ON DELETE CASCADE,
+            FOREIGN KEY (child_id) REFERENCES children (id) ON DELETE CASCADE
         )
         ''')
+        c.execute('CREATE INDEX ix_education_selections_lifeplan_id ON education_selections (lifeplan_id)')
+        c.execute('CREATE INDEX ix_education_selections_child_type ON education_selections (child_id, education_type)')
         
         conn.commit()
         conn.close()
@@ -427,6 +549,10 @@ def init_master_data():
                     db.session.add(cost)
                 
                 db.session.commit()
+                
+                # 起動中のアプリケーションが保持している教育費用キャッシュを無効化
+                from utils.education_costs import invalidate_education_costs
+                invalidate_education_costs()
                 print("教育費用データを作成しました。")
             else:
                 print("教育費用データは既に存在します。スキップします。")
@@ -437,6 +563,239 @@ def init_master_data():
         print(f"マスターデータの初期化に失敗しました: {e}")
         return False
 
+def convert_results(storage):
+    """シミュレーション結果の保存形式の変換（1年1行 ⇔ 列形式）"""
+    if not storage:
+        print('変換先の保存形式を --storage で指定してください。')
+        return False
+    
+    try:
+        from app import create_app
+        from utils.result_store import convert_results as convert
+        
+        app = create_app()
+        with app.app_context():
+            converted = convert(storage)
+        
+        print(f'{converted}件のプランのシミュレーション結果を {storage} 形式に変換しました。')
+        print(f'アプリケーションでも RESULT_STORAGE={storage} を設定してください。')
+        return True
+    except Exception as e:
+        print(f'シミュレーション結果の変換に失敗しました: {e}')
+        return False
+
+def _report_progress(progress):
+    """一括再計算の進捗を表示"""
+    eta = f"{progress['eta']:.0f}秒" if progress['eta'] is not None else '-'
+    print(f"{progress['processed']}/{progress['total']}件 "
+          f"({progress['rate']:.1f}件/秒, 残り{eta}, 最終ID {progress['last_id']})", flush=True)
+
+def _report_summary(summary):
+    """一括再計算の結果を表示"""
+    print(f"{summary['processed_now']}件のプランを再計算しました（{summary['elapsed']:.1f}秒, {summary['rate']:.1f}件/秒）。")
+    if summary['skipped']:
+        print(f"実行中に結果が更新された{summary['skipped']}件のプランは書き込みませんでした。")
+
+def resimulate(username=None, plan_ids=None, updated_before=None, chunk_size=None, workers=None, state_file=None, restart=False,
+               education=None, expense_item_ids=None):
+    """プランのシミュレーション結果の一括再計算（中断した場合は同じ条件で再実行すると続きから再開）"""
+    try:
+        from datetime import datetime
+        from app import create_app
+        from models import User
+        from utils.dependencies import education_key
+        from utils.resimulate import resimulate_plans
+        
+        if education:
+            # 「高校/私立」「大学/私立/理系」の形式で指定
+            education = [education_key(*key.split('/')[:3]) for key in education]
+        if plan_ids:
+            plan_ids = [int(plan_id) for plan_id in plan_ids.split(',') if plan_id.strip()]
+        if updated_before:
+            updated_before = datetime.fromisoformat(updated_before)
+        if expense_item_ids:
+            expense_item_ids = [int(item_id) for item_id in expense_item_ids.split(',') if item_id.strip()]
+        
+        app = create_app()
+        with app.app_context():
+            user_id = None
+            if username:
+                user = User.query.filter_by(username=username).first()
+                if not user:
+                    print(f'ユーザー {username} が見つかりません。')
+                    return False
+                user_id = user.id
+            
+            # education・expense_item_ids を指定した場合は、そのマスターデータを使用するプランに絞り込む
+            summary = resimulate_plans(
+                user_id=user_id, plan_ids=plan_ids or None, updated_before=updated_before,
+                chunk_size=chunk_size, workers=workers, state_file=state_file, restart=restart, progress=_report_progress,
+                education_keys=education or None, expense_item_ids=expense_item_ids or None,
+            )
+        
+        _report_summary(summary)
+        return True
+    except KeyboardInterrupt:
+        print(f'中断しました。同じ条件で再実行すると続きから再開します（{state_file}）。')
+        return False
+    except Exception as e:
+        print(f'シミュレーション結果の再計算に失敗しました: {e}')
+        return False
+
+def index_dependencies():
+    """全プランについて、使用するマスターデータの索引を作成"""
+    try:
+        from app import create_app
+        from utils.dependencies import rebuild_dependency_index
+        
+        app = create_app()
+        with app.app_context():
+            changed = rebuild_dependency_index()
+        
+        print(f'{changed}件のプランの索引を更新しました。')
+        return True
+    except Exception as e:
+        print(f'索引の作成に失敗しました: {e}')
+        return False
+
+def update_education_cost(education_type, institution_type, academic_field, annual_cost, chunk_size=None, workers=None, state_file=None,
+                          restart=False):
+    """教育費用マスタの更新と、その費用を使用するプランだけの再計算"""
+    if not education_type or not institution_type or annual_cost is None:
+        print('--education-type, --institution-type, --annual-cost を指定してください。')
+        return False
+    
+    try:
+        from app import create_app, db
+        from models import EducationCost, LifePlan
+        from utils.dependencies import education_key, uses_master_data
+        from utils.education_costs import invalidate_education_costs
+        from utils.resimulate import ResumeStateConflictError, resimulate_plans
+        
+        app = create_app()
+        with app.app_context():
+            query = EducationCost.query.filter_by(education_type=education_type, institution_type=institution_type)
+            if education_type == '大学':
+                query = query.filter_by(academic_field=academic_field)
+            costs = query.all()
+            if not costs:
+                print('該当する教育費用データがありません。')
+                return False
+            for cost in costs:
+                cost.annual_cost = annual_cost
+            db.session.commit()
+            invalidate_education_costs()
+            print(f'{len(costs)}件の教育費用データを更新しました。')
+            
+            # 対象のプランは依存関係の索引から絞り込む（IDのリストは作らない）
+            education_keys = [education_key(education_type, institution_type, academic_field)]
+            affected = LifePlan.query.filter(uses_master_data(education_keys)).count()
+            if not affected:
+                print('再計算が必要なプランはありません。')
+                return True
+            print(f'{affected}件のプランを再計算します。')
+            summary = resimulate_plans(
+                education_keys=education_keys, chunk_size=chunk_size, workers=workers, state_file=state_file,
+                restart=restart, progress=_report_progress,
+            )
+        
+        _report_summary(summary)
+        return True
+    except ResumeStateConflictError as e:
+        print(f'教育費用データは更新しましたが、再計算は実行していません: {e}')
+        return False
+    except KeyboardInterrupt:
+        print(f'中断しました。同じ条件で再実行すると続きから再開します（{state_file}）。')
+        return False
+    except Exception as e:
+        print(f'教育費用データの更新に失敗しました: {e}')
+        return False
+
+def backfill_final_assets():
+    """一覧の並べ替え用の最終年の総資産を、既存のシミュレーション結果から設定"""
+    try:
+        from app import create_app
+        from utils.result_store import backfill_final_assets as backfill
+        
+        app = create_app()
+        with app.app_context():
+            updated = backfill()
+        
+        print(f'{updated}件のプランの最終資産を設定しました。')
+        return True
+    except Exception as e:
+        print(f'最終資産の設定に失敗しました: {e}')
+        return False
+
+def explain(plans=5000, verbose=False):
+    """大きな監査用データを一時データベースに作成し、各ルートのSQLの EXPLAIN QUERY PLAN で全件走査を調べる"""
+    try:
+        import tempfile
+        from app import create_app
+        from config import Config
+        from utils.query_audit import seed_audit_data, audit_routes
+        
+        with tempfile.TemporaryDirectory() as directory:
+            class AuditConfig(Config):
+                SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'audit.db')
+                TESTING = True
+                WTF_CSRF_ENABLED = False
+                PROPAGATE_EXCEPTIONS = False  # エラーになるルートは状態コードを表示して監査を続ける
+            
+            app = create_app(AuditConfig)
+            app.logger.disabled = True
+            users = 10
+            with app.app_context():
+                from app import db
+                db.create_all()
+                data = seed_audit_data(users=users, plans_per_user=max(plans // users, 1))
+            print(f"監査用データ: プラン{data['plans']}件、支出{data['expense_values']}件、"
+                  f"イベント{data['events']}件、結果{data['results']}行")
+            
+            reports = audit_routes(app, data)
+            flagged = 0
+            for report in reports:
+                status = '' if report['status'] is None else f" [{report['status']}]"
+                print(f"{report['label']}{status}: {report['statements']}クエリ")
+                for query in report['queries']:
+                    if not query['scans'] and not verbose:
+                        continue
+                    flagged += bool(query['scans'])
+                    print(f"  {'全件走査' if query['scans'] else 'OK'}: {query['sql']}")
+                    for line in query['plan']:
+                        print(f'    {line}')
+        
+        if flagged:
+            print(f'{flagged}件のクエリがテーブルを全件走査しています。')
+            return False
+        print('全件走査しているクエリはありません。')
+        return True
+    except Exception as e:
+        print(f'クエリプランの確認に失敗しました: {e}')
+        return False
+
+def rollover(start_year=None, chunk_size=None, workers=None, pause_ratio=None, state_file=None, restart=False):
+    """年の切り替え後に、保存済みのシミュレーション結果を新しい開始年に合わせる（年始に定期実行する）"""
+    try:
+        from app import create_app
+        from utils.rollover import rollover_plans
+        
+        app = create_app()
+        with app.app_context():
+            summary = rollover_plans(
+                start_year=start_year, chunk_size=chunk_size, workers=workers, pause_ratio=pause_ratio,
+                state_file=state_file, restart=restart, progress=_report_progress,
+            )
+        
+        _report_summary(summary)
+        return True
+    except KeyboardInterrupt:
+        print('中断しました。再実行すると残りのプランだけを処理します。')
+        return False
+    except Exception as e:
+        print(f'開始年の切り替えに失敗しました: {e}')
+        return False
+
 if __name__ == '__main__':
     # コマンドに応じた処理を実行
     if args.command == 'init-db':
@@ -452,4 +811,20 @@ if __name__ == '__main__':
     elif args.command == 'restore':
         restore(args.file)
     elif args.command == 'init-master-data':
-        init_master_data()
\ No newline at end of file
+        init_master_data()
+    elif args.command == 'convert-results':
+        convert_results(args.storage)
+    elif args.command == 'resimulate':
+        resimulate(args.username, args.plan_ids, args.updated_before, args.chunk_size, args.workers, args.state_file, args.restart,
+                   args.education, args.expense_item_ids)
+    elif args.command == 'rollover':
+        rollover(args.start_year, args.chunk_size, args.workers, args.pause_ratio, args.state_file, args.restart)
+    elif args.command == 'index-dependencies':
+        index_dependencies()
+    elif args.command == 'backfill-final-assets':
+        backfill_final_assets()
+    elif args.command == 'explain':
+        explain(args.plans, args.verbose)
+    elif args.command == 'update-education-cost':
+        update_education_cost(args.education_type, args.institution_type, args.academic_field, args.annual_cost,
+                              args.chunk_size, args.workers, args.state_file, args.restart)
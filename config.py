@@ -4,12 +4,14 @@ from dotenv import load_dotenv
 # .envファイルから環境変数を読み込む
 load_dotenv()
 
+basedir = os.path.abspath(os.path.dirname(__file__))
+
 class Config:
     # Flask設定
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-key-please-change-in-production'
     
     # データベース設定
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+    SQLALCHEMY_DATABASE_URI = os.environ.get('SQLALCHEMY_DATABASE_URI') or 'sqlite:///:memory:'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
     # セッション設定
@@ -27,10 +29,78 @@ class Config:
     DEFAULT_INVESTMENT_RETURN_RATE = 0.03  # 投資収益率 3%
     DEFAULT_INFLATION_RATE = 0.01  # インフレ率 1%
     
+    # シミュレーションエンジン（'vectorized': NumPy一括計算, 'legacy': 年ごとの逐次計算）
+    SIMULATION_ENGINE = os.environ.get('SIMULATION_ENGINE') or 'vectorized'
+    
+    # バックグラウンド実行（登録後すぐに応答し、スレッドプールで計算する）
+    SIMULATION_BACKGROUND = (os.environ.get('SIMULATION_BACKGROUND') or 'true').lower() != 'false'
+    SIMULATION_WORKERS = int(os.environ.get('SIMULATION_WORKERS') or 2)  # 計算スレッド数
+    SIMULATION_QUEUE_DEPTH = 32  # 実行待ち＋実行中の上限（超えた場合はリクエスト内で実行）
+    SIMULATION_DEBOUNCE_SECONDS = float(os.environ.get('SIMULATION_DEBOUNCE_SECONDS') or 0)  # 最後の変更から実行開始までの待ち時間
+    SIMULATION_STATUS_TTL_SECONDS = 600  # 完了・失敗したジョブの状態を保持する時間（過ぎると 'idle' に戻る）
+    
+    # ジョブの実行方法（'thread': アプリ内のスレッドプール, 'database': ジョブテーブル経由で worker.py が実行）
+    SIMULATION_QUEUE = os.environ.get('SIMULATION_QUEUE') or 'thread'
+    SIMULATION_JOB_LEASE_SECONDS = 60  # ジョブのリース期間（ハートビートで延長）
+    SIMULATION_JOB_HEARTBEAT_SECONDS = 15  # ハートビートの間隔
+    SIMULATION_JOB_MAX_ATTEMPTS = 3  # 失敗・リース切れで再実行する最大回数
+    SIMULATION_JOB_RETRY_SECONDS = 10  # 失敗したジョブを再実行するまでの待ち時間（試行ごとに倍にする）
+    SIMULATION_JOB_RETRY_MAX_SECONDS = 600  # 再実行までの待ち時間の上限
+    SIMULATION_JOB_RETENTION_SECONDS = 7 * 24 * 3600  # 終了したジョブ（完了・失敗・統合）の行を残す期間
+    SIMULATION_JOB_PURGE_INTERVAL_SECONDS = 600  # ワーカーが終了したジョブを削除する間隔
+    SIMULATION_WORKER_POLL_SECONDS = 1.0  # ジョブがない場合の待機時間
+    
+    # シミュレーション結果の保存形式（'rows': 1年1行, 'columnar': 1世代を列ごとの配列1件にまとめる）
+    RESULT_STORAGE = os.environ.get('RESULT_STORAGE') or 'rows'
+    
+    # 公開中でなくなった世代の結果を削除する際の1回あたりの行数
+    RESULT_GC_BATCH_SIZE = 5000
+    
+    # 一括再計算（admin_tools.py resimulate）
+    RESIMULATE_CHUNK_SIZE = 500  # 1回のトランザクションで書き込むプラン数
+    RESIMULATE_WORKERS = int(os.environ.get('RESIMULATE_WORKERS') or os.cpu_count() or 1)  # 計算のプロセス数
+    
+    # 年の切り替え（admin_tools.py rollover）
+    ROLLOVER_CHUNK_SIZE = 100  # 1回のトランザクションで書き込むプラン数（書き込みロックを短くする）
+    ROLLOVER_PAUSE_RATIO = 1.0  # 書き込みにかかった時間の何倍だけ次の書き込みまで待つか
+    
+    # シミュレーション結果キャッシュ（入力値が同じ場合は計算を省略）
+    SIMULATION_CACHE_ENABLED = (os.environ.get('SIMULATION_CACHE_ENABLED') or 'true').lower() != 'false'
+    SIMULATION_CACHE_MAX_ENTRIES = 10000  # 保持する最大件数（超えた分は最終利用が古い順に削除）
+    SIMULATION_CACHE_MAX_BYTES = 64 * 1024 * 1024  # 保持する結果データの合計サイズの上限
+    
+    # モンテカルロシミュレーション設定
+    MONTE_CARLO_PATHS = 10000  # 既定の試行回数
+    MONTE_CARLO_MAX_PATHS = 100000  # 1回の計算で許可する最大試行回数
+    MONTE_CARLO_VOLATILITY = 0.15  # 投資収益率の標準偏差（年率）
+    MONTE_CARLO_DEPLETION_AGE = 90  # 資産枯渇確率を評価する年齢
+    MONTE_CARLO_BLOCK_SIZE = 4096  # 乱数シードを割り当てる経路ブロックの大きさ（結果の再現性の単位）
+    MONTE_CARLO_WORKERS = int(os.environ.get('MONTE_CARLO_WORKERS') or os.cpu_count() or 1)  # 並列計算のプロセス数
+    MONTE_CARLO_PARALLEL_THRESHOLD = 50000  # この試行回数以上でプロセスプールを使用
+    
+    # ライフプラン一覧設定
+    PLAN_PAGE_SIZE = 20  # 1ページに表示するプラン数
+    PLAN_PAGE_SIZE_MAX = 100  # API で指定できる1ページのプラン数の上限
+    
+    # 一括比較（スイープ）設定
+    SWEEP_MAX_SCENARIOS = 10000  # 1回の計算で許可する組み合わせの最大数
+    
+    # 目標値の逆算（ゴールシーク）設定
+    GOAL_SEEK_AGE = 100  # この年齢まで資産が枯渇しないことを条件にする
+    GOAL_SEEK_POINTS = 32  # 1回のベクトル演算で判定する候補数
+    GOAL_SEEK_MAX_AMOUNT = 1000000  # 探索する支出額の上限（万円）
+    
+    # 感度分析設定
+    SENSITIVITY_PERCENT = 10  # 各入力を増減させる割合（%）
+    SENSITIVITY_RETIREMENT_YEARS = 2  # 退職年を前後させる年数
+    
     # 自動計算設定
     INCOME_TAX_RATE = 0.1  # 所得税率（簡易版）
     SOCIAL_INSURANCE_RATE = 0.15  # 社会保険料率（簡易版）
     
+    # マスターデータ更新検知用のスタンプファイル（更新時に書き換え、各プロセスのキャッシュを無効化）
+    MASTER_DATA_STAMP_FILE = os.environ.get('MASTER_DATA_STAMP_FILE') or os.path.join(basedir, 'instance', 'master_data.stamp')
+    
     # 教育費デフォルト値（単位：万円）
     EDUCATION_COST = {
         "幼稚園": 50,  # 3年間の合計
@@ -2,6 +2,7 @@ import os
 import sys
 import sqlite3
 from datetime import datetime
+from utils.master_data import touch_master_data_stamp
 
 # 現在のディレクトリをプロジェクトのルートディレクトリに設定
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
@@ -112,6 +113,9 @@ def populate_education_costs():
     conn.commit()
     conn.close()
     
+    # 起動中のアプリケーションが保持している教育費用キャッシュを無効化
+    touch_master_data_stamp()
+    
     print(f"{len(education_costs)} 件の教育費用データを登録しました。")
 
 def main():
@@ -0,0 +1,49 @@
+"""simulation jobs
+
+ワーカープロセス（worker.py）が取得して実行するシミュレーションのジョブテーブルを作成する（Config.SIMULATION_QUEUE = 'database'）。
+
+Revision ID: 03550d97ca89
+Revises: 8d3a74de329d
+Create Date: 2026-10-18 08:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '03550d97ca89'
+down_revision = '8d3a74de329d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # db.create_all() で作成済みの場合は何もしない
+    if 'simulation_jobs' in sa.inspect(op.get_bind()).get_table_names():
+        return
+
+    op.create_table(
+        'simulation_jobs',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('lifeplan_id', sa.Integer(), sa.ForeignKey('lifeplans.id'), nullable=False),
+        sa.Column('from_year', sa.Integer()),
+        sa.Column('state', sa.String(20), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('coalesced', sa.Integer(), nullable=False),
+        sa.Column('run_after', sa.DateTime()),
+        sa.Column('worker_id', sa.String(100)),
+        sa.Column('lease_expires_at', sa.DateTime()),
+        sa.Column('error', sa.Text()),
+        sa.Column('created_at', sa.DateTime()),
+        sa.Column('started_at', sa.DateTime()),
+        sa.Column('finished_at', sa.DateTime()),
+    )
+    op.create_index('ix_simulation_jobs_lifeplan_id', 'simulation_jobs', ['lifeplan_id'])
+    op.create_index('ix_simulation_jobs_state_id', 'simulation_jobs', ['state', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_simulation_jobs_state_id', table_name='simulation_jobs')
+    op.drop_index('ix_simulation_jobs_lifeplan_id', table_name='simulation_jobs')
+    op.drop_table('simulation_jobs')
@@ -0,0 +1,49 @@
+"""simulation result generations
+
+シミュレーション結果を世代ごとに書き込み、LifePlan.result_generation で公開する。
+db.create_all() で作成済みのデータベースにも適用できるよう、既存の列・インデックスは作成しない。
+
+Revision ID: 3a7f2c91d4e0
+Revises: 03550d97ca89
+Create Date: 2026-10-18 09:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3a7f2c91d4e0'
+down_revision = '03550d97ca89'
+branch_labels = None
+depends_on = None
+
+
+def _inspector():
+    return sa.inspect(op.get_bind())
+
+
+def _has_column(table, column):
+    return column in {c['name'] for c in _inspector().get_columns(table)}
+
+
+def _has_index(table, index):
+    return index in {i['name'] for i in _inspector().get_indexes(table)}
+
+
+def upgrade():
+    if not _has_column('lifeplans', 'result_generation'):
+        op.add_column('lifeplans', sa.Column('result_generation', sa.Integer(), nullable=False, server_default='0'))
+    if not _has_column('simulation_results', 'generation'):
+        op.add_column('simulation_results', sa.Column('generation', sa.Integer(), nullable=False, server_default='0'))
+    if not _has_index('simulation_results', 'ix_simulation_results_plan_generation_year'):
+        op.create_index('ix_simulation_results_plan_generation_year', 'simulation_results',
+                        ['lifeplan_id', 'generation', 'year'])
+    
+
+def downgrade():
+    op.drop_index('ix_simulation_results_plan_generation_year', table_name='simulation_results')
+    with op.batch_alter_table('simulation_results') as batch_op:
+        batch_op.drop_column('generation')
+    with op.batch_alter_table('lifeplans') as batch_op:
+        batch_op.drop_column('result_generation')
@@ -0,0 +1,45 @@
+"""lifeplan listing
+
+一覧の並べ替え用に公開中の結果の最終年の総資産（lifeplans.final_assets）を追加し、
+ユーザーごとのキーセットページング用の複合インデックスを作成する。
+既存の結果の最終資産は `python admin_tools.py backfill-final-assets` で設定する。
+
+Revision ID: 4b9e1c7d2f60
+Revises: d5e2a8f47b13
+Create Date: 2026-10-18 13:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b9e1c7d2f60'
+down_revision = 'd5e2a8f47b13'
+branch_labels = None
+depends_on = None
+
+# (インデックス名, 列)
+INDEXES = (
+    ('ix_lifeplans_user_updated_at', ['user_id', 'updated_at', 'id']),
+    ('ix_lifeplans_user_name', ['user_id', 'name', 'id']),
+    ('ix_lifeplans_user_final_assets', ['user_id', 'final_assets', 'id']),
+)
+
+
+def upgrade():
+    # db.create_all() で作成済みの場合は何もしない
+    inspector = sa.inspect(op.get_bind())
+    if 'final_assets' not in {c['name'] for c in inspector.get_columns('lifeplans')}:
+        op.add_column('lifeplans', sa.Column('final_assets', sa.Integer()))
+    existing = {i['name'] for i in inspector.get_indexes('lifeplans')}
+    for name, columns in INDEXES:
+        if name not in existing:
+            op.create_index(name, 'lifeplans', columns)
+
+
+def downgrade():
+    for name, _ in reversed(INDEXES):
+        op.drop_index(name, table_name='lifeplans')
+    with op.batch_alter_table('lifeplans') as batch_op:
+        batch_op.drop_column('final_assets')
@@ -0,0 +1,41 @@
+"""simulation result sets
+
+シミュレーション結果を1世代分まとめて列形式で保持するテーブルを作成する（Config.RESULT_STORAGE = 'columnar'）。
+既存の行形式の結果は `python admin_tools.py convert-results --storage columnar` で変換する。
+
+Revision ID: 8c41e5b0a6f2
+Revises: 3a7f2c91d4e0
+Create Date: 2026-10-18 09:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c41e5b0a6f2'
+down_revision = '3a7f2c91d4e0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # db.create_all() で作成済みの場合は何もしない
+    if 'simulation_result_sets' in sa.inspect(op.get_bind()).get_table_names():
+        return
+
+    op.create_table(
+        'simulation_result_sets',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('lifeplan_id', sa.Integer(), sa.ForeignKey('lifeplans.id'), nullable=False),
+        sa.Column('generation', sa.Integer(), nullable=False),
+        sa.Column('first_year', sa.Integer()),
+        sa.Column('n_years', sa.Integer(), nullable=False),
+        sa.Column('payload', sa.LargeBinary(), nullable=False),
+        sa.Column('created_at', sa.DateTime()),
+        sa.UniqueConstraint('lifeplan_id', 'generation', name='uq_simulation_result_sets_plan_generation'),
+    )
+
+
+def downgrade():
+    op.drop_table('simulation_result_sets')
@@ -0,0 +1,40 @@
+"""simulation cache
+
+入力値の指紋（SHA-256）ごとにシミュレーション結果を保持するキャッシュのテーブルを作成する。
+
+Revision ID: 8d3a74de329d
+Revises: f18f80720cdb
+Create Date: 2026-10-18 08:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d3a74de329d'
+down_revision = 'f18f80720cdb'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # db.create_all() で作成済みの場合は何もしない
+    if 'simulation_cache' in sa.inspect(op.get_bind()).get_table_names():
+        return
+
+    op.create_table(
+        'simulation_cache',
+        sa.Column('fingerprint', sa.String(64), primary_key=True),
+        sa.Column('payload', sa.LargeBinary(), nullable=False),
+        sa.Column('size_bytes', sa.Integer(), nullable=False),
+        sa.Column('hits', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime()),
+        sa.Column('last_used_at', sa.DateTime()),
+    )
+    op.create_index('ix_simulation_cache_last_used_at', 'simulation_cache', ['last_used_at'])
+
+
+def downgrade():
+    op.drop_index('ix_simulation_cache_last_used_at', table_name='simulation_cache')
+    op.drop_table('simulation_cache')
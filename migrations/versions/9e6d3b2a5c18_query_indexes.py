@@ -0,0 +1,49 @@
+"""query indexes
+
+プランごとの子テーブル（イベント・子供・教育選択・支出値）の取得に使うインデックスを作成する。
+各ルートのクエリプランは `python admin_tools.py explain` で確認できる。
+
+Revision ID: 9e6d3b2a5c18
+Revises: 4b9e1c7d2f60
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e6d3b2a5c18'
+down_revision = '4b9e1c7d2f60'
+branch_labels = None
+depends_on = None
+
+# (インデックス名, テーブル, 列)
+INDEXES = (
+    ('ix_life_events_plan_year', 'life_events', ['lifeplan_id', 'event_year']),
+    ('ix_children_lifeplan_id', 'children', ['lifeplan_id']),
+    ('ix_education_selections_lifeplan_id', 'education_selections', ['lifeplan_id']),
+    ('ix_education_selections_child_type', 'education_selections', ['child_id', 'education_type']),
+    ('ix_expense_values_plan_item', 'expense_values', ['lifeplan_id', 'item_id']),
+)
+
+
+def upgrade():
+    # db.create_all() で作成済みのインデックスや、古いスキーマにないテーブル・列は飛ばす
+    inspector = sa.inspect(op.get_bind())
+    tables = set(inspector.get_table_names())
+    for name, table, columns in INDEXES:
+        if table not in tables:
+            continue
+        if not set(columns) <= {c['name'] for c in inspector.get_columns(table)}:
+            continue
+        if name not in {i['name'] for i in inspector.get_indexes(table)}:
+            op.create_index(name, table, columns)
+
+
+def downgrade():
+    inspector = sa.inspect(op.get_bind())
+    tables = set(inspector.get_table_names())
+    for name, table, _ in reversed(INDEXES):
+        if table in tables and name in {i['name'] for i in inspector.get_indexes(table)}:
+            op.drop_index(name, table_name=table)
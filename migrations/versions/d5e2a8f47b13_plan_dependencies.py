@@ -0,0 +1,41 @@
+"""plan dependencies
+
+プランが使用するマスターデータ（教育費用の組み合わせ・支出項目）の索引テーブルを作成する。
+索引はシミュレーション実行時に更新される。既存のプランの索引は `python admin_tools.py index-dependencies` で作成する。
+
+Revision ID: d5e2a8f47b13
+Revises: 8c41e5b0a6f2
+Create Date: 2026-10-18 11:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5e2a8f47b13'
+down_revision = '8c41e5b0a6f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # db.create_all() で作成済みの場合は何もしない
+    if 'plan_dependencies' in sa.inspect(op.get_bind()).get_table_names():
+        return
+
+    op.create_table(
+        'plan_dependencies',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('lifeplan_id', sa.Integer(), sa.ForeignKey('lifeplans.id'), nullable=False),
+        sa.Column('kind', sa.String(length=20), nullable=False),
+        sa.Column('key', sa.String(length=100), nullable=False),
+    )
+    op.create_index('ix_plan_dependencies_lifeplan_id', 'plan_dependencies', ['lifeplan_id'])
+    op.create_index('ix_plan_dependencies_kind_key', 'plan_dependencies', ['kind', 'key'])
+
+
+def downgrade():
+    op.drop_index('ix_plan_dependencies_kind_key', table_name='plan_dependencies')
+    op.drop_index('ix_plan_dependencies_lifeplan_id', table_name='plan_dependencies')
+    op.drop_table('plan_dependencies')
@@ -0,0 +1,38 @@
+"""simulation checkpoints
+
+イベントの変更時に影響する年から再計算できるよう、各年末の貯蓄・投資残高を保持するテーブルを作成する。
+
+Revision ID: f18f80720cdb
+Revises: 
+Create Date: 2026-10-18 08:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f18f80720cdb'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # db.create_all() で作成済みの場合は何もしない
+    if 'simulation_checkpoints' in sa.inspect(op.get_bind()).get_table_names():
+        return
+
+    op.create_table(
+        'simulation_checkpoints',
+        sa.Column('lifeplan_id', sa.Integer(), sa.ForeignKey('lifeplans.id'), primary_key=True),
+        sa.Column('start_year', sa.Integer(), nullable=False),
+        sa.Column('first_year', sa.Integer(), nullable=False),
+        sa.Column('savings_state', sa.LargeBinary(), nullable=False),
+        sa.Column('investments_state', sa.LargeBinary(), nullable=False),
+        sa.Column('updated_at', sa.DateTime()),
+    )
+
+
+def downgrade():
+    op.drop_table('simulation_checkpoints')
@@ -64,6 +64,10 @@ class ExpenseItem(db.Model):
 # 支出値のモデル（各ライフプランごとの支出項目の値）
 class ExpenseValue(db.Model):
     __tablename__ = 'expense_values'
+    __table_args__ = (
+        # プランの支出の取得と、支出項目ごとの依存関係の索引
+        db.Index('ix_expense_values_plan_item', 'lifeplan_id', 'item_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     lifeplan_id = db.Column(db.Integer, db.ForeignKey('lifeplans.id'), nullable=False)
@@ -89,12 +93,21 @@ class EducationCost(db.Model):
         else:
             return f'<EducationCost {self.education_type} {self.institution_type}: {self.annual_cost}万円/年>'
 
+# 教育段階と対象年齢（開始年齢以上・終了年齢未満）
+EDUCATION_STAGES = (
+    ('幼稚園', 3, 6),
+    ('小学校', 6, 12),
+    ('中学校', 12, 15),
+    ('高校', 15, 18),
+    ('大学', 18, 22),
+)
+
 # 子供の情報モデル
 class Child(db.Model):
     __tablename__ = 'children'
     
     id = db.Column(db.Integer, primary_key=True)
-    lifeplan_id = db.Column(db.Integer, db.ForeignKey('lifeplans.id'), nullable=False)
+    lifeplan_id = db.Column(db.Integer, db.ForeignKey('lifeplans.id'), nullable=False, index=True)
     name = db.Column(db.String(50), nullable=True)  # 子供の名前（任意）
     birth_year = db.Column(db.Integer, nullable=False)  # 誕生年
     
@@ -113,30 +126,24 @@ class Child(db.Model):
         }
     
     def get_current_education_level(self, current_year):
-        """現在の年齢から教育段階を判定"""
+        """現在の年齢から教育段階を判定（教育前・教育終了後は None）"""
         age = current_year - self.birth_year
         
-        if age < 3:
-            return None  # まだ教育を受けていない
-        elif age < 6:
-            return '幼稚園'
-        elif age < 12:
-            return '小学校'
-        elif age < 15:
-            return '中学校'
-        elif age < 18:
-            return '高校'
-        elif age < 22:
-            return '大学'
-        else:
-            return None  # 教育終了
+        for education_type, age_from, age_to in EDUCATION_STAGES:
+            if age_from <= age < age_to:
+                return education_type
+        return None
 
 # 教育費用選択のモデル（各ライフプランごとの教育費用設定）
 class EducationSelection(db.Model):
     __tablename__ = 'education_selections'
+    __table_args__ = (
+        # 子供ごとの学校種類の選択の取得
+        db.Index('ix_education_selections_child_type', 'child_id', 'education_type'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
-    lifeplan_id = db.Column(db.Integer, db.ForeignKey('lifeplans.id'), nullable=False)
+    lifeplan_id = db.Column(db.Integer, db.ForeignKey('lifeplans.id'), nullable=False, index=True)
     child_id = db.Column(db.Integer, db.ForeignKey('children.id'), nullable=False)
     education_type = db.Column(db.String(20), nullable=False)  # 学校種類
     institution_type = db.Column(db.String(20), nullable=False)  # 国公立/私立
@@ -160,6 +167,12 @@ class EducationSelection(db.Model):
 
 class LifePlan(db.Model):
     __tablename__ = 'lifeplans'
+    __table_args__ = (
+        # 一覧のキーセットページング用（ユーザーごとに並べ替えの列 → ID の順）
+        db.Index('ix_lifeplans_user_updated_at', 'user_id', 'updated_at', 'id'),
+        db.Index('ix_lifeplans_user_name', 'user_id', 'name', 'id'),
+        db.Index('ix_lifeplans_user_final_assets', 'user_id', 'final_assets', 'id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
@@ -191,7 +204,7 @@ class LifePlan(db.Model):
     
     # 支出単位（yearly または monthly）
     expense_unit = db.Column(db.String(10), default='yearly')
-
+    
     # 支出情報（従来の項目 - 後方互換性のために残す）
     expense_housing = db.Column(db.Integer, default=0)  # 住居費
     expense_living = db.Column(db.Integer, default=0)  # 生活費
@@ -201,107 +214,82 @@ class LifePlan(db.Model):
     expense_entertainment = db.Column(db.Integer, default=0)  # 娯楽費
     expense_transportation = db.Column(db.Integer, default=0)  # 交通費
     
+    # 公開中のシミュレーション結果の世代（結果を書き込んだ後に切り替える）
+    result_generation = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # 公開中の結果の最終年の総資産（預貯金＋投資資産、万円。一覧の並べ替え用。未計算は None）
+    final_assets = db.Column(db.Integer)
+    
     # リレーションシップ
     life_events = db.relationship('LifeEvent', backref='lifeplan', lazy='dynamic', cascade="all, delete-orphan")
     simulation_results = db.relationship('SimulationResult', backref='lifeplan', lazy='dynamic', cascade="all, delete-orphan")
     expense_values = db.relationship('ExpenseValue', backref='lifeplan', lazy='dynamic', cascade="all, delete-orphan")
     education_selections = db.relationship('EducationSelection', backref='lifeplan', lazy='dynamic', cascade="all, delete-orphan")
     children = db.relationship('Child', backref='lifeplan', lazy='dynamic', cascade="all, delete-orphan")
+    simulation_checkpoint = db.relationship('SimulationCheckpoint', backref='lifeplan', uselist=False, cascade="all, delete-orphan")
+    simulation_jobs = db.relationship('SimulationJob', backref='lifeplan', lazy='dynamic', cascade="all, delete-orphan")
+    simulation_result_sets = db.relationship('SimulationResultSet', backref='lifeplan', lazy='dynamic', cascade="all, delete-orphan")
+    dependencies = db.relationship('PlanDependency', backref='lifeplan', lazy='dynamic', cascade="all, delete-orphan")
     
     def __repr__(self):
         return f'<LifePlan {self.name}>'
     
     def to_dict(self):
-        base_dict = {
-            'id': self.id,
-            'name': self.name,
-            'user_id': self.user_id,
-            'birth_year': self.birth_year,
-            'family_structure': self.family_structure,
-            
-            # 収入情報
-            'income_self': self.income_self,
-            'income_spouse': self.income_spouse,
-            'income_increase_rate': self.income_increase_rate,
-            
-            # 退職情報
-            'retirement_year_self': self.retirement_year_self,
-            'retirement_year_spouse': self.retirement_year_spouse,
-            'income_after_retirement_self': self.income_after_retirement_self,
-            'income_after_retirement_spouse': self.income_after_retirement_spouse,
-            
-            # 資産情報
-            'savings': self.savings,
-            'investments': self.investments,
-            'investment_return_rate': self.investment_return_rate,
-            'real_estate': self.real_estate,
-            'debt': self.debt,
-            
-            # 支出情報
-            'expense_unit': self.expense_unit,
-            'expense_housing': self.expense_housing,
-            'expense_living': self.expense_living,
-            'expense_education': self.expense_education,
-            'expense_insurance': self.expense_insurance,
-            'expense_loan': self.expense_loan,
-            'expense_entertainment': self.expense_entertainment,
-            'expense_transportation': self.expense_transportation,
-            
-            # 日付
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None
-        }
-        
-        # 新しい支出項目の辞書を追加
-        expense_values_dict = {}
-        for expense_value in self.expense_values:
-            item = expense_value.item
-            category = item.category
-            
-            if category.name not in expense_values_dict:
-                expense_values_dict[category.name] = {}
-            
-            expense_values_dict[category.name][item.name] = expense_value.amount
-        
-        base_dict['detailed_expenses'] = expense_values_dict
-        
-        # 教育費用の選択情報
-        education_selections_dict = {}
-        for selection in self.education_selections:
-            education_selections_dict[selection.education_type] = {
-                'institution_type': selection.institution_type
-            }
-            if selection.academic_field:
-                education_selections_dict[selection.education_type]['academic_field'] = selection.academic_field
-        
-        base_dict['education_selections'] = education_selections_dict
+        # 教育選択は1回のクエリでまとめて読み込む
+        selections = (
+            db.session.query(EducationSelection.education_type, EducationSelection.institution_type, EducationSelection.academic_field)
+            .filter(EducationSelection.lifeplan_id == self.id)
+            .order_by(EducationSelection.id.asc())
+            .all()
+        )
         
+        base_dict = lifeplan_base_dict(self)
+        base_dict['detailed_expenses'] = self.get_expense_details()
+        base_dict['education_selections'] = education_selections_dict(selections)
         return base_dict
     
+    def get_expense_details(self):
+        """詳細支出情報を {カテゴリ名: {項目名: 金額}} で返す（項目・カテゴリ名と結合した1回のクエリで読む）"""
+        expenses = (
+            db.session.query(ExpenseCategory.name, ExpenseItem.name, ExpenseValue.amount)
+            .join(ExpenseItem, ExpenseItem.id == ExpenseValue.item_id)
+            .join(ExpenseCategory, ExpenseCategory.id == ExpenseItem.category_id)
+            .filter(ExpenseValue.lifeplan_id == self.id)
+            .order_by(ExpenseValue.id.asc())
+            .all()
+        )
+        return detailed_expenses_dict(expenses)
+    
     def get_total_expenses(self):
-        """各支出カテゴリの合計を計算して返す"""
-        total = 0
-        total_by_category = {}
+        """各支出カテゴリの合計を計算して返す（詳細支出情報はカテゴリごとに集計する1回のクエリで読む）"""
+        # カテゴリは支出値が最初に登録された順に並べる
+        categories = (
+            db.session.query(ExpenseCategory.name, db.func.sum(ExpenseValue.amount))
+            .join(ExpenseItem, ExpenseItem.category_id == ExpenseCategory.id)
+            .join(ExpenseValue, ExpenseValue.item_id == ExpenseItem.id)
+            .filter(ExpenseValue.lifeplan_id == self.id)
+            .group_by(ExpenseCategory.id, ExpenseCategory.name)
+            .order_by(db.func.min(ExpenseValue.id).asc())
+            .all()
+        )
         
         # 詳細支出情報がある場合はそちらを使用
-        if self.expense_values.count() > 0:
-            for expense_value in self.expense_values:
-                item = expense_value.item
-                category = item.category
-                
-                if category.name not in total_by_category:
-                    total_by_category[category.name] = 0
-                
-                total_by_category[category.name] += expense_value.amount
-                total += expense_value.amount
+        if categories:
+            # 名前が同じカテゴリは表示用の内訳では合算する（合計は全カテゴリの和）
+            total_by_category = {}
+            for name, amount in categories:
+                total_by_category[name] = total_by_category.get(name, 0) + (amount or 0)
+            total = sum(amount or 0 for _, amount in categories)
         else:
             # 従来の支出情報を使用（ただし教育費用は除く - 別途計算するため）
-            total = (self.expense_housing or 0) + \
-                    (self.expense_living or 0) + \
-                    (self.expense_insurance or 0) + \
-                    (self.expense_loan or 0) + \
-                    (self.expense_entertainment or 0) + \
-                    (self.expense_transportation or 0)
+            total_by_category = {}
+            total = (
+                (self.expense_housing or 0) +
+                (self.expense_living or 0) +
+                (self.expense_insurance or 0) +
+                (self.expense_loan or 0) +
+                (self.expense_entertainment or 0) +
+                (self.expense_transportation or 0)
+            )
             # 注意: expense_education は含めない（子供の年齢に基づいて別途計算）
         
         return {
@@ -309,8 +297,56 @@ class LifePlan(db.Model):
             'by_category': total_by_category
         }
 
+# LifePlan.to_dict で返す列（この順序で出力）
+LIFEPLAN_DICT_COLUMNS = (
+    'id', 'name', 'user_id', 'birth_year', 'family_structure',
+    # 収入情報
+    'income_self', 'income_spouse', 'income_increase_rate',
+    # 退職情報
+    'retirement_year_self', 'retirement_year_spouse', 'income_after_retirement_self', 'income_after_retirement_spouse',
+    # 資産情報
+    'savings', 'investments', 'investment_return_rate', 'real_estate', 'debt',
+    # 支出情報
+    'expense_unit', 'expense_housing', 'expense_living', 'expense_education', 'expense_insurance',
+    'expense_loan', 'expense_entertainment', 'expense_transportation',
+    # シミュレーション結果
+    'final_assets',
+    # 日付
+    'created_at', 'updated_at',
+)
+
+def lifeplan_base_dict(row, columns=LIFEPLAN_DICT_COLUMNS):
+    """LifePlan（または同じ名前の列を持つ行）の列を辞書に変換"""
+    result = {}
+    for column in columns:
+        value = getattr(row, column)
+        if column in ('created_at', 'updated_at'):
+            value = value.isoformat() if value else None
+        result[column] = value
+    return result
+
+def detailed_expenses_dict(rows):
+    """(カテゴリ名, 項目名, 金額) の行から {カテゴリ名: {項目名: 金額}} を作る"""
+    expenses = {}
+    for category_name, item_name, amount in rows:
+        expenses.setdefault(category_name, {})[item_name] = amount
+    return expenses
+
+def education_selections_dict(rows):
+    """(学校種類, 学校タイプ, 専攻) の行から {学校種類: {...}} を作る（同じ学校種類は後の行で上書き）"""
+    selections = {}
+    for education_type, institution_type, academic_field in rows:
+        selections[education_type] = {'institution_type': institution_type}
+        if academic_field:
+            selections[education_type]['academic_field'] = academic_field
+    return selections
+
 class LifeEvent(db.Model):
     __tablename__ = 'life_events'
+    __table_args__ = (
+        # プランのイベントを年の順に読む
+        db.Index('ix_life_events_plan_year', 'lifeplan_id', 'event_year'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     lifeplan_id = db.Column(db.Integer, db.ForeignKey('lifeplans.id'), nullable=False)
@@ -338,9 +374,13 @@ class LifeEvent(db.Model):
 
 class SimulationResult(db.Model):
     __tablename__ = 'simulation_results'
+    __table_args__ = (
+        db.Index('ix_simulation_results_plan_generation_year', 'lifeplan_id', 'generation', 'year'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     lifeplan_id = db.Column(db.Integer, db.ForeignKey('lifeplans.id'), nullable=False)
+    generation = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # 結果の世代（LifePlan.result_generation と一致するものが公開中）
     year = db.Column(db.Integer, nullable=False)  # シミュレーション年
     age = db.Column(db.Integer, nullable=False)  # その年の年齢
     income = db.Column(db.Integer, default=0)  # 年収（万円）
@@ -365,4 +405,104 @@ class SimulationResult(db.Model):
             'investments': self.investments,
             'balance': self.balance,
             'created_at': self.created_at.isoformat() if self.created_at else None
-        }
\ No newline at end of file
+        }
+
+# シミュレーション結果を1世代分まとめて列ごとの配列で保持する形式（Config.RESULT_STORAGE = 'columnar' の場合に使用）
+class SimulationResultSet(db.Model):
+    __tablename__ = 'simulation_result_sets'
+    __table_args__ = (
+        db.UniqueConstraint('lifeplan_id', 'generation', name='uq_simulation_result_sets_plan_generation'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    lifeplan_id = db.Column(db.Integer, db.ForeignKey('lifeplans.id'), nullable=False)
+    generation = db.Column(db.Integer, nullable=False)  # 結果の世代（LifePlan.result_generation と一致するものが公開中）
+    first_year = db.Column(db.Integer)  # 先頭の年
+    n_years = db.Column(db.Integer, nullable=False, default=0)  # 年数
+    payload = db.Column(db.LargeBinary, nullable=False)  # 列ごとの配列（utils.codec 形式、差分符号化）
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<SimulationResultSet plan:{self.lifeplan_id} gen:{self.generation} years:{self.n_years}>'
+
+# シミュレーションのチェックポイント（各年末の貯蓄・投資残高を丸めずに保持し、途中の年からの再計算に使う）
+class SimulationCheckpoint(db.Model):
+    __tablename__ = 'simulation_checkpoints'
+    
+    lifeplan_id = db.Column(db.Integer, db.ForeignKey('lifeplans.id'), primary_key=True)
+    start_year = db.Column(db.Integer, nullable=False)  # シミュレーション開始年（収入計算の基準年）
+    first_year = db.Column(db.Integer, nullable=False)  # 残高配列の先頭の年
+    savings_state = db.Column(db.LargeBinary, nullable=False)  # 各年末の貯蓄残高（float64配列）
+    investments_state = db.Column(db.LargeBinary, nullable=False)  # 各年末の投資残高（float64配列）
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<SimulationCheckpoint plan:{self.lifeplan_id} from {self.first_year}>'
+
+# プランが使用するマスターデータ（マスター更新時に影響するプランだけを再計算するための索引）
+class PlanDependency(db.Model):
+    __tablename__ = 'plan_dependencies'
+    __table_args__ = (
+        db.Index('ix_plan_dependencies_kind_key', 'kind', 'key'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    lifeplan_id = db.Column(db.Integer, db.ForeignKey('lifeplans.id'), nullable=False, index=True)
+    kind = db.Column(db.String(20), nullable=False)  # 'education'（教育費用）, 'expense_item'（支出項目）
+    key = db.Column(db.String(100), nullable=False)  # 教育段階/学校タイプ/専攻、または支出項目ID
+    
+    def __repr__(self):
+        return f'<PlanDependency plan:{self.lifeplan_id} {self.kind}:{self.key}>'
+
+# シミュレーション結果のキャッシュ（入力値のハッシュごとに結果配列を保持）
+class SimulationCache(db.Model):
+    __tablename__ = 'simulation_cache'
+    
+    fingerprint = db.Column(db.String(64), primary_key=True)  # 入力値全体のSHA-256
+    payload = db.Column(db.LargeBinary, nullable=False)  # 結果配列をまとめたバイト列（utils.codec 形式）
+    size_bytes = db.Column(db.Integer, nullable=False)
+    hits = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f'<SimulationCache {self.fingerprint[:12]} hits:{self.hits}>'
+
+# シミュレーションの実行待ちジョブ（複数のワーカープロセスがリース付きで取得して実行する）
+class SimulationJob(db.Model):
+    __tablename__ = 'simulation_jobs'
+    __table_args__ = (
+        db.Index('ix_simulation_jobs_state_id', 'state', 'id'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    lifeplan_id = db.Column(db.Integer, db.ForeignKey('lifeplans.id'), nullable=False, index=True)
+    from_year = db.Column(db.Integer)  # この年から再計算（None の場合は全期間）
+    state = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, succeeded, failed, merged
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    coalesced = db.Column(db.Integer, nullable=False, default=0)  # このジョブにまとめた変更の数
+    run_after = db.Column(db.DateTime)  # この日時まで実行を待つ（続けて変更された場合にまとめるため）
+    worker_id = db.Column(db.String(100))  # 実行中のワーカー
+    lease_expires_at = db.Column(db.DateTime)  # この日時までにハートビートがなければ他のワーカーが再取得
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    
+    def __repr__(self):
+        return f'<SimulationJob {self.id} plan:{self.lifeplan_id} {self.state}>'
+    
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'lifeplan_id': self.lifeplan_id,
+            'state': self.state,
+            'from_year': self.from_year,
+            'attempts': self.attempts,
+            'coalesced': self.coalesced,
+            'worker_id': self.worker_id,
+            'submitted_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'error': self.error
+        }
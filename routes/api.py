@@ -1,36 +1,71 @@
-from flask import Blueprint, jsonify, request, send_file
+from flask import Blueprint, jsonify, request, send_file, abort
 from flask_login import login_required, current_user
-from models import LifePlan, SimulationResult, LifeEvent
+from models import LifePlan, LifeEvent
 import pandas as pd
 import json
 import io
 from datetime import datetime
 import csv
+from utils.plan_spec import compile_plan, expense_breakdown
+from utils.monte_carlo import run_monte_carlo
+from utils.scenarios import SWEEP_AXES, parse_axis, run_sweep, goal_seek, run_sensitivity
+from utils.jobs import simulation_status
+from utils.result_store import current_results, load_result_lists
+from utils.serializers import lifeplan_dicts, lifeplan_dicts_by_ids, parse_fields
+from utils.pagination import parse_plan_listing, plan_page
 
 api_bp = Blueprint('api', __name__)
 
 @api_bp.route('/lifeplans', methods=['GET'])
 @login_required
 def get_lifeplans():
-    lifeplans = LifePlan.query.filter_by(user_id=current_user.id).all()
+    # fields（カンマ区切りの項目名）または view（full / summary）で返す項目を絞る
+    # sort・order・limit・cursor と絞り込み条件でキーセットページング（next_cursor で次のページを取得）
+    try:
+        fields = parse_fields(request.args.get('fields'), request.args.get('view'))
+        listing = parse_plan_listing(request.args)
+        page = plan_page(current_user.id, **listing)
+    except ValueError as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+    
     return jsonify({
         'status': 'success',
-        'data': [lifeplan.to_dict() for lifeplan in lifeplans]
+        'data': lifeplan_dicts_by_ids(page['ids'], fields=fields),
+        'paging': {
+            'sort': listing['sort'],
+            'order': listing['order'],
+            'limit': listing['limit'],
+            'next_cursor': page['next_cursor']
+        }
     })
 
 @api_bp.route('/lifeplans/<int:id>', methods=['GET'])
 @login_required
 def get_lifeplan(id):
-    lifeplan = LifePlan.query.get_or_404(id)
-    if lifeplan.user_id != current_user.id:
+    # 権限の確認には所有者だけを読み込み、返す項目は指定されたものだけを読み込む
+    user_id = LifePlan.query.with_entities(LifePlan.user_id).filter_by(id=id).scalar()
+    if user_id is None:
+        abort(404)
+    if user_id != current_user.id:
         return jsonify({
             'status': 'error',
             'message': 'アクセス権限がありません。'
         }), 403
     
+    try:
+        fields = parse_fields(request.args.get('fields'), request.args.get('view'))
+    except ValueError as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+    
     return jsonify({
         'status': 'success',
-        'data': lifeplan.to_dict()
+        'data': lifeplan_dicts(LifePlan.id == id, fields=fields)[0]
     })
 
 @api_bp.route('/lifeplans/<int:id>/events', methods=['GET'])
@@ -59,12 +94,150 @@ def get_lifeplan_results(id):
             'message': 'アクセス権限がありません。'
         }), 403
     
-    results = SimulationResult.query.filter_by(lifeplan_id=id).order_by(SimulationResult.year.asc()).all()
+    # format=columns の場合は列ごとの配列で返す（行ごとのオブジェクトを組み立てない）
+    if request.args.get('format') == 'columns':
+        return jsonify({
+            'status': 'success',
+            'data': load_result_lists(id)
+        })
+    
+    results = current_results(id)
     return jsonify({
         'status': 'success',
         'data': [result.to_dict() for result in results]
     })
 
+@api_bp.route('/lifeplans/<int:id>/simulation/status', methods=['GET'])
+@login_required
+def get_simulation_status(id):
+    lifeplan = LifePlan.query.get_or_404(id)
+    if lifeplan.user_id != current_user.id:
+        return jsonify({
+            'status': 'error',
+            'message': 'アクセス権限がありません。'
+        }), 403
+    
+    return jsonify({
+        'status': 'success',
+        'data': simulation_status(id)
+    })
+
+@api_bp.route('/lifeplans/<int:id>/monte-carlo', methods=['GET'])
+@login_required
+def get_lifeplan_monte_carlo(id):
+    lifeplan = LifePlan.query.get_or_404(id)
+    if lifeplan.user_id != current_user.id:
+        return jsonify({
+            'status': 'error',
+            'message': 'アクセス権限がありません。'
+        }), 403
+    
+    # 収益率・標準偏差は小数（例: 0.03）で指定
+    try:
+        summary = run_monte_carlo(
+            compile_plan(lifeplan),
+            n_paths=request.args.get('paths', type=int),
+            mean=request.args.get('mean', type=float),
+            volatility=request.args.get('volatility', type=float),
+            depletion_age=request.args.get('age', type=int),
+            seed=request.args.get('seed', type=int)
+        )
+    except ValueError as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+    
+    return jsonify({
+        'status': 'success',
+        'data': summary
+    })
+
+@api_bp.route('/lifeplans/<int:id>/sweep', methods=['GET'])
+@login_required
+def get_lifeplan_sweep(id):
+    lifeplan = LifePlan.query.get_or_404(id)
+    if lifeplan.user_id != current_user.id:
+        return jsonify({
+            'status': 'error',
+            'message': 'アクセス権限がありません。'
+        }), 403
+    
+    # 各項目は '0.01,0.02' のような列挙、または '0.00:0.06:20' のような 開始:終了:個数 で指定
+    try:
+        axes = {
+            name: parse_axis(request.args[name], integer=name.startswith('retirement_year'))
+            for name in SWEEP_AXES if request.args.get(name)
+        }
+        data = run_sweep(compile_plan(lifeplan), axes)
+    except ValueError as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+    
+    return jsonify({
+        'status': 'success',
+        'data': data
+    })
+
+@api_bp.route('/lifeplans/<int:id>/goal-seek', methods=['GET'])
+@login_required
+def get_lifeplan_goal_seek(id):
+    lifeplan = LifePlan.query.get_or_404(id)
+    if lifeplan.user_id != current_user.id:
+        return jsonify({
+            'status': 'error',
+            'message': 'アクセス権限がありません。'
+        }), 403
+    
+    # target=max_expenses: 資産が枯渇しない年間の基本支出の上限, target=earliest_retirement: 最も早い退職年
+    try:
+        data = goal_seek(
+            compile_plan(lifeplan),
+            request.args.get('target', 'max_expenses'),
+            until_age=request.args.get('age', type=int)
+        )
+    except ValueError as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+    
+    return jsonify({
+        'status': 'success',
+        'data': data
+    })
+
+@api_bp.route('/lifeplans/<int:id>/sensitivity', methods=['GET'])
+@login_required
+def get_lifeplan_sensitivity(id):
+    lifeplan = LifePlan.query.get_or_404(id)
+    if lifeplan.user_id != current_user.id:
+        return jsonify({
+            'status': 'error',
+            'message': 'アクセス権限がありません。'
+        }), 403
+    
+    # percent: 各入力を増減させる割合（%）, years: 退職年を前後させる年数
+    try:
+        data = run_sensitivity(
+            compile_plan(lifeplan),
+            expense_breakdown(lifeplan),
+            percent=request.args.get('percent', type=float),
+            retirement_years=request.args.get('years', type=int)
+        )
+    except ValueError as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+    
+    return jsonify({
+        'status': 'success',
+        'data': data
+    })
+
 @api_bp.route('/lifeplans/<int:id>/export/json', methods=['GET'])
 @login_required
 def export_json(id):
@@ -83,7 +256,7 @@ def export_json(id):
     data['events'] = [event.to_dict() for event in events]
     
     # シミュレーション結果を追加
-    results = SimulationResult.query.filter_by(lifeplan_id=id).order_by(SimulationResult.year.asc()).all()
+    results = current_results(id)
     data['results'] = [result.to_dict() for result in results]
     
     # JSONファイルとして返す
@@ -110,7 +283,7 @@ def export_csv(id):
         }), 403
     
     # シミュレーション結果をCSVに変換
-    results = SimulationResult.query.filter_by(lifeplan_id=id).order_by(SimulationResult.year.asc()).all()
+    results = current_results(id)
     
     # Pandasを使用してCSVを作成
     data = {
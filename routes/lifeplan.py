@@ -1,20 +1,27 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify
+from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify, abort
 from flask_login import login_required, current_user
 from app import db
-from models import LifePlan, LifeEvent, SimulationResult, EducationSelection, Child
+from models import LifePlan, LifeEvent, EducationSelection, Child
 from forms import LifePlanForm, LifeEventForm, ChildForm, EducationSelectionForm
 import numpy as np
 from datetime import datetime
 import json
-from utils.simulation import run_simulation
+from utils.jobs import submit_simulation, simulation_status
+from utils.result_store import current_results
+from utils.education_costs import get_education_costs
+from utils.pagination import parse_plan_listing, plan_page, plans_in_order
 
 lifeplan_bp = Blueprint('lifeplan', __name__)
 
 @lifeplan_bp.route('/')
 @login_required
 def index():
-    lifeplans = LifePlan.query.filter_by(user_id=current_user.id).all()
-    return render_template('lifeplan/index.html', lifeplans=lifeplans)
+    try:
+        listing = parse_plan_listing(request.args)
+        page = plan_page(current_user.id, **listing)
+    except ValueError:
+        abort(400)
+    return render_template('lifeplan/index.html', lifeplans=plans_in_order(page['ids']), listing=listing, page=page)
 
 @lifeplan_bp.route('/create', methods=['GET', 'POST'])
 @login_required
@@ -90,8 +97,8 @@ def create():
                     db.session.add(selection)
                 db.session.commit()
             
-            # シミュレーション実行
-            run_simulation(lifeplan)
+            # シミュレーション実行（バックグラウンドで計算し、結果画面で完了を待つ）
+            submit_simulation(lifeplan.id)
             
             flash('ライフプランを作成しました。', 'success')
             return redirect(url_for('lifeplan.view', id=lifeplan.id))
@@ -192,7 +199,7 @@ def process_children_data(form_data, lifeplan_id):
                     education_data[child_index][edu_index] = {}
                 
                 education_data[child_index][edu_index][field_name] = value
-                
+    
     print(f"Found {len(children_data)} children and {sum(len(eds) for eds in education_data.values() if eds)} education settings")
     
     # 子供情報を保存または更新
@@ -281,7 +288,7 @@ def view(id):
         return redirect(url_for('lifeplan.index'))
     
     # シミュレーション結果を取得
-    results = SimulationResult.query.filter_by(lifeplan_id=lifeplan.id).order_by(SimulationResult.year.asc()).all()
+    results = current_results(lifeplan.id)
     
     # ライフイベントを取得
     events = LifeEvent.query.filter_by(lifeplan_id=lifeplan.id).order_by(LifeEvent.event_year.asc()).all()
@@ -289,6 +296,15 @@ def view(id):
     # 現在の年を取得
     current_year = datetime.now().year
     
+    # 子供と教育段階ごとの選択（テンプレートで子供・段階ごとにクエリを発行しないよう、まとめて取得）
+    children = Child.query.filter_by(lifeplan_id=lifeplan.id).order_by(Child.id.asc()).all()
+    selections_by_child = {child.id: {} for child in children}
+    if children:
+        for selection in EducationSelection.query.filter(
+            EducationSelection.child_id.in_(list(selections_by_child))
+        ).order_by(EducationSelection.id.asc()):
+            selections_by_child[selection.child_id].setdefault(selection.education_type, selection)
+    
     # グラフ用データの準備
     chart_data = {
         'years': [r.year for r in results],
@@ -298,16 +314,16 @@ def view(id):
         'balance': [r.balance for r in results]
     }
     
-    # EducationCostモデルをテンプレートに渡す
-    from models import EducationCost
-    
     return render_template('lifeplan/view.html', 
                          lifeplan=lifeplan, 
                          results=results, 
                          events=events, 
                          chart_data=json.dumps(chart_data),
                          current_year=current_year,
-                         EducationCost=EducationCost)
+                         children=children,
+                         selections_by_child=selections_by_child,
+                         education_costs=get_education_costs(),
+                         simulation=simulation_status(lifeplan.id))
 
 @lifeplan_bp.route('/<int:id>/edit', methods=['GET', 'POST'])
 @login_required
@@ -377,12 +393,8 @@ def edit(id):
             # 子供と教育費用選択データを処理
             process_children_data(request.form, lifeplan.id)
             
-            # シミュレーション結果を削除して再計算
-            SimulationResult.query.filter_by(lifeplan_id=lifeplan.id).delete()
-            db.session.commit()
-            
-            # シミュレーション実行
-            run_simulation(lifeplan)
+            # シミュレーション再実行（完了するまでは既存の結果を表示）
+            submit_simulation(lifeplan.id)
             
             flash('ライフプランを更新しました。', 'success')
             return redirect(url_for('lifeplan.view', id=lifeplan.id))
@@ -484,12 +496,8 @@ def add_event(id):
         db.session.add(event)
         db.session.commit()
         
-        # シミュレーション結果を削除して再計算
-        SimulationResult.query.filter_by(lifeplan_id=id).delete()
-        db.session.commit()
-        
-        # シミュレーション実行
-        run_simulation(lifeplan)
+        # シミュレーション再実行（イベント発生年より前の結果は変わらないため、その年から再計算）
+        submit_simulation(lifeplan.id, from_year=event.event_year)
         
         flash('ライフイベントを追加しました。', 'success')
         return redirect(url_for('lifeplan.events', id=id))
@@ -511,15 +519,12 @@ def edit_event(id, event_id):
     
     form = LifeEventForm(obj=event)
     if form.validate_on_submit():
+        previous_year = event.event_year
         form.populate_obj(event)
         db.session.commit()
         
-        # シミュレーション結果を削除して再計算
-        SimulationResult.query.filter_by(lifeplan_id=id).delete()
-        db.session.commit()
-        
-        # シミュレーション実行
-        run_simulation(lifeplan)
+        # シミュレーション再実行（変更前後のイベント発生年のうち早い方から再計算）
+        submit_simulation(lifeplan.id, from_year=min(previous_year, event.event_year))
         
         flash('ライフイベントを更新しました。', 'success')
         return redirect(url_for('lifeplan.events', id=id))
@@ -539,15 +544,12 @@ def delete_event(id, event_id):
         flash('無効なイベントIDです。', 'danger')
         return redirect(url_for('lifeplan.events', id=id))
     
+    event_year = event.event_year
     db.session.delete(event)
     db.session.commit()
     
-    # シミュレーション結果を削除して再計算
-    SimulationResult.query.filter_by(lifeplan_id=id).delete()
-    db.session.commit()
-    
-    # シミュレーション実行
-    run_simulation(lifeplan)
+    # シミュレーション再実行（削除したイベントの発生年から再計算）
+    submit_simulation(lifeplan.id, from_year=event_year)
     
     flash('ライフイベントを削除しました。', 'info')
     return redirect(url_for('lifeplan.events', id=id))
\ No newline at end of file
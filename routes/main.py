@@ -1,6 +1,6 @@
-from flask import Blueprint, render_template, redirect, url_for
+from flask import Blueprint, render_template, redirect, url_for, request, abort
 from flask_login import login_required, current_user
-from models import LifePlan
+from utils.pagination import parse_plan_listing, plan_page, plans_in_order
 
 main_bp = Blueprint('main', __name__)
 
@@ -8,8 +8,12 @@ main_bp = Blueprint('main', __name__)
 def index():
     if current_user.is_authenticated:
         # ログイン済みユーザーには自分のライフプラン一覧を表示
-        lifeplans = LifePlan.query.filter_by(user_id=current_user.id).all()
-        return render_template('index.html', lifeplans=lifeplans)
+        try:
+            listing = parse_plan_listing(request.args)
+            page = plan_page(current_user.id, **listing)
+        except ValueError:
+            abort(400)
+        return render_template('index.html', lifeplans=plans_in_order(page['ids']), listing=listing, page=page)
     else:
         # 未ログインユーザーにはウェルカムページを表示
         return render_template('index.html')
@@ -17,6 +21,10 @@ def index():
 @main_bp.route('/dashboard')
 @login_required
 def dashboard():
-    # ユーザーのライフプラン一覧を取得
-    lifeplans = LifePlan.query.filter_by(user_id=current_user.id).all()
-    return render_template('dashboard/index.html', lifeplans=lifeplans)
\ No newline at end of file
+    # ユーザーのライフプラン一覧を取得（1ページ分）
+    try:
+        listing = parse_plan_listing(request.args)
+        page = plan_page(current_user.id, **listing)
+    except ValueError:
+        abort(400)
+    return render_template('dashboard/index.html', lifeplans=plans_in_order(page['ids']), listing=listing, page=page)
\ No newline at end of file
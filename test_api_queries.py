@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""ライフプランAPIのクエリ回数の確認（プランや支出項目の件数によらず一定であること）・ページング・クエリプラン"""
+from datetime import datetime
+from sqlalchemy import event
+from app import create_app, db
+from config import Config
+from utils.plan_spec import compile_plan
+from utils.serializers import LIFEPLAN_VIEWS
+from utils.query_audit import seed_audit_data, audit_routes
+from models import User, LifePlan, LifeEvent, ExpenseCategory, ExpenseItem, ExpenseValue, Child, EducationSelection
+
+class TestConfig(Config):
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+
+def add_plans(user_id, count, items):
+    """支出項目・子供・教育選択つきのライフプランを count 件追加"""
+    for i in range(count):
+        lifeplan = LifePlan(
+            name=f'プラン{i % 50}', user_id=user_id, birth_year=1980 + i % 20, expense_unit='yearly',
+            final_assets=None if i % 3 == 0 else (i * 7) % 40
+        )
+        db.session.add(lifeplan)
+        db.session.flush()
+        for item in items:
+            db.session.add(ExpenseValue(lifeplan_id=lifeplan.id, item_id=item.id, amount=i + item.id))
+        child = Child(lifeplan_id=lifeplan.id, name='子供', birth_year=2015)
+        db.session.add(child)
+        db.session.flush()
+        for education_type in ('小学校', '大学'):
+            db.session.add(EducationSelection(
+                lifeplan_id=lifeplan.id, child_id=child.id, education_type=education_type,
+                institution_type='私立', academic_field='理系' if education_type == '大学' else None
+            ))
+    db.session.commit()
+
+def capture_queries(app, client, url):
+    """url の取得で実行されたSQLのリストとレスポンスを返す"""
+    statements = []
+    
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        response = client.get(url)
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return statements, response
+
+def test_lifeplan_list_query_count():
+    app = create_app(TestConfig)
+    with app.app_context():
+        user = User('tester', 'tester@example.com', 'password')
+        db.session.add(user)
+        for name in ('住居費', '食費', '保険'):
+            category = ExpenseCategory(name=name)
+            db.session.add(category)
+            db.session.flush()
+            for j in range(10):
+                db.session.add(ExpenseItem(category_id=category.id, name=f'{name}{j}'))
+        db.session.commit()
+        user_id = user.id
+        items = ExpenseItem.query.all()
+        add_plans(user_id, 30, items)
+    
+    client = app.test_client()
+    client.post('/auth/login', data={'email': 'tester@example.com', 'password': 'password'})
+    
+    few, response = capture_queries(app, client, '/api/lifeplans?limit=25')
+    assert response.status_code == 200
+    assert len(response.get_json()['data']) == 25
+    
+    with app.app_context():
+        add_plans(user_id, 970, ExpenseItem.query.all())
+    many, response = capture_queries(app, client, '/api/lifeplans?limit=25')
+    data = response.get_json()['data']
+    assert response.status_code == 200
+    assert len(data) == 25
+    assert sum(len(items) for items in data[-1]['detailed_expenses'].values()) == 30
+    assert data[-1]['education_selections']['大学'] == {'institution_type': '私立', 'academic_field': '理系'}
+    print(f'/api/lifeplans: 30件 {len(few)}クエリ, 1000件 {len(many)}クエリ')
+    assert len(few) == len(many)
+    
+    # 一覧と詳細で同じ内容を返す
+    detail, response = capture_queries(app, client, f'/api/lifeplans/{data[-1]["id"]}')
+    assert response.get_json()['data'] == data[-1]
+    print(f'/api/lifeplans/<id>: {len(detail)}クエリ')
+    assert len(detail) <= len(few) + 1
+    
+    # 要約・項目指定では指定されていない関連テーブルを読み込まない
+    summary, response = capture_queries(app, client, '/api/lifeplans?view=summary')
+    assert response.status_code == 200
+    assert set(response.get_json()['data'][0]) == set(LIFEPLAN_VIEWS['summary'])
+    assert not any('expense_values' in statement or 'education_selections' in statement for statement in summary)
+    print(f'/api/lifeplans?view=summary: {len(summary)}クエリ')
+    
+    selected, response = capture_queries(app, client, f'/api/lifeplans/{data[-1]["id"]}?fields=name,education_selections')
+    assert response.get_json()['data'] == {
+        'id': data[-1]['id'], 'name': data[-1]['name'], 'education_selections': data[-1]['education_selections']
+    }
+    assert not any('expense_values' in statement or 'income_self' in statement for statement in selected)
+    
+    response = client.get('/api/lifeplans?fields=name,password_hash')
+    assert response.status_code == 400
+
+def walk_pages(client, query):
+    """next_cursor をたどって全ページのプランを取得"""
+    plans = []
+    url = f'/api/lifeplans?view=summary&limit=100&{query}'
+    while True:
+        body = client.get(url).get_json()
+        plans.extend(body['data'])
+        if not body['paging']['next_cursor']:
+            return plans
+        url = f'/api/lifeplans?view=summary&limit=100&{query}&cursor={body["paging"]["next_cursor"]}'
+
+def test_lifeplan_pagination():
+    app = create_app(TestConfig)
+    with app.app_context():
+        user = User('pager', 'pager@example.com', 'password')
+        other = User('other', 'other@example.com', 'password')
+        db.session.add_all([user, other])
+        db.session.commit()
+        add_plans(user.id, 250, [])
+        add_plans(other.id, 10, [])
+        user_id = user.id
+    
+    client = app.test_client()
+    client.post('/auth/login', data={'email': 'pager@example.com', 'password': 'password'})
+    
+    # NULL（未計算）は最小の値として扱い、同じ値の中では ID 順
+    for sort, order in (('name', 'asc'), ('name', 'desc'), ('final_assets', 'asc'), ('final_assets', 'desc'), ('updated_at', 'desc')):
+        plans = walk_pages(client, f'sort={sort}&order={order}')
+        keys = [((plan[sort] is not None, plan[sort] or 0), plan['id']) for plan in plans]
+        assert len(plans) == 250 and len({plan['id'] for plan in plans}) == 250
+        assert keys == sorted(keys, reverse=order == 'desc'), (sort, order)
+    
+    filtered = walk_pages(client, 'sort=final_assets&min_final_assets=10&max_final_assets=20&q=プラン1')
+    assert filtered and all(10 <= plan['final_assets'] <= 20 and 'プラン1' in plan['name'] for plan in filtered)
+    
+    # 並べ替えが異なるカーソルや不正な値は 400
+    cursor = client.get('/api/lifeplans?limit=10').get_json()['paging']['next_cursor']
+    assert client.get(f'/api/lifeplans?sort=name&cursor={cursor}').status_code == 400
+    assert client.get('/api/lifeplans?cursor=invalid').status_code == 400
+    assert client.get('/api/lifeplans?sort=password_hash').status_code == 400
+    assert client.get('/lifeplan/?sort=final_assets&order=asc').status_code == 200
+    assert client.get('/dashboard').status_code == 200
+
+def test_route_query_plans():
+    class AuditConfig(TestConfig):
+        PROPAGATE_EXCEPTIONS = False
+    
+    app = create_app(AuditConfig)
+    app.logger.disabled = True
+    with app.app_context():
+        db.create_all()
+        data = seed_audit_data(users=2, plans_per_user=20, years=5)
+    
+    # どのルートのSQLもプランごとのテーブルを全件走査しない
+    for report in audit_routes(app, data):
+        assert report['queries'], report['label']
+        for query in report['queries']:
+            assert not query['scans'], (report['label'], query['sql'], query['plan'])
+
+def add_children(lifeplan_id, count):
+    """小学生の子供（私立）を count 人追加"""
+    for _ in range(count):
+        child = Child(lifeplan_id=lifeplan_id, name='子供', birth_year=datetime.now().year - 8)
+        db.session.add(child)
+        db.session.flush()
+        db.session.add(EducationSelection(lifeplan_id=lifeplan_id, child_id=child.id, education_type='小学校', institution_type='私立'))
+    db.session.commit()
+
+def test_lifeplan_view_query_count():
+    app = create_app(TestConfig)
+    with app.app_context():
+        db.session.add(User('viewer', 'viewer@example.com', 'password'))
+        db.session.commit()
+        lifeplan = LifePlan(name='プラン', user_id=1, birth_year=1985, expense_unit='yearly')
+        db.session.add(lifeplan)
+        db.session.commit()
+        lifeplan_id = lifeplan.id
+        add_children(lifeplan_id, 1)
+    
+    client = app.test_client()
+    client.post('/auth/login', data={'email': 'viewer@example.com', 'password': 'password'})
+    
+    # 子供の教育段階の選択は子供の人数によらずまとめて読み込む（初回は教育費用マスタの読み込みを含むため除く）
+    client.get(f'/lifeplan/{lifeplan_id}')
+    few, response = capture_queries(app, client, f'/lifeplan/{lifeplan_id}')
+    assert response.status_code == 200
+    with app.app_context():
+        add_children(lifeplan_id, 5)
+    many, response = capture_queries(app, client, f'/lifeplan/{lifeplan_id}')
+    html = response.get_data(as_text=True)
+    assert html.count('（私立') == 6
+    print(f'/lifeplan/<id>: 子供1人 {len(few)}クエリ, 6人 {len(many)}クエリ')
+    assert len(few) == len(many)
+
+def test_monte_carlo_parameters():
+    app = create_app(TestConfig)
+    with app.app_context():
+        db.session.add(User('carlo', 'carlo@example.com', 'password'))
+        db.session.commit()
+        lifeplan = LifePlan(name='プラン', user_id=1, birth_year=1985, expense_unit='yearly', savings=1000)
+        db.session.add(lifeplan)
+        db.session.commit()
+        lifeplan_id = lifeplan.id
+    
+    client = app.test_client()
+    client.post('/auth/login', data={'email': 'carlo@example.com', 'password': 'password'})
+    
+    # 収益率・標準偏差に有限でない値や負の標準偏差を指定すると 400
+    url = f'/api/lifeplans/{lifeplan_id}/monte-carlo?paths=10&seed=1'
+    assert client.get(url + '&mean=0.03&volatility=0.1').status_code == 200
+    for query in ('mean=nan', 'mean=inf', 'mean=-inf', 'volatility=nan', 'volatility=inf', 'volatility=-0.1'):
+        assert client.get(f'{url}&{query}').status_code == 400, query
+
+def count_queries(function):
+    """function の実行中に発行されたSQLの数と戻り値"""
+    statements = []
+    
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        result = function()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    return len(statements), result
+
+def test_compile_plan_query_count():
+    app = create_app(TestConfig)
+    with app.app_context():
+        db.session.add(User('compiler', 'compiler@example.com', 'password'))
+        category = ExpenseCategory(name='住居費')
+        db.session.add(category)
+        db.session.flush()
+        items = [ExpenseItem(category_id=category.id, name=f'項目{i}') for i in range(6)]
+        db.session.add_all(items)
+        lifeplan = LifePlan(name='プラン', user_id=1, birth_year=1985, expense_unit='yearly')
+        db.session.add(lifeplan)
+        db.session.commit()
+        lifeplan_id = lifeplan.id
+        
+        def add_details(count):
+            for i in range(count):
+                db.session.add(LifeEvent(lifeplan_id=lifeplan_id, event_type='その他', event_year=2030 + i, cost=100))
+                db.session.add(ExpenseValue(lifeplan_id=lifeplan_id, item_id=items[i].id, amount=10))
+            db.session.commit()
+            add_children(lifeplan_id, count)
+        
+        # イベント・子供・教育選択・支出値の件数によらずクエリ数は一定（初回は教育費用マスタの読み込みを含むため除く）
+        add_details(1)
+        compile_plan(db.session.get(LifePlan, lifeplan_id))
+        db.session.expire_all()
+        few, spec = count_queries(lambda: compile_plan(db.session.get(LifePlan, lifeplan_id)))
+        assert len(spec.events) == 1 and len(spec.children) == 1
+        add_details(5)
+        db.session.expire_all()
+        many, spec = count_queries(lambda: compile_plan(db.session.get(LifePlan, lifeplan_id)))
+        assert len(spec.events) == 6 and len(spec.children) == 6 and spec.base_expenses == 60
+        print(f'compile_plan: 子供1人 {few}クエリ, 6人 {many}クエリ')
+        assert few == many
+
+def main():
+    test_lifeplan_list_query_count()
+    test_lifeplan_view_query_count()
+    test_compile_plan_query_count()
+    test_lifeplan_pagination()
+    test_route_query_plans()
+    test_monte_carlo_parameters()
+    print('OK')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,742 @@
+#!/usr/bin/env python3
+"""シミュレーションの実行と結果の保存の確認"""
+import contextlib
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+import pytest
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from app import create_app, db
+from config import Config
+from models import (
+    User, LifePlan, LifeEvent, Child, EducationSelection, EducationCost,
+    ExpenseCategory, ExpenseItem, ExpenseValue, PlanDependency, SimulationCache, SimulationJob, SimulationResult,
+)
+from utils.codec import pack_arrays, unpack_arrays
+from utils.dependencies import EDUCATION, affected_plans, education_key
+from utils.education_costs import invalidate_education_costs
+from utils import jobs
+from utils.job_queue import claim_job, complete_job, enqueue_job, fail_job, purge_jobs, retry_delay
+from utils.monte_carlo import PERCENTILES, run_monte_carlo, simulate_paths
+from utils.result_store import (
+    ResultConflictError, RESULT_COLUMNS, collect_old_results, convert_results, current_results, load_result_arrays,
+    load_resume_state, write_results,
+)
+from utils.plan_spec import compile_plan, expense_breakdown
+from utils.resimulate import ResumeStateConflictError, resimulate_plans
+from utils.rollover import rollover_plans
+from utils.scenarios import goal_seek, parse_axis, run_sensitivity, run_sweep
+from utils.simulation import (
+    child_education_vector, household_education_vector, run_simulation, simulate_batch, simulate_lifeplan, simulate_spec,
+)
+from utils.simulation_cache import cache_stats, evict, get_cached_result
+import worker
+
+# 従来版と一致することを確認するプランの種類（乱数シード, 子供の数, イベント数, 継続イベントの割合, 支出の単位）
+ENGINE_CASES = (
+    (10, 0, 0, 0.0, 'yearly'),
+    (11, 2, 5, 0.0, 'yearly'),
+    (12, 2, 6, 1.0, 'monthly'),
+    (13, 3, 8, 0.5, 'monthly'),
+    (14, None, None, 0.4, None),
+)
+
+class TestConfig(Config):
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+
+EDUCATION_COSTS = (
+    ('幼稚園', '国公立', None, 20), ('幼稚園', '私立', None, 40),
+    ('小学校', '国公立', None, 15), ('小学校', '私立', None, 100),
+    ('中学校', '国公立', None, 25), ('中学校', '私立', None, 120),
+    ('高校', '国公立', None, 30), ('高校', '私立', None, 100),
+    ('大学', '国公立', '文系', 54), ('大学', '私立', '文系', 86),
+    ('大学', '国公立', '理系', 65), ('大学', '私立', '理系', 120),
+)
+
+@contextlib.contextmanager
+def configured(**values):
+    """Config の設定値を一時的に変更"""
+    saved = {name: getattr(Config, name) for name in values}
+    for name, value in values.items():
+        setattr(Config, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(Config, name, value)
+
+def setup_app():
+    """テスト用のアプリとユーザー・マスターデータを作成"""
+    app = create_app(TestConfig)
+    with app.app_context():
+        db.session.add(User('tester', 'tester@example.com', 'password'))
+        for education_type, institution_type, academic_field, annual_cost in EDUCATION_COSTS:
+            db.session.add(EducationCost(education_type=education_type, institution_type=institution_type,
+                                         academic_field=academic_field, annual_cost=annual_cost))
+        for name, items in (('住居費', ('家賃', '管理費')), ('食費', ('食材費', '外食費')), ('その他', ('予備費',))):
+            category = ExpenseCategory(name=name)
+            db.session.add(category)
+            db.session.flush()
+            for item in items:
+                db.session.add(ExpenseItem(category_id=category.id, name=item))
+        db.session.commit()
+    return app
+
+def make_plan(rng, children=None, events=None, expense_unit=None, recurring_ratio=0.4):
+    """支出項目・子供と教育選択・イベントつきのライフプランをランダムに作成"""
+    birth_year = rng.randint(1950, 2010)
+    expense_unit = expense_unit or rng.choice(['yearly', 'monthly'])
+    scale = 12 if expense_unit == 'monthly' else 1
+    lifeplan = LifePlan(
+        name=f'プラン{rng.randint(1, 9999)}', user_id=1, birth_year=birth_year,
+        income_self=rng.randint(0, 1500), income_spouse=rng.choice([0, rng.randint(0, 900)]),
+        income_increase_rate=rng.choice([0, 0.01, 0.02, 0.035]),
+        retirement_year_self=rng.choice([None, birth_year + 60, birth_year + 65]),
+        retirement_year_spouse=rng.choice([None, birth_year + 62]),
+        income_after_retirement_self=rng.randint(0, 300), income_after_retirement_spouse=rng.randint(0, 200),
+        savings=rng.randint(-10, 3000), investments=rng.randint(0, 5000),
+        investment_return_rate=rng.choice([0.0, 0.03, 0.05, 0.017]), expense_unit=expense_unit,
+        expense_housing=rng.randint(0, 200) // scale, expense_living=rng.randint(0, 300) // scale,
+        expense_insurance=rng.randint(0, 40) // scale, expense_loan=rng.randint(0, 100) // scale,
+        expense_entertainment=rng.randint(0, 50) // scale, expense_transportation=rng.randint(0, 30) // scale,
+    )
+    db.session.add(lifeplan)
+    db.session.flush()
+    for item in ExpenseItem.query.all():
+        if rng.random() < 0.7:
+            db.session.add(ExpenseValue(lifeplan_id=lifeplan.id, item_id=item.id, amount=rng.randint(1, 100) // scale))
+    for _ in range(rng.randint(0, 3) if children is None else children):
+        child = Child(lifeplan_id=lifeplan.id, name='子供', birth_year=rng.randint(1995, 2035))
+        db.session.add(child)
+        db.session.flush()
+        for education_type in ('幼稚園', '小学校', '中学校', '高校', '大学'):
+            if rng.random() < 0.8:
+                db.session.add(EducationSelection(
+                    lifeplan_id=lifeplan.id, child_id=child.id, education_type=education_type,
+                    institution_type=rng.choice(['国公立', '私立']),
+                    academic_field=rng.choice(['文系', '理系', None]) if education_type == '大学' else None,
+                ))
+    for _ in range(rng.randint(0, 5) if events is None else events):
+        event_year = rng.randint(2020, 2080)
+        recurring = rng.random() < recurring_ratio
+        db.session.add(LifeEvent(
+            lifeplan_id=lifeplan.id, event_type='その他', event_year=event_year, cost=rng.randint(-500, 3000),
+            recurring=recurring, recurring_end_year=rng.choice([None, event_year + rng.randint(0, 20)]) if recurring else None,
+        ))
+    db.session.commit()
+    return lifeplan
+
+def quiet(function, *args, **kwargs):
+    """標準出力を捨てて実行（従来版のエンジンは1年ごとに出力する）"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function(*args, **kwargs)
+
+def result_rows(lifeplan_id):
+    return [(row.year, row.age, row.income, row.expenses, row.savings, row.investments, row.balance)
+            for row in current_results(lifeplan_id)]
+
+@pytest.mark.parametrize('seed, children, events, recurring_ratio, expense_unit', ENGINE_CASES)
+def test_engine_matches_legacy(seed, children, events, recurring_ratio, expense_unit):
+    app = setup_app()
+    with app.app_context():
+        rng = random.Random(seed)
+        for _ in range(20):
+            lifeplan = make_plan(rng, children, events, expense_unit, recurring_ratio)
+            with configured(SIMULATION_ENGINE='legacy'):
+                quiet(run_simulation, lifeplan)
+            expected = result_rows(lifeplan.id)
+            
+            # 一括計算の結果は従来版の1年ずつの計算と各年の全ての値が一致する
+            with configured(SIMULATION_ENGINE='vectorized', SIMULATION_CACHE_ENABLED=False):
+                run_simulation(lifeplan)
+            assert expected and result_rows(lifeplan.id) == expected, (seed, lifeplan.id)
+
+def test_generation_publish_and_collect():
+    app = setup_app()
+    with app.app_context():
+        lifeplan = make_plan(random.Random(6), children=1)
+        run_simulation(lifeplan)
+        published = result_rows(lifeplan.id)
+        years = len(published)
+        
+        # 新しい世代を書き込んで切り替え、古い世代は collect_old_results まで残る
+        lifeplan.savings += 500
+        db.session.commit()
+        run_simulation(lifeplan)
+        db.session.refresh(lifeplan)
+        assert lifeplan.result_generation == 2
+        assert SimulationResult.query.filter_by(lifeplan_id=lifeplan.id).count() == 2 * years
+        assert result_rows(lifeplan.id) != published
+        assert collect_old_results([lifeplan.id]) == years
+        assert {row.generation for row in SimulationResult.query.filter_by(lifeplan_id=lifeplan.id)} == {2}
+        
+        # 読み込んだ後に別の書き込みが公開した場合は中止し、公開中の世代と結果は変わらない
+        published = result_rows(lifeplan.id)
+        engine = db.engine
+        switches = []
+        
+        def publish_concurrently(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('UPDATE lifeplans SET') and 'result_generation=' in statement and not switches:
+                switches.append(statement)
+                cursor.execute('UPDATE lifeplans SET result_generation = result_generation + 1 WHERE id = ?', (lifeplan.id,))
+        
+        event.listen(engine, 'before_cursor_execute', publish_concurrently)
+        try:
+            write_results({lifeplan.id: simulate_lifeplan(lifeplan)})
+            raise AssertionError('ResultConflictError was not raised')
+        except ResultConflictError:
+            pass
+        finally:
+            event.remove(engine, 'before_cursor_execute', publish_concurrently)
+        db.session.refresh(lifeplan)
+        assert lifeplan.result_generation == 2 and result_rows(lifeplan.id) == published
+        assert SimulationResult.query.filter_by(lifeplan_id=lifeplan.id).count() == years
+        
+        # 計算に使った入力を読んだ後に公開された場合は書き込まずに飛ばす
+        timings = write_results({lifeplan.id: simulate_lifeplan(lifeplan)}, expected_generations={lifeplan.id: 1})
+        assert timings['skipped'] == 1 and db.session.get(LifePlan, lifeplan.id).result_generation == 2
+
+def test_monte_carlo_summary():
+    app = setup_app()
+    with app.app_context():
+        spec = compile_plan(make_plan(random.Random(11), children=1, events=2))
+        
+        # パーセンタイル帯は各年で p5 ≤ p25 ≤ … ≤ p95
+        summary = run_monte_carlo(spec, n_paths=500, seed=1)
+        bands = np.array([summary['percentiles'][f'p{p}'] for p in PERCENTILES])
+        assert bands.shape == (len(PERCENTILES), len(summary['years']))
+        assert (np.diff(bands, axis=0) >= 0).all()
+        
+        # 標準偏差0では全経路が決定論的な計算と同じ推移になる（整数への切り捨ての差だけ）
+        summary = run_monte_carlo(spec, n_paths=5, volatility=0, seed=1)
+        deterministic = simulate_spec(spec)
+        expected = deterministic['savings'] + deterministic['investments']
+        assert summary['years'] == deterministic['year'].tolist()
+        for p in PERCENTILES:
+            assert np.abs(np.array(summary['percentiles'][f'p{p}']) - expected).max() <= 1
+        
+        # 収入だけの場合は枯渇せず、資産も収入もなく支出だけの場合は全経路が初年に枯渇する
+        solvent = spec._replace(income_self=1000, base_expenses=0, children=(), events=())
+        assert run_monte_carlo(solvent, n_paths=200, seed=1)['depletion_probability'] == 0.0
+        broke = spec._replace(income_self=0, income_spouse=0, income_after_retirement_self=0, income_after_retirement_spouse=0,
+                              savings=0, investments=0, base_expenses=100)
+        summary = run_monte_carlo(broke, n_paths=200, seed=1, depletion_age=200)
+        assert summary['depletion_probability'] == 1.0 and summary['depletion_probability_by_year'][0] == 1.0
+
+def test_monte_carlo_parallel_matches_serial():
+    # 経路ブロックを小さくし、プロセスプールを使う試行回数の下限を下げて複数ブロックを2プロセスに分担させる
+    net = np.linspace(300, -400, 40)
+    with configured(MONTE_CARLO_BLOCK_SIZE=64, MONTE_CARLO_PARALLEL_THRESHOLD=100):
+        serial = simulate_paths(net, 500, 1000, 1000, 0.03, 0.15, seed=7, workers=1)
+        parallel = simulate_paths(net, 500, 1000, 1000, 0.03, 0.15, seed=7, workers=2)
+    for expected, actual in zip(serial, parallel):
+        assert np.array_equal(expected, actual)
+    assert (serial[1] >= 0).any() and (serial[1] < 0).any()
+
+def test_codec_round_trip():
+    arrays = {
+        'year': np.arange(2025, 2100, dtype=np.int64),
+        'savings': np.array([0, -5, 3 * 10 ** 12, -(2 ** 40), 7], dtype=np.int64),
+        'small': np.array([1, -2, 3], dtype=np.int32),
+        'rate': np.array([0.1, -2.5, float('inf')]),
+        'empty': np.array([], dtype=np.int64),
+    }
+    scalars = {'start_year': 2025, 'first_year': None}
+    
+    # 差分符号化・int32 への縮小の有無によらず、値と型を元に戻す
+    for delta in ((), ('year', 'savings', 'small', 'empty')):
+        unpacked, unpacked_scalars = unpack_arrays(pack_arrays(arrays, scalars, delta=delta))
+        assert unpacked_scalars == scalars
+        assert list(unpacked) == list(arrays)
+        for name, values in arrays.items():
+            assert unpacked[name].dtype == values.dtype, name
+            assert np.array_equal(unpacked[name], values), name
+
+def test_parse_axis():
+    assert parse_axis('0.01, 0.02') == [0.01, 0.02]
+    assert parse_axis('0:0.1:3') == [0.0, 0.05, 0.1]
+    assert parse_axis('2030:2040:3', integer=True) == [2030, 2035, 2040]
+    for text, integer in (('nan', False), ('0.01,inf', False), ('-inf:0.1:3', False), ('2030:nan:3', True), ('', False)):
+        with pytest.raises(ValueError):
+            parse_axis(text, integer=integer)
+
+def test_sweep_matches_simulate_spec():
+    app = setup_app()
+    with app.app_context():
+        spec = compile_plan(make_plan(random.Random(13), children=1, events=2))
+        spec = spec._replace(birth_year=1980, income_self=900, retirement_year_self=2040, savings=1000, base_expenses=400)
+        axes = {'investment_return_rate': [0.0, 0.04], 'retirement_year_self': [2035, 2045, 2050]}
+        result = run_sweep(spec, axes)
+        assert result['scenarios'] == 6
+        assert result['axes']['income_increase_rate'] == [spec.income_increase_rate]
+        
+        # 格子の各セルは、その値に置き換えた PlanSpec を1件ずつ計算した結果と同じ
+        depleted = 0
+        for i, rate in enumerate(axes['investment_return_rate']):
+            for k, year in enumerate(axes['retirement_year_self']):
+                single = simulate_spec(spec._replace(investment_return_rate=rate, retirement_year_self=year))
+                assets = single['savings_state'] + single['investments_state']
+                assert result['final_assets'][i][0][k] == int(assets[-1])
+                # 残高が尽き、赤字を補えなかった最初の年が枯渇年
+                exhausted = np.flatnonzero((assets == 0) & (single['balance'] < 0))
+                expected_age = int(single['age'][exhausted[0]]) if len(exhausted) else None
+                assert result['depletion_age'][i][0][k] == expected_age, (rate, year)
+                depleted += expected_age is not None
+        assert 0 < depleted < 6
+        
+        with configured(SWEEP_MAX_SCENARIOS=5):
+            with pytest.raises(ValueError):
+                run_sweep(spec, axes)
+
+def test_goal_seek():
+    app = setup_app()
+    with app.app_context():
+        spec = compile_plan(make_plan(random.Random(12), children=1, events=0))
+        spec = spec._replace(birth_year=1980, income_self=800, income_spouse=0, income_increase_rate=0.01,
+                             income_after_retirement_self=150, savings=500, investments=0, base_expenses=350)
+        until_age = 90
+        
+        def depletion_ages(overrides):
+            return simulate_batch(spec, {name: np.asarray(values) for name, values in overrides.items()})['depletion_age']
+        
+        def solvent(depletion_age):
+            return (depletion_age < 0) | (depletion_age > until_age)
+        
+        # 逆算した支出額では until_age 歳まで枯渇せず、1万円多いと枯渇する
+        result = goal_seek(spec, 'max_expenses', until_age)
+        value = result['value']
+        assert value and not result.get('capped')
+        assert solvent(depletion_ages({'base_expenses': [value, value + 1]})).tolist() == [True, False]
+        
+        # 退職年は計算期間の全ての年を調べた中で枯渇しない最も早い年
+        years = simulate_batch(spec)['year']
+        ok = solvent(depletion_ages({'retirement_year_self': years}))
+        assert ok.any() and not ok.all()
+        assert goal_seek(spec, 'earliest_retirement', until_age)['value'] == int(years[ok][0])
+        
+        # 範囲外の年齢や現在の年齢より前の年齢は指定できない
+        current_age = datetime.now().year - spec.birth_year
+        for age in (Config.MIN_AGE - 1, Config.MAX_AGE + 1, current_age - 1):
+            with pytest.raises(ValueError):
+                goal_seek(spec, 'max_expenses', age)
+        assert goal_seek(spec, 'max_expenses', current_age)['value'] is not None
+
+def test_sensitivity_by_category():
+    app = setup_app()
+    with app.app_context():
+        # 名前が同じカテゴリもまとめず、カテゴリごとに変化させる
+        category = ExpenseCategory(name='食費')
+        db.session.add(category)
+        db.session.flush()
+        item = ExpenseItem(category_id=category.id, name='嗜好品')
+        db.session.add(item)
+        lifeplan = LifePlan(name='プラン', user_id=1, birth_year=1985, expense_unit='monthly', income_self=600, savings=1000)
+        db.session.add(lifeplan)
+        db.session.flush()
+        amounts = {}
+        for expense_item in ExpenseItem.query.filter(ExpenseItem.name.in_(('食材費', '外食費', '嗜好品'))):
+            amounts[expense_item.category_id] = amounts.get(expense_item.category_id, 0) + 5
+            db.session.add(ExpenseValue(lifeplan_id=lifeplan.id, item_id=expense_item.id, amount=5))
+        db.session.commit()
+        
+        breakdown = expense_breakdown(lifeplan)
+        assert breakdown == {category_id: ('食費', amount * 12) for category_id, amount in amounts.items()}
+        spec = compile_plan(lifeplan)
+        assert sum(amount for _, amount in breakdown.values()) == spec.base_expenses
+        inputs = {item['input']: item for item in run_sensitivity(spec, breakdown)['inputs']}
+        for category_id, (name, amount) in breakdown.items():
+            assert inputs[f'expense:{category_id}']['label'] == name
+            assert inputs[f'expense:{category_id}']['base'] == amount
+
+def test_columnar_storage():
+    app = setup_app()
+    with app.app_context():
+        rng = random.Random(7)
+        plans = [make_plan(rng) for _ in range(4)]
+        for lifeplan in plans:
+            run_simulation(lifeplan)
+        expected = {lifeplan.id: result_rows(lifeplan.id) for lifeplan in plans}
+        
+        # 列形式に変換・書き込みしても、読み取る結果は1年1行の形式と同じ
+        with configured(RESULT_STORAGE='columnar'):
+            assert convert_results('columnar') == len(plans)
+            assert SimulationResult.query.count() == 0
+            assert {lifeplan.id: result_rows(lifeplan.id) for lifeplan in plans} == expected
+            run_simulation(plans[0])
+            assert result_rows(plans[0].id) == expected[plans[0].id]
+            assert load_result_arrays(plans[0].id)['year'].dtype == np.int64
+        
+        # 保存形式を戻した直後も列形式の結果を読める
+        assert result_rows(plans[1].id) == expected[plans[1].id]
+
+@pytest.mark.parametrize('storage', ['rows', 'columnar'])
+def test_incremental_matches_full(storage):
+    app = setup_app()
+    with app.app_context(), configured(RESULT_STORAGE=storage):
+        rng = random.Random(8)
+        start_year = datetime.now().year
+        for _ in range(10):
+            lifeplan = make_plan(rng)
+            run_simulation(lifeplan)
+            
+            # 途中の年のイベントを追加し、その年からだけ再計算する
+            event_year = start_year + rng.randint(1, 40)
+            db.session.add(LifeEvent(lifeplan_id=lifeplan.id, event_type='その他', event_year=event_year,
+                                     cost=rng.randint(100, 2000), recurring=rng.random() < 0.5))
+            db.session.commit()
+            resumable = load_resume_state(lifeplan.id, start_year, event_year) is not None
+            run_simulation(lifeplan, from_year=event_year)
+            
+            # 途中からの結果は全期間を計算し直した結果と一致する
+            full = simulate_lifeplan(lifeplan, start_year)
+            assert result_rows(lifeplan.id) == list(zip(*(full[column].tolist() for column in RESULT_COLUMNS)))
+            if event_year < lifeplan.birth_year + 100:
+                assert resumable, (lifeplan.id, event_year)
+
+def test_job_coalescing():
+    app = setup_app()
+    with app.app_context():
+        lifeplan_id = make_plan(random.Random(9)).id
+        
+        # 実行待ちの間の変更は1つのジョブにまとめ、開始年は早い方（全期間を含む場合は全期間）
+        job_id = enqueue_job(lifeplan_id, 2040, debounce_seconds=0)
+        assert enqueue_job(lifeplan_id, 2035, debounce_seconds=0) == job_id
+        assert db.session.get(SimulationJob, job_id).from_year == 2035
+        assert enqueue_job(lifeplan_id, 2050, debounce_seconds=0) == job_id
+        assert enqueue_job(lifeplan_id, None, debounce_seconds=0) == job_id
+        job = db.session.get(SimulationJob, job_id)
+        assert job.from_year is None and job.coalesced == 3
+        
+        # 実行中の変更は次のジョブになり、実行中のジョブが終わるまで他のワーカーは取得しない
+        assert claim_job('worker-1').id == job_id
+        follow_up = enqueue_job(lifeplan_id, 2045, debounce_seconds=0)
+        assert follow_up != job_id
+        assert claim_job('worker-2') is None
+        assert complete_job(job_id, 'worker-1')
+        assert claim_job('worker-2').id == follow_up
+
+def test_job_retry_backoff_and_purge():
+    app = setup_app()
+    with app.app_context(), configured(SIMULATION_JOB_RETRY_SECONDS=10, SIMULATION_JOB_RETRY_MAX_SECONDS=15):
+        lifeplan_id = make_plan(random.Random(15)).id
+        
+        # 失敗したジョブは待ち時間を過ぎるまで取得されず、待ち時間は試行ごとに倍（上限あり）
+        assert [retry_delay(attempts) for attempts in (1, 2, 3)] == [10, 15, 15]
+        job_id = enqueue_job(lifeplan_id, debounce_seconds=0)
+        assert claim_job('worker-1').id == job_id
+        fail_job(job_id, 'worker-1', RuntimeError('boom'))
+        job = db.session.get(SimulationJob, job_id)
+        assert job.state == 'queued' and job.run_after > datetime.utcnow() + timedelta(seconds=5)
+        assert claim_job('worker-1') is None
+        job.run_after = datetime.utcnow()
+        db.session.commit()
+        assert claim_job('worker-1').id == job_id
+        
+        # 終了してから保持期間を過ぎたジョブの行だけを削除する
+        complete_job(job_id, 'worker-1')
+        recent = enqueue_job(lifeplan_id, debounce_seconds=0)
+        claim_job('worker-1')
+        complete_job(recent, 'worker-1')
+        queued = enqueue_job(lifeplan_id, debounce_seconds=0)
+        db.session.get(SimulationJob, job_id).finished_at = datetime.utcnow() - timedelta(days=30)
+        db.session.commit()
+        assert purge_jobs(retention_seconds=24 * 3600) == 1
+        assert [job.id for job in SimulationJob.query.order_by(SimulationJob.id)] == [recent, queued]
+
+def test_finished_status_expires():
+    app = setup_app()
+    with app.app_context():
+        lifeplan_id = make_plan(random.Random(10)).id
+        
+        # 完了したジョブの状態は TTL の間だけ残り、過ぎたら削除されて 'idle' に戻る
+        quiet(jobs.submit_simulation, lifeplan_id)
+        assert jobs.simulation_status(lifeplan_id)['state'] == 'succeeded'
+        with configured(SIMULATION_STATUS_TTL_SECONDS=0):
+            assert jobs.simulation_status(lifeplan_id)['state'] == 'idle'
+        assert lifeplan_id not in jobs._status and lifeplan_id not in jobs._finished
+
+def test_heartbeat_survives_database_errors():
+    app = setup_app()
+    stop = threading.Event()
+    calls = []
+    
+    def flaky_heartbeat(job_id, worker_id):
+        calls.append(job_id)
+        if len(calls) == 1:
+            raise OperationalError('UPDATE simulation_jobs', {}, Exception('database is locked'))
+        if len(calls) == 3:
+            stop.set()
+        return True
+    
+    # 一時的なエラーの後もリースの延長を続ける
+    original = worker.heartbeat
+    worker.heartbeat = flaky_heartbeat
+    try:
+        with configured(SIMULATION_JOB_HEARTBEAT_SECONDS=0.01):
+            beat = threading.Thread(target=worker._heartbeat_loop, args=(app, 1, 'worker-1', stop))
+            beat.start()
+            beat.join(5)
+    finally:
+        worker.heartbeat = original
+    assert not beat.is_alive() and len(calls) == 3
+
+def test_write_results_bulk():
+    app = setup_app()
+    with app.app_context(), configured(RESULT_STORAGE='rows'):
+        rng = random.Random(14)
+        plans = [make_plan(rng) for _ in range(3)]
+        results = {plan.id: simulate_lifeplan(plan) for plan in plans}
+        
+        # 全プランの行を1回の executemany で挿入し、件数と各段階の所要時間を返す
+        inserts = []
+        
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('INSERT INTO simulation_results'):
+                inserts.append(executemany)
+        
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            timings = write_results(results)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        assert inserts == [True]
+        assert timings['plans'] == 3 and timings['skipped'] == 0
+        assert timings['rows'] == sum(len(result['year']) for result in results.values())
+        stages = ('prepare', 'insert', 'switch', 'commit')
+        assert all(timings[stage] >= 0 for stage in stages)
+        assert abs(timings['total'] - sum(timings[stage] for stage in stages)) < 1e-6
+        for plan in plans:
+            expected = results[plan.id]
+            assert result_rows(plan.id) == list(zip(*(expected[column].tolist() for column in RESULT_COLUMNS)))
+        
+        # 途中の年からの結果は、それより前の年の行を公開中の世代からそのままコピーし、以降の年だけを書き込む
+        lifeplan = plans[0]
+        previous = {row.year: row for row in current_results(lifeplan.id)}
+        resumed_from = min(previous) + 5
+        resume = load_resume_state(lifeplan.id, datetime.now().year, resumed_from)
+        resumed = simulate_spec(compile_plan(lifeplan), resume=resume)
+        assert resumed['resumed_from'] == resumed_from
+        timings = write_results({lifeplan.id: resumed})
+        assert timings['rows'] == len(previous) - 5
+        rows = current_results(lifeplan.id)
+        assert [row.year for row in rows] == sorted(previous)
+        columns = (*RESULT_COLUMNS, 'created_at')
+        for row in rows:
+            if row.year < resumed_from:
+                old = previous[row.year]
+                assert row.generation == old.generation + 1
+                assert [getattr(row, column) for column in columns] == [getattr(old, column) for column in columns]
+        assert result_rows(lifeplan.id) == list(zip(*(results[lifeplan.id][column].tolist() for column in RESULT_COLUMNS)))
+
+def test_results_keep_updated_at():
+    app = setup_app()
+    with app.app_context():
+        lifeplan = make_plan(random.Random(1))
+        stamp = datetime(2020, 1, 1)
+        LifePlan.query.filter_by(id=lifeplan.id).update({'updated_at': stamp})
+        db.session.commit()
+        
+        # 結果の書き込み（公開する世代の切り替え）はプランの更新日時を変えない
+        run_simulation(lifeplan)
+        run_simulation(lifeplan)
+        db.session.expire_all()
+        lifeplan = db.session.get(LifePlan, lifeplan.id)
+        assert lifeplan.updated_at == stamp, lifeplan.updated_at
+        assert lifeplan.final_assets is not None
+
+def test_resume_state_conflict():
+    app = setup_app()
+    with app.app_context(), tempfile.TemporaryDirectory() as directory:
+        rng = random.Random(2)
+        plan_ids = [make_plan(rng).id for _ in range(5)]
+        state_file = os.path.join(directory, 'resimulate.state.json')
+        
+        # 別の条件で中断した再開位置は上書きも削除もしない
+        interrupted = {'filters': {'user_id': 99}, 'last_id': 3, 'processed': 3}
+        with open(state_file, 'w', encoding='utf-8') as f:
+            json.dump(interrupted, f)
+        try:
+            resimulate_plans(plan_ids=plan_ids, workers=1, state_file=state_file)
+            raise AssertionError('ResumeStateConflictError was not raised')
+        except ResumeStateConflictError:
+            pass
+        with open(state_file, encoding='utf-8') as f:
+            assert json.load(f) == interrupted
+        
+        # restart=True なら破棄して最初から実行し、完了後に削除する
+        summary = resimulate_plans(plan_ids=plan_ids, workers=1, chunk_size=2, state_file=state_file, restart=True)
+        assert summary['processed'] == 5 and not os.path.exists(state_file)
+
+def test_resimulate_by_education_key():
+    app = setup_app()
+    with app.app_context(), tempfile.TemporaryDirectory() as directory:
+        rng = random.Random(3)
+        for _ in range(12):
+            run_simulation(make_plan(rng))
+        key = education_key('高校', '私立')
+        expected = affected_plans([key])
+        assert expected and len(expected) < 12
+        
+        # 対象は依存関係の索引で絞り込み、再開用の状態にはプランIDではなくキーを記録する
+        state_file = os.path.join(directory, 'update-education-cost.state.json')
+        states = []
+        
+        def progress(_):
+            with open(state_file, encoding='utf-8') as f:
+                states.append(json.load(f))
+        
+        summary = resimulate_plans(education_keys=[key], workers=1, chunk_size=2, state_file=state_file, progress=progress)
+        assert summary['processed'] == len(expected)
+        assert states[-1]['filters']['education_keys'] == [key]
+        assert states[-1]['filters']['plan_ids'] is None
+        assert PlanDependency.query.filter_by(kind=EDUCATION, key=key).count() == len(expected)
+
+def test_resimulate_matches_run_simulation():
+    app = setup_app()
+    with app.app_context(), tempfile.TemporaryDirectory() as directory, configured(SIMULATION_CACHE_ENABLED=False):
+        rng = random.Random(5)
+        plans = [make_plan(rng) for _ in range(9)]
+        
+        # カテゴリごとの合計は支出値を1件ずつ集計した結果と同じ
+        for plan in plans:
+            by_category = {}
+            for value in ExpenseValue.query.filter_by(lifeplan_id=plan.id):
+                category = value.item.category.name
+                by_category[category] = by_category.get(category, 0) + value.amount
+            totals = plan.get_total_expenses()
+            if by_category:
+                assert totals['by_category'] == by_category and totals['total'] == sum(by_category.values())
+        
+        # プラン数より小さいチャンクで一括再計算した結果は、プランごとの run_simulation と同じ
+        summary = resimulate_plans(workers=1, chunk_size=4, state_file=os.path.join(directory, 'resimulate.state.json'))
+        assert summary['processed'] == len(plans)
+        batched = {plan.id: result_rows(plan.id) for plan in plans}
+        for plan in plans:
+            quiet(run_simulation, plan)
+            assert batched[plan.id] and result_rows(plan.id) == batched[plan.id], plan.id
+
+def test_rollover_matches_full_simulation():
+    app = setup_app()
+    with app.app_context(), tempfile.TemporaryDirectory() as directory, configured(SIMULATION_CACHE_ENABLED=False):
+        rng = random.Random(4)
+        plans = [make_plan(rng) for _ in range(7)]
+        this_year = datetime.now().year
+        state_file = os.path.join(directory, 'rollover.state.json')
+        resimulate_plans(start_year=this_year - 1, workers=1, state_file=state_file)
+        last_year = {plan.id: result_rows(plan.id) for plan in plans}
+        
+        # 前年を開始年とする結果を今年の開始年で計算し直し、再実行しても計算済みのプランは処理しない
+        summary = rollover_plans(start_year=this_year, chunk_size=3, workers=1, pause_ratio=0, state_file=state_file)
+        assert summary['processed'] == len(plans)
+        assert rollover_plans(start_year=this_year, workers=1, pause_ratio=0, state_file=state_file)['processed'] == 0
+        rolled = {plan.id: result_rows(plan.id) for plan in plans}
+        assert any(rolled[plan_id] != rows for plan_id, rows in last_year.items())
+        for plan in plans:
+            quiet(run_simulation, plan)
+            assert result_rows(plan.id) == rolled[plan.id], plan.id
+
+def test_education_vector_cache():
+    app = setup_app()
+    with app.app_context():
+        this_year = datetime.now().year
+        plan_ids = []
+        for _ in range(2):
+            lifeplan = LifePlan(name='プラン', user_id=1, birth_year=1985, expense_unit='yearly', income_self=600)
+            db.session.add(lifeplan)
+            db.session.flush()
+            child = Child(lifeplan_id=lifeplan.id, name='子供', birth_year=this_year - 8)
+            db.session.add(child)
+            db.session.flush()
+            db.session.add(EducationSelection(lifeplan_id=lifeplan.id, child_id=child.id, education_type='小学校', institution_type='私立'))
+            plan_ids.append(lifeplan.id)
+        db.session.commit()
+        
+        # 内容が同じ子供・世帯の配列はプランが違っても計算し直さない
+        child_education_vector.cache_clear()
+        household_education_vector.cache_clear()
+        first = simulate_lifeplan(db.session.get(LifePlan, plan_ids[0]))
+        second = simulate_lifeplan(db.session.get(LifePlan, plan_ids[1]))
+        assert child_education_vector.cache_info().misses == 1
+        assert household_education_vector.cache_info().hits == 1
+        assert np.array_equal(first['expenses'], second['expenses'])
+        
+        # 教育費用マスタを変更すると費用が変わった子供は新しいキーになり、結果はキャッシュなしの計算と同じ
+        EducationCost.query.filter_by(education_type='小学校', institution_type='私立').update({'annual_cost': 130})
+        db.session.commit()
+        invalidate_education_costs()
+        updated = simulate_lifeplan(db.session.get(LifePlan, plan_ids[0]))
+        assert child_education_vector.cache_info().misses == 2
+        assert (updated['expenses'] - first['expenses'])[:4].tolist() == [30] * 4
+        child_education_vector.cache_clear()
+        household_education_vector.cache_clear()
+        uncached = simulate_lifeplan(db.session.get(LifePlan, plan_ids[0]))
+        assert all(np.array_equal(updated[name], uncached[name]) for name in ('expenses', 'savings', 'investments'))
+
+def test_simulation_cache():
+    app = setup_app()
+    with app.app_context():
+        first = make_plan(random.Random(4))
+        stats = cache_stats()
+        run_simulation(first)
+        assert cache_stats()['misses'] == stats['misses'] + 1 and cache_stats()['entries'] == 1
+        
+        # 入力値が同じ別のプランは計算を省略し、同じ結果を公開する
+        same = make_plan(random.Random(4))
+        run_simulation(same)
+        assert cache_stats()['hits'] == stats['hits'] + 1
+        assert result_rows(same.id) == result_rows(first.id)
+        
+        # 入力値が変わると別の結果として計算する
+        same.income_self += 100
+        db.session.commit()
+        run_simulation(same)
+        assert cache_stats()['misses'] == stats['misses'] + 2 and cache_stats()['entries'] == 2
+        assert result_rows(same.id) != result_rows(first.id)
+        
+        # 上限を超えた分は最終利用日時が古い順に削除する（利用したエントリは残る）
+        run_simulation(make_plan(random.Random(5)))
+        oldest = SimulationCache.query.order_by(SimulationCache.last_used_at.asc()).first().fingerprint
+        assert get_cached_result(oldest) is not None
+        db.session.commit()
+        assert evict(max_entries=2) == 1
+        db.session.commit()
+        assert SimulationCache.query.count() == 2 and db.session.get(SimulationCache, oldest) is not None
+
+def main():
+    for case in ENGINE_CASES:
+        test_engine_matches_legacy(*case)
+    test_simulation_cache()
+    test_education_vector_cache()
+    test_generation_publish_and_collect()
+    test_monte_carlo_summary()
+    test_monte_carlo_parallel_matches_serial()
+    test_codec_round_trip()
+    test_parse_axis()
+    test_sweep_matches_simulate_spec()
+    test_goal_seek()
+    test_sensitivity_by_category()
+    test_columnar_storage()
+    for storage in ('rows', 'columnar'):
+        test_incremental_matches_full(storage)
+    test_job_coalescing()
+    test_job_retry_backoff_and_purge()
+    test_finished_status_expires()
+    test_heartbeat_survives_database_errors()
+    test_write_results_bulk()
+    test_results_keep_updated_at()
+    test_resume_state_conflict()
+    test_resimulate_by_education_key()
+    test_resimulate_matches_run_simulation()
+    test_rollover_matches_full_simulation()
+    print('OK')
+
+if __name__ == "__main__":
+    main()
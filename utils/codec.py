@@ -0,0 +1,66 @@
+import json
+import struct
+import zlib
+import numpy as np
+
+# パック形式: [ヘッダー長(4バイト)][ヘッダーJSON][各配列のバイト列] を zlib で圧縮
+_HEADER_LENGTH = struct.Struct('<I')
+
+_INT32 = np.iinfo(np.int32)
+
+def _little_endian(dtype):
+    return dtype.newbyteorder('<') if dtype.byteorder == '>' else dtype
+
+def _narrow(values):
+    """整数配列を、値が収まる場合は int32 で保存する"""
+    if values.dtype.kind == 'i' and values.dtype.itemsize > 4 and len(values):
+        if _INT32.min <= values.min() and values.max() <= _INT32.max:
+            return values.astype('<i4')
+    return values
+
+def pack_arrays(arrays, scalars=None, delta=()):
+    """名前付きのNumPy配列（とスカラー値）を1つのバイト列にまとめる
+    
+    delta に指定した整数配列は前の要素との差分で保存する（年ごとに少しずつ変わる値がよく圧縮される）。
+    整数配列は値が収まれば int32 で保存し、展開時に元の型に戻す。
+    """
+    header = {'arrays': [], 'scalars': scalars or {}}
+    chunks = []
+    for name, values in arrays.items():
+        values = np.ascontiguousarray(values)
+        dtype = _little_endian(values.dtype)
+        encoding = 'raw'
+        if values.dtype.kind == 'i':
+            if name in delta:
+                values = np.diff(values.astype(np.int64), prepend=0)
+                encoding = 'delta'
+            values = _narrow(values)
+        stored = _little_endian(values.dtype)
+        header['arrays'].append([name, stored.str, len(values), dtype.str, encoding])
+        chunks.append(values.astype(stored, copy=False).tobytes())
+    
+    header_bytes = json.dumps(header, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return zlib.compress(_HEADER_LENGTH.pack(len(header_bytes)) + header_bytes + b''.join(chunks))
+
+def unpack_arrays(blob):
+    """pack_arrays でまとめたバイト列を (配列の辞書, スカラー値の辞書) に戻す"""
+    data = zlib.decompress(blob)
+    (header_length,) = _HEADER_LENGTH.unpack_from(data)
+    offset = _HEADER_LENGTH.size
+    header = json.loads(data[offset:offset + header_length].decode('utf-8'))
+    offset += header_length
+    
+    arrays = {}
+    for name, stored, length, *encoding in header['arrays']:
+        stored = np.dtype(stored)
+        values = np.frombuffer(data, dtype=stored, count=length, offset=offset)
+        offset += stored.itemsize * length
+        # 型・符号化の情報がない形式（変換なしで保存したもの）はそのまま返す
+        if encoding:
+            dtype, method = np.dtype(encoding[0]), encoding[1]
+            if method == 'delta':
+                values = np.cumsum(values, dtype=np.int64)
+            if values.dtype != dtype:
+                values = values.astype(dtype)
+        arrays[name] = values
+    return arrays, header['scalars']
@@ -0,0 +1,111 @@
+from sqlalchemy import and_, delete, exists, insert, or_, select
+from app import db
+from config import Config
+from models import ExpenseValue, LifePlan, PlanDependency
+from utils.plan_spec import compile_plan
+
+# 依存するマスターデータの種類
+EDUCATION = 'education'
+EXPENSE_ITEM = 'expense_item'
+
+def education_key(education_type, institution_type, academic_field=None):
+    """教育費用の索引キー（大学以外は専攻を区別しない。EducationCostTable の検索と同じ）"""
+    if education_type != '大学':
+        academic_field = None
+    return f'{education_type}/{institution_type}/{academic_field or ""}'
+
+def dependency_keys(spec, item_ids=()):
+    """PlanSpec が使用するマスターデータの (種類, キー) の集合
+    
+    教育費用は選択がない段階のデフォルト（国公立・文系）も含め、計算に使った組み合わせを記録する。
+    """
+    keys = {
+        (EDUCATION, education_key(stage.education_type, stage.institution_type, stage.academic_field))
+        for child in spec.children for stage in child.stages
+    }
+    keys.update((EXPENSE_ITEM, str(item_id)) for item_id in item_ids)
+    return keys
+
+def refresh_dependencies(specs):
+    """各プランの依存関係の索引を PlanSpec の内容に更新し、変更したプラン数を返す（コミットは呼び出し側で行う）
+    
+    内容が変わらないプランは書き込まない。
+    """
+    plan_ids = [spec.lifeplan_id for spec in specs]
+    if not plan_ids:
+        return 0
+    table = PlanDependency.__table__
+    
+    item_ids = {}
+    for lifeplan_id, item_id in db.session.execute(
+        select(ExpenseValue.lifeplan_id, ExpenseValue.item_id).where(ExpenseValue.lifeplan_id.in_(plan_ids)).distinct()
+    ):
+        item_ids.setdefault(lifeplan_id, []).append(item_id)
+    existing = {}
+    for lifeplan_id, kind, key in db.session.execute(
+        select(table.c.lifeplan_id, table.c.kind, table.c.key).where(table.c.lifeplan_id.in_(plan_ids))
+    ):
+        existing.setdefault(lifeplan_id, set()).add((kind, key))
+    
+    changed = []
+    rows = []
+    for spec in specs:
+        keys = dependency_keys(spec, item_ids.get(spec.lifeplan_id, ()))
+        if keys == existing.get(spec.lifeplan_id, set()):
+            continue
+        changed.append(spec.lifeplan_id)
+        rows.extend({'lifeplan_id': spec.lifeplan_id, 'kind': kind, 'key': key} for kind, key in sorted(keys))
+    
+    if changed:
+        db.session.execute(delete(table).where(table.c.lifeplan_id.in_(changed)))
+    if rows:
+        db.session.execute(insert(table), rows)
+    return len(changed)
+
+def _key_conditions(education_keys=(), expense_item_ids=()):
+    table = PlanDependency.__table__
+    conditions = []
+    if education_keys:
+        conditions.append(and_(table.c.kind == EDUCATION, table.c.key.in_(list(education_keys))))
+    if expense_item_ids:
+        conditions.append(and_(table.c.kind == EXPENSE_ITEM, table.c.key.in_([str(item_id) for item_id in expense_item_ids])))
+    return conditions
+
+def uses_master_data(education_keys=(), expense_item_ids=()):
+    """LifePlan が指定したマスターデータのいずれかを使用する条件（LifePlan のクエリの filter に渡す）
+    
+    プランIDのリストを作らずに絞り込むため、対象が多くてもバインド変数の上限に達しない。
+    """
+    table = PlanDependency.__table__
+    return exists().where(table.c.lifeplan_id == LifePlan.id, or_(*_key_conditions(education_keys, expense_item_ids)))
+
+def affected_plans(education_keys=(), expense_item_ids=()):
+    """指定したマスターデータのいずれかを使用するプランのID（昇順）
+    
+    索引はシミュレーション実行時に更新されるため、索引の作成後に一度も計算していないプランは含まれない
+    （admin_tools.py index-dependencies で全プランの索引を作成できる）。
+    """
+    table = PlanDependency.__table__
+    conditions = _key_conditions(education_keys, expense_item_ids)
+    if not conditions:
+        return []
+    return db.session.execute(
+        select(table.c.lifeplan_id).where(or_(*conditions)).distinct().order_by(table.c.lifeplan_id.asc())
+    ).scalars().all()
+
+def rebuild_dependency_index(chunk_size=None):
+    """全プランの依存関係の索引を作成し直し、変更したプラン数を返す（シミュレーションは実行しない）"""
+    chunk_size = chunk_size or Config.RESIMULATE_CHUNK_SIZE
+    changed = 0
+    last_id = 0
+    while True:
+        plans = LifePlan.query.filter(LifePlan.id > last_id).order_by(LifePlan.id.asc()).limit(chunk_size).all()
+        if not plans:
+            return changed
+        last_id = plans[-1].id
+        try:
+            changed += refresh_dependencies([compile_plan(plan) for plan in plans])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
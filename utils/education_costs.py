@@ -0,0 +1,54 @@
+import threading
+from models import EducationCost
+from utils.master_data import read_master_data_stamp, touch_master_data_stamp
+
+class EducationCostTable:
+    """教育費用マスタのメモリ上の検索テーブル"""
+    
+    def __init__(self, costs):
+        self._costs = {}
+        for cost in costs:
+            # 大学は専攻まで一致するものを、それ以外は専攻を問わず最初の1件を使用（従来の .first() と同じ）
+            self._costs.setdefault((cost.education_type, cost.institution_type, cost.academic_field), cost.annual_cost)
+            self._costs.setdefault((cost.education_type, cost.institution_type), cost.annual_cost)
+    
+    def __len__(self):
+        return len(self._costs)
+    
+    def annual_cost(self, education_type, institution_type, academic_field=None):
+        """教育段階・学校タイプ・専攻に対応する年間費用（該当なしは0）"""
+        if education_type == '大学':
+            return self._costs.get((education_type, institution_type, academic_field), 0)
+        return self._costs.get((education_type, institution_type), 0)
+    
+    def default_annual_cost(self, education_type):
+        """教育選択がない場合のデフォルト（国公立、大学は文系）の年間費用"""
+        return self.annual_cost(education_type, '国公立', '文系')
+
+_lock = threading.Lock()
+_table = None
+_table_stamp = None
+
+def get_education_costs():
+    """プロセス全体で共有する教育費用テーブルを取得（マスタ更新後は再読み込み）"""
+    global _table, _table_stamp
+    
+    stamp = read_master_data_stamp()
+    table = _table
+    if table is not None and stamp == _table_stamp:
+        return table
+    
+    with _lock:
+        if _table is None or stamp != _table_stamp:
+            costs = EducationCost.query.order_by(EducationCost.id.asc()).all()
+            _table = EducationCostTable(costs)
+            _table_stamp = stamp
+        return _table
+
+def invalidate_education_costs():
+    """教育費用マスタの変更を通知し、全プロセスのキャッシュを無効化"""
+    global _table
+    
+    with _lock:
+        _table = None
+    touch_master_data_stamp()
@@ -0,0 +1,213 @@
+from datetime import datetime, timedelta
+from sqlalchemy import and_, case, delete, exists, insert, or_, select, update
+from app import db
+from config import Config
+from models import LifePlan, SimulationJob
+
+def merge_from_year(first, second):
+    """2つの変更をまとめた場合の再計算開始年（どちらかが全期間なら全期間）"""
+    if first is None or second is None:
+        return None
+    return min(first, second)
+
+def _claimable(table, now):
+    """取得できるジョブの条件（実行を待つ期間を過ぎた実行待ち、またはリースが切れた実行中のジョブ）"""
+    return or_(
+        and_(table.c.state == 'queued', or_(table.c.run_after.is_(None), table.c.run_after <= now)),
+        and_(table.c.state == 'running', table.c.lease_expires_at < now),
+    )
+
+def _not_running(table, now):
+    """同じプランの別のジョブが（有効なリースで）実行中でない"""
+    running = SimulationJob.__table__.alias('running')
+    return ~exists().where(
+        running.c.lifeplan_id == table.c.lifeplan_id,
+        running.c.id != table.c.id,
+        running.c.state == 'running',
+        running.c.lease_expires_at >= now,
+    )
+
+def enqueue_job(lifeplan_id, from_year=None, debounce_seconds=None):
+    """シミュレーションのジョブを登録してコミットし、ジョブIDを返す
+    
+    同じプランの実行待ちジョブがある場合は新しく登録せず、そのジョブにまとめる
+    （再計算の開始年は早い方にし、実行開始を debounce_seconds 秒後に延ばす）。
+    """
+    debounce_seconds = Config.SIMULATION_DEBOUNCE_SECONDS if debounce_seconds is None else debounce_seconds
+    table = SimulationJob.__table__
+    now = datetime.utcnow()
+    run_after = now + timedelta(seconds=debounce_seconds)
+    if from_year is None:
+        merged_from_year = None
+    else:
+        merged_from_year = case(
+            (table.c.from_year.is_(None), None),
+            (table.c.from_year > from_year, from_year),
+            else_=table.c.from_year,
+        )
+    
+    try:
+        queued = db.session.execute(
+            select(table.c.id)
+            .where(table.c.lifeplan_id == lifeplan_id, table.c.state == 'queued')
+            .order_by(table.c.id.desc()).limit(1)
+        ).scalar()
+        if queued is not None and db.session.execute(
+            update(table)
+            .where(table.c.id == queued, table.c.state == 'queued')
+            .values(from_year=merged_from_year, run_after=run_after, coalesced=table.c.coalesced + 1)
+        ).rowcount:
+            job_id = queued
+        else:
+            job_id = db.session.execute(
+                insert(table).values(lifeplan_id=lifeplan_id, from_year=from_year, state='queued',
+                                     attempts=0, coalesced=0, run_after=run_after, created_at=now)
+            ).inserted_primary_key[0]
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return job_id
+
+def claim_job(worker_id, lease_seconds=None):
+    """実行待ちのジョブを1件取得してリースを設定する（ない場合は None）
+    
+    SQLiteで読み取りから書き込みへの昇格による競合が起きないよう、トランザクションは更新から始める。
+    候補を選んだ後、状態が変わっていない場合だけ更新する条件付きUPDATEで取得するため、
+    複数のワーカーが同時に取得しようとしても1つのワーカーだけが成功する（SQLite・PostgreSQL共通）。
+    同じプランのジョブが実行中の場合は取得せず（同じプランを同時に計算しない）、
+    同じプランの他の実行待ちジョブは取得したジョブにまとめる。
+    リースが切れたジョブ（停止したワーカーが実行していたもの）もここで再取得される。
+    """
+    lease_seconds = lease_seconds or Config.SIMULATION_JOB_LEASE_SECONDS
+    table = SimulationJob.__table__
+    while True:
+        now = datetime.utcnow()
+        # 試行回数の上限に達したままリースが切れたジョブは再実行せず失敗にする
+        db.session.execute(
+            update(table)
+            .where(table.c.state == 'running', table.c.lease_expires_at < now,
+                   table.c.attempts >= Config.SIMULATION_JOB_MAX_ATTEMPTS)
+            .values(state='failed', lease_expires_at=None, finished_at=now, error='lease expired')
+        )
+        candidate = db.session.execute(
+            select(table.c.id, table.c.lifeplan_id)
+            .where(_claimable(table, now), _not_running(table, now))
+            .order_by(table.c.id.asc()).limit(1)
+        ).first()
+        if candidate is None:
+            db.session.rollback()
+            return None
+        
+        # プランの行をロックし、同じプランのジョブを取得するワーカーを1つにする（SQLiteでは書き込みロックで直列化）
+        db.session.execute(select(LifePlan.id).where(LifePlan.id == candidate.lifeplan_id).with_for_update())
+        claimed = db.session.execute(
+            update(table)
+            .where(table.c.id == candidate.id, _claimable(table, now), _not_running(table, now))
+            .values(state='running', worker_id=worker_id, attempts=table.c.attempts + 1,
+                    lease_expires_at=now + timedelta(seconds=lease_seconds), started_at=now)
+        ).rowcount
+        if claimed:
+            _absorb_queued(table, candidate.id, candidate.lifeplan_id, now)
+        db.session.commit()
+        if claimed:
+            return db.session.get(SimulationJob, candidate.id)
+        # 他のワーカーが先に取得した場合は次の候補を探す
+
+def _absorb_queued(table, job_id, lifeplan_id, now):
+    """同じプランの他の実行待ちジョブを取得したジョブにまとめる"""
+    others = db.session.execute(
+        select(table.c.id, table.c.from_year)
+        .where(table.c.lifeplan_id == lifeplan_id, table.c.state == 'queued', table.c.id != job_id)
+    ).all()
+    if not others:
+        return
+    
+    from_year = db.session.execute(select(table.c.from_year).where(table.c.id == job_id)).scalar()
+    for _, other_from_year in others:
+        from_year = merge_from_year(from_year, other_from_year)
+    db.session.execute(
+        update(table).where(table.c.id == job_id)
+        .values(from_year=from_year, coalesced=table.c.coalesced + len(others))
+    )
+    db.session.execute(
+        update(table).where(table.c.id.in_([other_id for other_id, _ in others]))
+        .values(state='merged', finished_at=now)
+    )
+
+def heartbeat(job_id, worker_id, lease_seconds=None):
+    """リースを延長する（他のワーカーに取られていた場合は False）"""
+    lease_seconds = lease_seconds or Config.SIMULATION_JOB_LEASE_SECONDS
+    table = SimulationJob.__table__
+    extended = db.session.execute(
+        update(table)
+        .where(table.c.id == job_id, table.c.worker_id == worker_id, table.c.state == 'running')
+        .values(lease_expires_at=datetime.utcnow() + timedelta(seconds=lease_seconds))
+    ).rowcount
+    db.session.commit()
+    return bool(extended)
+
+def complete_job(job_id, worker_id):
+    """ジョブを完了にする（リースを失っていた場合は False）"""
+    table = SimulationJob.__table__
+    completed = db.session.execute(
+        update(table)
+        .where(table.c.id == job_id, table.c.worker_id == worker_id, table.c.state == 'running')
+        .values(state='succeeded', lease_expires_at=None, finished_at=datetime.utcnow(), error=None)
+    ).rowcount
+    db.session.commit()
+    return bool(completed)
+
+def retry_delay(attempts):
+    """attempts 回目の失敗の後、再実行するまでの待ち時間（秒、試行ごとに倍にして上限で止める）"""
+    return min(Config.SIMULATION_JOB_RETRY_SECONDS * 2 ** max(0, attempts - 1), Config.SIMULATION_JOB_RETRY_MAX_SECONDS)
+
+def fail_job(job_id, worker_id, error, max_attempts=None):
+    """ジョブの失敗を記録する
+    
+    試行回数が上限未満なら実行待ちに戻し、retry_delay 秒後まで取得されないようにする
+    （入力によって必ず失敗するプランを続けて再実行しないため）。
+    """
+    max_attempts = max_attempts or Config.SIMULATION_JOB_MAX_ATTEMPTS
+    table = SimulationJob.__table__
+    now = datetime.utcnow()
+    try:
+        attempts = db.session.execute(select(table.c.attempts).where(table.c.id == job_id)).scalar() or 0
+        retry = table.c.attempts < max_attempts
+        db.session.execute(
+            update(table)
+            .where(table.c.id == job_id, table.c.worker_id == worker_id, table.c.state == 'running')
+            .values(state=case((retry, 'queued'), else_='failed'), lease_expires_at=None, error=str(error),
+                    run_after=now + timedelta(seconds=retry_delay(attempts)),
+                    finished_at=case((retry, None), else_=now))
+        )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+def purge_jobs(retention_seconds=None):
+    """終了してから retention_seconds 秒を過ぎたジョブ（完了・失敗・統合）の行を削除し、件数を返す
+    
+    ジョブテーブルが際限なく大きくならないよう、ワーカーが定期的に呼び出す。
+    """
+    retention_seconds = Config.SIMULATION_JOB_RETENTION_SECONDS if retention_seconds is None else retention_seconds
+    table = SimulationJob.__table__
+    try:
+        deleted = db.session.execute(
+            delete(table).where(
+                table.c.state.in_(('succeeded', 'failed', 'merged')),
+                table.c.finished_at < datetime.utcnow() - timedelta(seconds=retention_seconds),
+            )
+        ).rowcount
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return deleted
+
+def latest_job(lifeplan_id):
+    """プランの最新のジョブ（ない場合は None）"""
+    return SimulationJob.query.filter(
+        SimulationJob.lifeplan_id == lifeplan_id, SimulationJob.state != 'merged'
+    ).order_by(SimulationJob.id.desc()).first()
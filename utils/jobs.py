@@ -0,0 +1,238 @@
+import atexit
+import logging
+from collections import OrderedDict
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from flask import current_app
+from app import db
+from config import Config
+from models import LifePlan
+from utils.simulation import run_simulation
+from utils.job_queue import enqueue_job, latest_job, merge_from_year
+from utils.result_store import collect_old_results
+
+logger = logging.getLogger(__name__)
+
+# 実行待ち・実行中のジョブ状態
+PENDING_STATES = ('queued', 'running')
+
+_executor = None
+_executor_lock = threading.Lock()
+_slots = None  # 実行待ち＋実行中のジョブ数の上限（Config.SIMULATION_QUEUE_DEPTH）
+
+# プランごとの最新ジョブの状態（実行待ち・実行中のジョブはプランごとに1つ）
+_status = {}
+_status_lock = threading.Lock()
+# 完了・失敗したジョブのプランID → 終了時刻（time.monotonic()、終了した順）
+_finished = OrderedDict()
+
+def _get_executor():
+    """シミュレーション用のスレッドプールを取得"""
+    global _executor, _slots
+    
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=Config.SIMULATION_WORKERS, thread_name_prefix='simulation')
+            _slots = threading.BoundedSemaphore(Config.SIMULATION_QUEUE_DEPTH)
+        return _executor
+
+@atexit.register
+def shutdown_simulation_pool(wait=True):
+    """スレッドプールを終了（実行待ちのジョブは wait=True なら完了まで待つ）"""
+    global _executor
+    
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=wait)
+            _executor = None
+
+def background_enabled(app=None):
+    """バックグラウンドで実行できるか
+    
+    インメモリのSQLiteは全スレッドで1つの接続を共有するため、
+    別スレッドのトランザクションと混ざらないようリクエスト内で実行する。
+    """
+    app = app or current_app
+    uri = app.config.get('SQLALCHEMY_DATABASE_URI') or ''
+    in_memory = uri.startswith('sqlite') and (uri in ('sqlite://', 'sqlite:///:memory:') or 'mode=memory' in uri)
+    return Config.SIMULATION_BACKGROUND and not in_memory
+
+def _now():
+    return datetime.utcnow().isoformat()
+
+def _finish(status, **values):
+    """ジョブを終了状態にし、期限切れの状態を削除する（_status_lock を取得して呼び出す）"""
+    status.update(finished_at=_now(), **values)
+    _finished.pop(status['lifeplan_id'], None)
+    _finished[status['lifeplan_id']] = time.monotonic()
+    _prune_finished()
+
+def _prune_finished():
+    """終了してから Config.SIMULATION_STATUS_TTL_SECONDS 秒を過ぎたジョブの状態を削除する（_status_lock を取得して呼び出す）
+    
+    プランごとの状態を残し続けるとプロセスのメモリが際限なく増えるため、終了した順に古いものから削除する。
+    """
+    expires = time.monotonic() - Config.SIMULATION_STATUS_TTL_SECONDS
+    while _finished:
+        lifeplan_id, finished = next(iter(_finished.items()))
+        if finished > expires:
+            return
+        del _finished[lifeplan_id]
+        status = _status.get(lifeplan_id)
+        if status is not None and status['state'] not in PENDING_STATES:
+            del _status[lifeplan_id]
+
+def _wait_for_quiet(status):
+    """最後の変更から Config.SIMULATION_DEBOUNCE_SECONDS 秒経つまで待つ（待つ間の変更は同じ実行にまとめる）"""
+    while True:
+        with _status_lock:
+            remaining = status['_last_change'] + Config.SIMULATION_DEBOUNCE_SECONDS - time.monotonic()
+        if remaining <= 0:
+            return
+        time.sleep(remaining)
+
+def _collect_old_results(lifeplan_id):
+    """公開中でなくなった世代の結果を削除（失敗してもジョブは成功として扱う）"""
+    try:
+        collect_old_results([lifeplan_id])
+    except Exception:
+        logger.exception('failed to collect old results for lifeplan %s', lifeplan_id)
+
+def _run_job(status, debounce=False):
+    """プランのジョブを実行する（アプリケーションコンテキスト内で呼び出す）
+    
+    実行中に届いた変更は1回の再実行にまとめ、このスレッドで続けて計算する。
+    同じプランのジョブは常に1つなので、同じプランを同時に計算することはない。
+    """
+    lifeplan_id = status['lifeplan_id']
+    if debounce:
+        _wait_for_quiet(status)
+    with _status_lock:
+        from_year = status['from_year']
+        status.update(state='running', started_at=_now())
+    
+    while True:
+        try:
+            lifeplan = db.session.get(LifePlan, lifeplan_id)
+            # ジョブの実行前にプランが削除された場合は何もしない
+            if lifeplan is not None:
+                run_simulation(lifeplan, from_year=from_year)
+            error = None
+        except Exception as e:
+            db.session.rollback()
+            logger.exception('simulation job %s for lifeplan %s failed', status['job_id'], lifeplan_id)
+            error = e
+        
+        if error is None:
+            _collect_old_results(lifeplan_id)
+        
+        with _status_lock:
+            if not status['_rerun']:
+                if error is None:
+                    _finish(status, state='succeeded', error=None)
+                    return
+                _finish(status, state='failed', error=str(error))
+                raise error
+            # 実行中に変更があった場合は続けて再計算（失敗していた場合は全期間）
+            from_year = None if error is not None else status['_rerun_from_year']
+            status.update(_rerun=False, _rerun_from_year=None, runs=status['runs'] + 1,
+                          error=str(error) if error is not None else None)
+        
+        db.session.expire_all()
+        if debounce:
+            _wait_for_quiet(status)
+
+def _run_in_pool(app, status):
+    """プールのスレッドでジョブを実行（セッションはジョブごとのアプリケーションコンテキストで作る）"""
+    try:
+        with app.app_context():
+            _run_job(status, debounce=True)
+    except Exception:
+        # 失敗はジョブの状態に記録済み
+        pass
+    finally:
+        _slots.release()
+
+def submit_simulation(lifeplan_id, from_year=None):
+    """シミュレーションの実行を登録し、すぐに戻る
+    
+    同じプランのジョブが実行待ちの場合はそのジョブに、実行中の場合は完了後の1回の再実行にまとめる
+    （再計算の開始年はまとめた変更のうち最も早い年）。
+    実行待ち＋実行中のジョブが上限に達している場合は、呼び出し元のスレッドで実行する
+    （編集が集中しても待ち行列が際限なく伸びないよう、登録する側を遅くする）。
+    バックグラウンド実行が無効な場合も同様にその場で実行し、例外はそのまま送出する。
+    Config.SIMULATION_QUEUE が 'database' の場合はジョブテーブルに登録するだけで、実行は worker.py が行う。
+    戻り値はジョブの状態。
+    """
+    if Config.SIMULATION_QUEUE == 'database':
+        # ジョブテーブルに登録し、worker.py のプロセスに実行させる
+        enqueue_job(lifeplan_id, from_year)
+        return simulation_status(lifeplan_id)
+    
+    app = current_app._get_current_object()
+    with _status_lock:
+        _prune_finished()
+        status = _status.get(lifeplan_id)
+        if status is not None and status['state'] in PENDING_STATES:
+            if status['state'] == 'queued':
+                status['from_year'] = merge_from_year(status['from_year'], from_year)
+            else:
+                status['_rerun_from_year'] = merge_from_year(status['_rerun_from_year'], from_year) if status['_rerun'] else from_year
+                status['_rerun'] = True
+            status['coalesced'] += 1
+            status['_last_change'] = time.monotonic()
+            return _public_status(status)
+        
+        status = {
+            'lifeplan_id': lifeplan_id,
+            'job_id': uuid.uuid4().hex,
+            'state': 'queued',
+            'from_year': from_year,
+            'coalesced': 0,  # このジョブにまとめた変更の数
+            'runs': 1,  # 実行中の変更による再実行を含めた計算回数
+            'submitted_at': _now(),
+            'started_at': None,
+            'finished_at': None,
+            'error': None,
+            '_rerun': False,
+            '_rerun_from_year': None,
+            '_last_change': time.monotonic(),
+        }
+        _status[lifeplan_id] = status
+        _finished.pop(lifeplan_id, None)
+    
+    if background_enabled(app):
+        executor = _get_executor()
+        if _slots.acquire(blocking=False):
+            try:
+                executor.submit(_run_in_pool, app, status)
+            except Exception:
+                _slots.release()
+                raise
+            return simulation_status(lifeplan_id)
+        logger.info('simulation queue is full, running lifeplan %s in the request thread', lifeplan_id)
+    
+    _run_job(status)
+    return simulation_status(lifeplan_id)
+
+def _public_status(status):
+    """状態の辞書から内部用の項目を除いたコピー"""
+    status = {key: value for key, value in status.items() if not key.startswith('_')}
+    status['pending'] = status['state'] in PENDING_STATES
+    return status
+
+def simulation_status(lifeplan_id):
+    """プランの最新ジョブの状態（ジョブがない場合は 'idle'）"""
+    if Config.SIMULATION_QUEUE == 'database':
+        job = latest_job(lifeplan_id)
+        status = job.to_dict() if job else {'lifeplan_id': lifeplan_id, 'job_id': None, 'state': 'idle'}
+        status['pending'] = status['state'] in PENDING_STATES
+        return status
+    
+    with _status_lock:
+        _prune_finished()
+        status = _status.get(lifeplan_id)
+        return _public_status(status or {'lifeplan_id': lifeplan_id, 'job_id': None, 'state': 'idle'})
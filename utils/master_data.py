@@ -0,0 +1,25 @@
+import os
+import time
+from config import Config
+
+def read_master_data_stamp():
+    """マスターデータのスタンプ（最終更新時刻）を取得。未作成の場合は None"""
+    try:
+        return os.stat(Config.MASTER_DATA_STAMP_FILE).st_mtime_ns
+    except OSError:
+        return None
+
+def touch_master_data_stamp():
+    """マスターデータが更新されたことを他のプロセスに通知する"""
+    path = Config.MASTER_DATA_STAMP_FILE
+    previous = read_master_data_stamp()
+    
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a'):
+        pass
+    
+    # 時刻の分解能が粗い環境で連続して更新しても、必ずスタンプが変わるようにする
+    stamp = time.time_ns()
+    if previous is not None and stamp <= previous:
+        stamp = previous + 1
+    os.utime(path, ns=(stamp, stamp))
@@ -0,0 +1,170 @@
+import atexit
+import math
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from config import Config
+from utils.simulation import build_cashflows, rollforward_batch
+
+# 資産推移として返すパーセンタイル
+PERCENTILES = (5, 25, 50, 75, 95)
+
+def generate_return_paths(n_paths, n_years, mean, volatility, seed=None):
+    """投資収益率の経路（形状 (n_paths, n_years)）を正規分布から生成"""
+    rng = np.random.default_rng(seed)
+    return rng.normal(mean, volatility, size=(n_paths, n_years))
+
+def path_blocks(n_paths, seed=None, block_size=None):
+    """経路を固定長のブロックに分け、ブロックごとに独立した乱数シードを割り当てる
+    
+    シードはブロック単位で決まるため、何プロセスで分担しても同じ乱数列になる。
+    """
+    block_size = block_size or Config.MONTE_CARLO_BLOCK_SIZE
+    starts = range(0, n_paths, block_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+    return [(start, min(start + block_size, n_paths), block_seed) for start, block_seed in zip(starts, seeds)]
+
+def _simulate_blocks(blocks, net, savings, investments, mean, volatility, assets, depleted_index):
+    """ブロックごとに収益率の経路を生成して繰り越し、結果を出力配列の該当行に書き込む"""
+    for start, stop, block_seed in blocks:
+        returns = generate_return_paths(stop - start, len(net), mean, volatility, block_seed)
+        assets[start:stop], depleted_index[start:stop] = rollforward_batch(net, returns, savings, investments)
+
+def _simulate_blocks_shared(blocks, net, savings, investments, mean, volatility, assets_name, depleted_name, n_paths):
+    """ワーカープロセス用: 共有メモリ上の結果バッファに直接書き込む（結果は返さない）
+    
+    共有メモリの削除は作成した親プロセスが行う（spawn で起動したワーカーは親と同じ
+    resource_tracker を共有するため、ここでは閉じるだけでよい）。
+    """
+    assets_shm = shared_memory.SharedMemory(name=assets_name)
+    depleted_shm = shared_memory.SharedMemory(name=depleted_name)
+    try:
+        assets = np.ndarray((n_paths, len(net)), dtype=np.float64, buffer=assets_shm.buf)
+        depleted_index = np.ndarray((n_paths,), dtype=np.int64, buffer=depleted_shm.buf)
+        _simulate_blocks(blocks, net, savings, investments, mean, volatility, assets, depleted_index)
+        del assets, depleted_index
+    finally:
+        assets_shm.close()
+        depleted_shm.close()
+    return len(blocks)
+
+_executor = None
+_executor_workers = 0
+_executor_lock = threading.Lock()
+
+def _get_executor(workers):
+    """プロセス間で使い回すワーカープールを取得（プロセス数が変わった場合は作り直す）"""
+    global _executor, _executor_workers
+    
+    with _executor_lock:
+        if _executor is None or _executor_workers != workers:
+            if _executor is not None:
+                _executor.shutdown()
+            # Flaskのスレッドを引き継がないよう spawn で起動（macOSの既定と同じ）
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _executor_workers = workers
+        return _executor
+
+@atexit.register
+def shutdown_monte_carlo_pool():
+    """ワーカープールを終了"""
+    global _executor
+    
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
+
+def simulate_paths(net, savings, investments, n_paths, mean, volatility, seed=None, workers=None, reduce=None):
+    """n_paths 経路の総資産推移と資産枯渇年を計算
+    
+    経路数が多い場合はブロックを複数プロセスに分担させ、各プロセスは共有メモリ上の
+    結果バッファに直接書き込む。結果はプロセス数によらずビット単位で一致する。
+    reduce を指定した場合は、バッファを複製せずに reduce(assets, depleted_index) の結果を返す。
+    """
+    reduce = reduce or (lambda assets, depleted_index: (assets.copy(), depleted_index.copy()))
+    net = np.ascontiguousarray(net, dtype=np.float64)
+    blocks = path_blocks(n_paths, seed)
+    workers = Config.MONTE_CARLO_WORKERS if workers is None else workers
+    workers = max(1, min(workers, len(blocks)))
+    
+    if workers == 1 or n_paths < Config.MONTE_CARLO_PARALLEL_THRESHOLD:
+        assets = np.empty((n_paths, len(net)), dtype=np.float64)
+        depleted_index = np.empty(n_paths, dtype=np.int64)
+        _simulate_blocks(blocks, net, savings, investments, mean, volatility, assets, depleted_index)
+        return reduce(assets, depleted_index)
+    
+    assets_shm = shared_memory.SharedMemory(create=True, size=max(1, n_paths * len(net) * 8))
+    depleted_shm = shared_memory.SharedMemory(create=True, size=n_paths * 8)
+    try:
+        # ブロックを順番に各ワーカーへ割り当てる
+        executor = _get_executor(workers)
+        futures = [
+            executor.submit(
+                _simulate_blocks_shared, blocks[i::workers], net, savings, investments, mean, volatility,
+                assets_shm.name, depleted_shm.name, n_paths
+            )
+            for i in range(workers)
+        ]
+        for future in futures:
+            future.result()
+        
+        assets = np.ndarray((n_paths, len(net)), dtype=np.float64, buffer=assets_shm.buf)
+        depleted_index = np.ndarray((n_paths,), dtype=np.int64, buffer=depleted_shm.buf)
+        try:
+            return reduce(assets, depleted_index)
+        finally:
+            # 共有メモリを閉じる前にバッファへの参照を解放する
+            del assets, depleted_index
+    finally:
+        assets_shm.close()
+        assets_shm.unlink()
+        depleted_shm.close()
+        depleted_shm.unlink()
+
+def summarize_paths(cashflows, assets, depleted_index, depletion_age):
+    """経路ごとの総資産からパーセンタイル帯と資産枯渇確率を集計"""
+    ages = cashflows['age']
+    bands = np.percentile(assets, PERCENTILES, axis=0) if assets.shape[1] else np.zeros((len(PERCENTILES), 0))
+    
+    # 各年までに資産が枯渇した経路の割合（累積）
+    depleted = depleted_index >= 0
+    by_year = np.bincount(depleted_index[depleted], minlength=len(ages)).cumsum() / max(len(depleted_index), 1)
+    
+    depleted_before = depleted & (ages[np.maximum(depleted_index, 0)] < depletion_age) if len(ages) else depleted
+    return {
+        'years': cashflows['year'].tolist(),
+        'ages': ages.tolist(),
+        'percentiles': {f'p{p}': band.astype(np.int64).tolist() for p, band in zip(PERCENTILES, bands)},
+        'depletion_age': depletion_age,
+        'depletion_probability': float(depleted_before.mean()) if len(depleted_index) else 0.0,
+        'depletion_probability_by_year': by_year.tolist(),
+    }
+
+def run_monte_carlo(spec, n_paths=None, mean=None, volatility=None, depletion_age=None, seed=None, start_year=None, workers=None):
+    """投資収益率を確率的に変動させたシミュレーションを n_paths 経路分まとめて実行
+    
+    収入・支出は決定論的シミュレーションと同じものを使い、投資収益率だけを
+    平均 mean・標準偏差 volatility の正規分布から年ごと・経路ごとに生成する。
+    """
+    n_paths = Config.MONTE_CARLO_PATHS if n_paths is None else int(n_paths)
+    if not 0 < n_paths <= Config.MONTE_CARLO_MAX_PATHS:
+        raise ValueError(f'試行回数は1〜{Config.MONTE_CARLO_MAX_PATHS}の範囲で指定してください。')
+    mean = spec.investment_return_rate if mean is None else mean
+    volatility = Config.MONTE_CARLO_VOLATILITY if volatility is None else volatility
+    if not math.isfinite(mean):
+        raise ValueError('収益率には有限の値を指定してください。')
+    if not (math.isfinite(volatility) and volatility >= 0):
+        raise ValueError('標準偏差には0以上の有限の値を指定してください。')
+    depletion_age = Config.MONTE_CARLO_DEPLETION_AGE if depletion_age is None else depletion_age
+    
+    cashflows = build_cashflows(spec, start_year)
+    summary = simulate_paths(
+        cashflows['income'] - cashflows['expenses'], spec.savings, spec.investments,
+        n_paths, mean, volatility, seed=seed, workers=workers,
+        reduce=lambda assets, depleted_index: summarize_paths(cashflows, assets, depleted_index, depletion_age)
+    )
+    summary.update(paths=n_paths, mean=mean, volatility=volatility)
+    return summary
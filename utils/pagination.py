@@ -0,0 +1,132 @@
+import base64
+import json
+from datetime import datetime
+from sqlalchemy import select, tuple_
+from app import db
+from config import Config
+from models import LifePlan
+
+# 並べ替えに使える列（それぞれ (user_id, 列, id) の複合インデックスがある）
+PLAN_SORT_KEYS = {
+    'updated_at': LifePlan.updated_at,
+    'name': LifePlan.name,
+    'final_assets': LifePlan.final_assets,
+}
+PLAN_SORT_ORDERS = ('asc', 'desc')
+
+def encode_cursor(sort, order, value, last_id):
+    """次のページの開始位置（直前の行の並べ替えの値とID）を不透明な文字列にする"""
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    payload = json.dumps([sort, order, value, last_id], ensure_ascii=False, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, sort, order):
+    """encode_cursor の文字列から (並べ替えの値, ID) を取り出す（並べ替えが異なるカーソルは無効）"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        cursor_sort, cursor_order, value, last_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        if (cursor_sort, cursor_order) != (sort, order) or not isinstance(last_id, int):
+            raise ValueError
+        if value is not None and sort == 'updated_at':
+            value = datetime.fromisoformat(value)
+    except (ValueError, TypeError, UnicodeError):
+        raise ValueError('カーソルが正しくありません。')
+    return value, last_id
+
+def parse_plan_listing(args):
+    """一覧のクエリパラメータ（sort, order, limit, cursor, q, family_structure, min_final_assets, max_final_assets）を解釈する"""
+    sort = args.get('sort') or 'updated_at'
+    if sort not in PLAN_SORT_KEYS:
+        raise ValueError(f'sort には {", ".join(PLAN_SORT_KEYS)} のいずれかを指定してください。')
+    order = args.get('order') or ('asc' if sort == 'name' else 'desc')
+    if order not in PLAN_SORT_ORDERS:
+        raise ValueError('order には asc または desc を指定してください。')
+    
+    try:
+        limit = int(args.get('limit') or Config.PLAN_PAGE_SIZE)
+        min_final_assets = int(args['min_final_assets']) if args.get('min_final_assets') else None
+        max_final_assets = int(args['max_final_assets']) if args.get('max_final_assets') else None
+    except ValueError:
+        raise ValueError('limit・min_final_assets・max_final_assets は整数で指定してください。')
+    if not 1 <= limit <= Config.PLAN_PAGE_SIZE_MAX:
+        raise ValueError(f'limit は1以上{Config.PLAN_PAGE_SIZE_MAX}以下で指定してください。')
+    
+    return {
+        'sort': sort,
+        'order': order,
+        'limit': limit,
+        'cursor': args.get('cursor') or None,
+        'q': args.get('q') or None,
+        'family_structure': args.get('family_structure') or None,
+        'min_final_assets': min_final_assets,
+        'max_final_assets': max_final_assets,
+    }
+
+def plan_page(user_id, sort='updated_at', order='desc', limit=None, cursor=None,
+              q=None, family_structure=None, min_final_assets=None, max_final_assets=None):
+    """ユーザーのライフプランの1ページ分のIDと次のページのカーソル（最後のページは None）
+    
+    (並べ替えの列, ID) によるキーセットページングで、(user_id, 列, id) のインデックスの範囲を読むため、
+    何ページ目でもプランの件数によらず読む行数はページの大きさ程度になる。
+    並べ替えの値が NULL（未計算の final_assets など）の行は最小の値として扱い（昇順では先頭、降順では末尾）、
+    NULL の行と NULL でない行は別のクエリで読む（それぞれインデックスの範囲になるよう OR を使わない）。
+    """
+    limit = limit or Config.PLAN_PAGE_SIZE
+    column = PLAN_SORT_KEYS[sort]
+    descending = order == 'desc'
+    
+    conditions = [LifePlan.user_id == user_id]
+    if q:
+        conditions.append(LifePlan.name.contains(q, autoescape=True))
+    if family_structure:
+        conditions.append(LifePlan.family_structure == family_structure)
+    if min_final_assets is not None:
+        conditions.append(LifePlan.final_assets >= min_final_assets)
+    if max_final_assets is not None:
+        conditions.append(LifePlan.final_assets <= max_final_assets)
+    
+    # NULL の区間と NULL でない区間を並び順に読む（位置はカーソルの値が NULL かどうかで決まる）
+    segments = ['not_null', 'null'] if descending else ['null', 'not_null']
+    if not column.nullable:
+        segments.remove('null')
+    value = last_id = None
+    if cursor:
+        value, last_id = decode_cursor(cursor, sort, order)
+        current = 'null' if value is None else 'not_null'
+        if current not in segments:
+            return {'ids': [], 'next_cursor': None}
+        segments = segments[segments.index(current):]
+    
+    rows = []
+    for segment in segments:
+        statement = select(LifePlan.id, column).where(*conditions)
+        if segment == 'null':
+            statement = statement.where(column.is_(None))
+            position = LifePlan.id
+            key = last_id
+            ordering = [LifePlan.id.desc() if descending else LifePlan.id.asc()]
+        else:
+            statement = statement.where(column.isnot(None))
+            position = tuple_(column, LifePlan.id)
+            key = tuple_(value, last_id)
+            ordering = [column.desc(), LifePlan.id.desc()] if descending else [column.asc(), LifePlan.id.asc()]
+        # カーソルと同じ区間ではカーソルより後の行だけを読む
+        if last_id is not None and (segment == 'null') == (value is None):
+            statement = statement.where(position < key if descending else position > key)
+        rows.extend(db.session.execute(statement.order_by(*ordering).limit(limit + 1 - len(rows))).all())
+        if len(rows) > limit:
+            break
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(sort, order, rows[-1][1], rows[-1][0])
+    return {'ids': [row[0] for row in rows], 'next_cursor': next_cursor}
+
+def plans_in_order(ids):
+    """ID のリストと同じ順序の LifePlan のリスト"""
+    if not ids:
+        return []
+    plans = {plan.id: plan for plan in LifePlan.query.filter(LifePlan.id.in_(ids))}
+    return [plans[plan_id] for plan_id in ids if plan_id in plans]
@@ -0,0 +1,139 @@
+from collections import namedtuple
+from app import db
+from models import EDUCATION_STAGES, LifeEvent, Child, EducationSelection, ExpenseCategory, ExpenseItem, ExpenseValue
+from utils.education_costs import get_education_costs
+
+# ライフイベント（単発または継続）
+EventSpec = namedtuple('EventSpec', ['event_year', 'cost', 'recurring', 'recurring_end_year'])
+
+# 子供の教育段階ごとの選択と年間費用（EDUCATION_STAGES と同じ順序）
+StageSpec = namedtuple('StageSpec', ['education_type', 'institution_type', 'academic_field', 'annual_cost'])
+ChildSpec = namedtuple('ChildSpec', ['birth_year', 'stages'])
+
+# シミュレーションに必要なライフプランの入力値（ORMオブジェクトを含まない不変データ）
+PlanSpec = namedtuple('PlanSpec', [
+    'lifeplan_id',
+    'birth_year',
+    'income_self',
+    'income_spouse',
+    'income_increase_rate',
+    'retirement_year_self',
+    'retirement_year_spouse',
+    'income_after_retirement_self',
+    'income_after_retirement_spouse',
+    'savings',
+    'investments',
+    'investment_return_rate',
+    'base_expenses',  # 教育費・税金・イベントを除いた年間支出（万円/年）
+    'events',  # 単発イベント → 継続イベントの順（各々ID順）
+    'children',
+])
+
+def compile_child_stages(selections, costs):
+    """子供の教育選択から各教育段階の選択内容と年間費用を確定する"""
+    chosen = {}
+    for selection in selections:
+        chosen.setdefault(selection.education_type, selection)
+    
+    stages = []
+    for stage, _, _ in EDUCATION_STAGES:
+        selection = chosen.get(stage)
+        if selection:
+            institution_type, academic_field = selection.institution_type, selection.academic_field
+        else:
+            # 教育選択がない場合は国公立（大学は文系）をデフォルトとして使用
+            institution_type, academic_field = '国公立', '文系'
+        
+        if stage != '大学':
+            academic_field = None
+        annual_cost = costs.annual_cost(stage, institution_type, academic_field)
+        stages.append(StageSpec(stage, institution_type, academic_field, annual_cost))
+    
+    return tuple(stages)
+
+def _base_expenses(lifeplan):
+    """教育費・税金・イベントを除いた年間の基本支出"""
+    expenses = lifeplan.get_total_expenses()['total']
+    
+    # 月間データの場合は年間に変換
+    if lifeplan.expense_unit == 'monthly':
+        expenses *= 12
+    return expenses
+
+# 従来の支出項目とカテゴリ名（教育費は別途計算するため含めない）
+LEGACY_EXPENSE_FIELDS = (
+    ('expense_housing', '住居費'),
+    ('expense_living', '生活費'),
+    ('expense_insurance', '保険料'),
+    ('expense_loan', 'ローン返済'),
+    ('expense_entertainment', '娯楽費'),
+    ('expense_transportation', '交通費'),
+)
+
+def expense_breakdown(lifeplan):
+    """基本支出のカテゴリごとの (カテゴリ名, 年額)（合計は PlanSpec.base_expenses と同じ）
+    
+    キーはカテゴリID（詳細支出情報がない場合は従来の支出項目の列名）。名前が同じカテゴリもまとめない。
+    """
+    # カテゴリは支出値が最初に登録された順に並べる（LifePlan.get_total_expenses と同じ）
+    categories = (
+        db.session.query(ExpenseCategory.id, ExpenseCategory.name, db.func.sum(ExpenseValue.amount))
+        .join(ExpenseItem, ExpenseItem.category_id == ExpenseCategory.id)
+        .join(ExpenseValue, ExpenseValue.item_id == ExpenseItem.id)
+        .filter(ExpenseValue.lifeplan_id == lifeplan.id)
+        .group_by(ExpenseCategory.id, ExpenseCategory.name)
+        .order_by(db.func.min(ExpenseValue.id).asc())
+        .all()
+    )
+    breakdown = {category_id: (name, amount or 0) for category_id, name, amount in categories}
+    if not breakdown:
+        # 詳細支出情報がない場合は従来の支出項目
+        breakdown = {field: (label, getattr(lifeplan, field) or 0) for field, label in LEGACY_EXPENSE_FIELDS}
+    
+    # 月間データの場合は年間に変換
+    if lifeplan.expense_unit == 'monthly':
+        breakdown = {key: (name, amount * 12) for key, (name, amount) in breakdown.items()}
+    return breakdown
+
+def compile_plan(lifeplan):
+    """ライフプランと関連データを一度だけ読み込み、シミュレーション用の PlanSpec に変換"""
+    # イベントは単発 → 継続の順に並べておく（支出への加算順序を従来版と揃えるため）
+    events = LifeEvent.query.filter_by(lifeplan_id=lifeplan.id).order_by(LifeEvent.id.asc()).all()
+    event_specs = tuple(
+        EventSpec(event.event_year, event.cost or 0, bool(event.recurring), event.recurring_end_year)
+        for event in sorted(events, key=lambda event: bool(event.recurring))
+    )
+    
+    children = Child.query.filter_by(lifeplan_id=lifeplan.id).order_by(Child.id.asc()).all()
+    child_specs = ()
+    if children:
+        selections_by_child = {child.id: [] for child in children}
+        selections = EducationSelection.query.filter(
+            EducationSelection.child_id.in_(selections_by_child.keys())
+        ).order_by(EducationSelection.id.asc()).all()
+        for selection in selections:
+            selections_by_child[selection.child_id].append(selection)
+        
+        costs = get_education_costs()
+        child_specs = tuple(
+            ChildSpec(child.birth_year, compile_child_stages(selections_by_child[child.id], costs))
+            for child in children
+        )
+    
+    return PlanSpec(
+        lifeplan_id=lifeplan.id,
+        birth_year=lifeplan.birth_year,
+        income_self=lifeplan.income_self or 0,
+        income_spouse=lifeplan.income_spouse or 0,
+        income_increase_rate=lifeplan.income_increase_rate,
+        retirement_year_self=lifeplan.retirement_year_self,
+        retirement_year_spouse=lifeplan.retirement_year_spouse,
+        income_after_retirement_self=lifeplan.income_after_retirement_self or 0,
+        income_after_retirement_spouse=lifeplan.income_after_retirement_spouse or 0,
+        savings=lifeplan.savings or 0,
+        investments=lifeplan.investments or 0,
+        investment_return_rate=lifeplan.investment_return_rate,
+        base_expenses=_base_expenses(lifeplan),
+        events=event_specs,
+        children=child_specs,
+    )
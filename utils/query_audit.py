@@ -0,0 +1,194 @@
+import contextlib
+import io
+import random
+from datetime import datetime, timedelta
+from sqlalchemy import event, insert
+from werkzeug.security import generate_password_hash
+from app import db
+from models import (
+    EDUCATION_STAGES, User, LifePlan, LifeEvent, Child, EducationSelection, EducationCost,
+    ExpenseCategory, ExpenseItem, ExpenseValue, SimulationResult,
+)
+
+# 監査するルート（{id} は監査するプランのID、{event_id} はそのプランのイベントID）
+AUDIT_ROUTES = (
+    '/',
+    '/dashboard',
+    '/lifeplan/',
+    '/lifeplan/?sort=name&order=asc&q=プラン1',
+    '/lifeplan/{id}',
+    '/lifeplan/{id}/edit',
+    '/lifeplan/{id}/events',
+    '/lifeplan/{id}/events/{event_id}/edit',
+    '/api/lifeplans',
+    '/api/lifeplans?view=summary&sort=final_assets&order=asc',
+    '/api/lifeplans/{id}',
+    '/api/lifeplans/{id}/events',
+    '/api/lifeplans/{id}/results',
+    '/api/lifeplans/{id}/simulation/status',
+    '/api/lifeplans/{id}/monte-carlo?paths=1000',
+    '/api/lifeplans/{id}/sensitivity',
+    '/api/lifeplans/{id}/export/json',
+    '/api/lifeplans/{id}/export/csv',
+)
+
+# 全件を読んでも問題ないテーブル（件数の少ないマスターデータと、件数に上限があるシミュレーション結果のキャッシュ）
+SMALL_TABLES = ('expense_categories', 'expense_items', 'education_costs', 'simulation_cache')
+
+AUDIT_EMAIL = 'audit@example.com'
+AUDIT_PASSWORD = 'audit'
+
+def seed_audit_data(users=10, plans_per_user=500, years=60, seed=0):
+    """空のデータベースに監査用の大きなデータを作成し、監査するユーザー・プラン・イベントのIDを返す
+    
+    各プランに支出項目・子供と教育選択・イベント・公開中の結果（years 年分）を持たせる。
+    件数が多いため、ORMオブジェクトは作らずに一括挿入する（IDは1から順に割り当てる）。
+    """
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    
+    education_costs = []
+    for education_type, _, _ in EDUCATION_STAGES:
+        for institution_type in ('国公立', '私立'):
+            for academic_field in (('文系', '理系') if education_type == '大学' else (None,)):
+                education_costs.append({
+                    'education_type': education_type, 'institution_type': institution_type,
+                    'academic_field': academic_field, 'annual_cost': rng.randint(10, 150),
+                })
+    db.session.execute(insert(EducationCost.__table__), education_costs)
+    db.session.execute(insert(ExpenseCategory.__table__), [
+        {'id': category_id, 'name': f'カテゴリ{category_id}', 'description': None} for category_id in range(1, 11)
+    ])
+    items = [{'id': item_id, 'category_id': (item_id - 1) // 5 + 1, 'name': f'項目{item_id}', 'description': None}
+             for item_id in range(1, 51)]
+    db.session.execute(insert(ExpenseItem.__table__), items)
+    
+    password_hash = generate_password_hash(AUDIT_PASSWORD)
+    db.session.execute(insert(User.__table__), [
+        {'id': user_id, 'username': f'audit{user_id}', 'email': AUDIT_EMAIL if user_id == 1 else f'audit{user_id}@example.com',
+         'password_hash': password_hash, 'created_at': now}
+        for user_id in range(1, users + 1)
+    ])
+    
+    plans, values, children, selections, events, results = [], [], [], [], [], []
+    for lifeplan_id in range(1, users * plans_per_user + 1):
+        birth_year = rng.randint(1950, 2000)
+        updated_at = now - timedelta(minutes=rng.randint(0, 500000))
+        savings = rng.randint(0, 3000)
+        plans.append({
+            'id': lifeplan_id, 'name': f'プラン{lifeplan_id}', 'user_id': (lifeplan_id - 1) // plans_per_user + 1,
+            'created_at': updated_at, 'updated_at': updated_at, 'birth_year': birth_year,
+            'family_structure': rng.choice(['単身', '夫婦', '夫婦+子供1人', '夫婦+子供2人']),
+            'income_self': rng.randint(0, 1200), 'income_spouse': rng.randint(0, 600), 'income_increase_rate': 0.02,
+            'savings': savings, 'investments': rng.randint(0, 3000), 'investment_return_rate': 0.03,
+            'expense_unit': 'yearly', 'result_generation': 1, 'final_assets': rng.choice([None, rng.randint(-5000, 20000)]),
+        })
+        for item in rng.sample(items, 15):
+            values.append({'lifeplan_id': lifeplan_id, 'item_id': item['id'], 'amount': rng.randint(1, 60)})
+        for _ in range(rng.randint(0, 2)):
+            child_id = len(children) + 1
+            children.append({'id': child_id, 'lifeplan_id': lifeplan_id, 'name': '子供', 'birth_year': rng.randint(2000, 2030)})
+            for education_type, _, _ in EDUCATION_STAGES:
+                selections.append({
+                    'lifeplan_id': lifeplan_id, 'child_id': child_id, 'education_type': education_type,
+                    'institution_type': rng.choice(['国公立', '私立']),
+                    'academic_field': rng.choice(['文系', '理系']) if education_type == '大学' else None,
+                })
+        for _ in range(rng.randint(1, 5)):
+            event_year = rng.randint(2025, 2080)
+            events.append({
+                'lifeplan_id': lifeplan_id, 'event_type': 'その他', 'event_year': event_year, 'description': None,
+                'cost': rng.randint(10, 1000), 'recurring': False, 'recurring_end_year': None,
+            })
+        for offset in range(years):
+            results.append({
+                'lifeplan_id': lifeplan_id, 'generation': 1, 'year': now.year + offset, 'age': now.year + offset - birth_year,
+                'income': 500, 'expenses': 400, 'savings': savings + offset * 100, 'investments': 0, 'balance': 100,
+                'created_at': now,
+            })
+    
+    for table, rows in ((LifePlan.__table__, plans), (ExpenseValue.__table__, values), (Child.__table__, children),
+                        (EducationSelection.__table__, selections), (LifeEvent.__table__, events),
+                        (SimulationResult.__table__, results)):
+        for start in range(0, len(rows), 10000):
+            db.session.execute(insert(table), rows[start:start + 10000])
+    db.session.commit()
+    
+    lifeplan_id = plans_per_user // 2
+    event_id = next(index for index, row in enumerate(events, 1) if row['lifeplan_id'] == lifeplan_id)
+    return {
+        'users': users, 'plans': len(plans), 'expense_values': len(values), 'events': len(events),
+        'results': len(results), 'lifeplan_id': lifeplan_id, 'event_id': event_id,
+    }
+
+def capture_queries(engine, function):
+    """function の実行中に発行されたSQL（executemany を除く）と引数のリスト"""
+    statements = []
+    
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            statements.append((statement, parameters))
+    
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        function()
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return statements
+
+def explain_query_plan(statement, parameters):
+    """EXPLAIN QUERY PLAN の各行の説明"""
+    rows = db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+    return [row[-1] for row in rows]
+
+def full_scans(plan):
+    """クエリプランのうち、SMALL_TABLES 以外のテーブルを全件走査する行"""
+    scans = []
+    for line in plan:
+        words = line.split()
+        if words[0] == 'SCAN' and len(words) > 1 and words[1] not in SMALL_TABLES and words[1] != 'CONSTANT':
+            scans.append(line)
+    return scans
+
+def audit_statements(label, statements):
+    """SQLごと（同じ文は1回）のクエリプランと全件走査"""
+    queries = []
+    seen = set()
+    for statement, parameters in statements:
+        if statement in seen or not statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'WITH')):
+            continue
+        seen.add(statement)
+        plan = explain_query_plan(statement, parameters)
+        queries.append({'sql': ' '.join(statement.split()), 'plan': plan, 'scans': full_scans(plan)})
+    return {'label': label, 'statements': len(statements), 'queries': queries}
+
+def audit_routes(app, data, routes=AUDIT_ROUTES):
+    """各ルートの取得（とシミュレーションの実行）で発行されるSQLのクエリプランを調べる
+    
+    data は seed_audit_data の戻り値。監査するユーザーでログインしたテストクライアントでルートを順に取得する。
+    """
+    client = app.test_client()
+    client.post('/auth/login', data={'email': AUDIT_EMAIL, 'password': AUDIT_PASSWORD})
+    
+    reports = []
+    with app.app_context():
+        engine = db.engine
+    for route in routes:
+        url = route.format(id=data['lifeplan_id'], event_id=data['event_id'])
+        responses = []
+        statements = capture_queries(engine, lambda: responses.append(client.get(url)))
+        with app.app_context():
+            report = audit_statements(f'GET {url}', statements)
+        report['status'] = responses[0].status_code
+        reports.append(report)
+    
+    # 編集の保存後などに実行されるシミュレーション（結果の書き込みを含む）
+    from utils.simulation import run_simulation
+    with app.app_context():
+        lifeplan = db.session.get(LifePlan, data['lifeplan_id'])
+        with contextlib.redirect_stdout(io.StringIO()):
+            statements = capture_queries(engine, lambda: run_simulation(lifeplan))
+        report = audit_statements('run_simulation', statements)
+        report['status'] = None
+        reports.append(report)
+    return reports
@@ -0,0 +1,203 @@
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from app import db
+from config import Config
+from sqlalchemy import exists
+from models import LifePlan, SimulationCheckpoint
+from utils.dependencies import refresh_dependencies, uses_master_data
+from utils.plan_spec import compile_plan
+from utils.result_store import ResultConflictError, write_results, collect_old_results
+from utils.simulation import simulate_spec
+
+logger = logging.getLogger(__name__)
+
+def simulate_specs(specs, start_year):
+    """複数の PlanSpec をまとめて計算する（データベースにアクセスしないためワーカープロセスで実行できる）"""
+    return {spec.lifeplan_id: simulate_spec(spec, start_year) for spec in specs}
+
+def _plan_query(user_id=None, plan_ids=None, updated_before=None, stale_for_year=None, education_keys=None, expense_item_ids=None):
+    query = LifePlan.query
+    if user_id is not None:
+        query = query.filter(LifePlan.user_id == user_id)
+    if plan_ids is not None:
+        query = query.filter(LifePlan.id.in_(list(plan_ids)))
+    if education_keys or expense_item_ids:
+        query = query.filter(uses_master_data(education_keys or (), expense_item_ids or ()))
+    if updated_before is not None:
+        query = query.filter(LifePlan.updated_at < updated_before)
+    if stale_for_year is not None:
+        # stale_for_year 以降を開始年とする結果（チェックポイント）がないプラン
+        query = query.filter(~exists().where(
+            SimulationCheckpoint.lifeplan_id == LifePlan.id, SimulationCheckpoint.start_year >= stale_for_year
+        ))
+    return query
+
+class ResumeStateConflictError(RuntimeError):
+    """再開用の状態ファイルに、別の条件で中断した実行の再開位置が記録されている"""
+
+def _load_state(state_file, filters):
+    """中断した前回の実行状態を読み込む（条件が異なる場合は再開位置を上書きしないよう中止する）"""
+    if not state_file or not os.path.exists(state_file):
+        return None
+    with open(state_file, encoding='utf-8') as f:
+        state = json.load(f)
+    if state.get('filters') != filters:
+        raise ResumeStateConflictError(
+            f'{state_file} には別の条件で中断した実行の再開位置が記録されています。'
+            '同じ条件で再実行して完了させるか、--restart で破棄するか、別の --state-file を指定してください。'
+        )
+    return state
+
+def _save_state(state_file, state):
+    """実行状態を書き込む（途中で止まっても壊れないよう一時ファイルから置き換える）"""
+    if not state_file:
+        return
+    directory = os.path.dirname(state_file)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary = f'{state_file}.tmp'
+    with open(temporary, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(temporary, state_file)
+
+def _write_chunk(results, generations):
+    """チャンクの結果をまとめて書き込み、書き込まなかったプラン数を返す
+    
+    プランを読み込んだ後にアプリケーション側で結果が公開されたプランは、入力が変わっている可能性があるため飛ばす。
+    書き込みの途中で公開されて一括の書き込みが中止された場合は、1プランずつ書き込み直す。
+    """
+    try:
+        return write_results(results, expected_generations=generations)['skipped']
+    except ResultConflictError:
+        pass
+    
+    skipped = 0
+    for lifeplan_id, result in results.items():
+        try:
+            skipped += write_results({lifeplan_id: result}, expected_generations=generations)['skipped']
+        except ResultConflictError:
+            skipped += 1
+    return skipped
+
+def resimulate_plans(user_id=None, plan_ids=None, updated_before=None, start_year=None,
+                     chunk_size=None, workers=None, state_file=None, restart=False, progress=None,
+                     stale_only=False, pause_ratio=0, education_keys=None, expense_item_ids=None):
+    """条件に合うプランを一括で再計算し、チャンクごとにまとめて書き込む
+    
+    プランはID順に chunk_size 件ずつ読み込み、親プロセスで PlanSpec に変換してからプロセスプールで計算する。
+    次のチャンクの読み込みは前のチャンクの計算と並行して行う。
+    書き込んだチャンクの最後のIDを state_file に記録するため、中断しても同じ条件で実行すれば続きから再開する
+    （restart=True の場合は最初から）。state_file に別の条件の再開位置がある場合は ResumeStateConflictError。progress にはチャンクごとの進捗の辞書が渡される。
+    stale_only=True の場合は start_year を開始年とする結果がまだないプランだけを対象にする。
+    education_keys・expense_item_ids を指定すると、そのマスターデータを使用するプランだけを対象にする
+    （依存関係の索引で絞り込み、再開用の状態にはプランIDではなくキーを記録する）。
+    pause_ratio を指定すると、チャンクを書き込むたびに書き込みにかかった時間の pause_ratio 倍だけ待つ
+    （SQLiteのファイルを共有するアプリケーションの書き込みが待たされ続けないようにする）。
+    戻り値は処理したプラン数などの集計。
+    """
+    chunk_size = chunk_size or Config.RESIMULATE_CHUNK_SIZE
+    workers = workers or Config.RESIMULATE_WORKERS
+    start_year = start_year or datetime.now().year
+    filters = {
+        'user_id': user_id,
+        'plan_ids': sorted(plan_ids) if plan_ids is not None else None,
+        'updated_before': updated_before.isoformat() if updated_before else None,
+        'start_year': start_year,
+        'stale_only': stale_only,
+        'education_keys': sorted(education_keys) if education_keys else None,
+        'expense_item_ids': sorted(expense_item_ids) if expense_item_ids else None,
+    }
+    
+    state = None if restart else _load_state(state_file, filters)
+    if state is None:
+        state = {'filters': filters, 'last_id': 0, 'processed': 0, 'started_at': datetime.utcnow().isoformat()}
+    elif state['last_id']:
+        logger.info('resuming after lifeplan %s (%d plans already done)', state['last_id'], state['processed'])
+    
+    query = _plan_query(user_id, plan_ids, updated_before, start_year if stale_only else None, education_keys, expense_item_ids)
+    total = state['processed'] + query.filter(LifePlan.id > state['last_id']).count()
+    started = time.perf_counter()
+    processed_now = 0
+    skipped = 0
+    
+    def next_chunk(after_id):
+        plans = query.filter(LifePlan.id > after_id).order_by(LifePlan.id.asc()).limit(chunk_size).all()
+        specs = [compile_plan(plan) for plan in plans]
+        generations = {plan.id: plan.result_generation for plan in plans}
+        return specs, generations
+    
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    
+    def submit(specs):
+        if executor is None:
+            return None, simulate_specs(specs, start_year)
+        # ワーカー間で分担するため、チャンクをさらにプロセス数に分けて計算
+        size = max(1, -(-len(specs) // workers))
+        return [executor.submit(simulate_specs, specs[i:i + size], start_year) for i in range(0, len(specs), size)], None
+    
+    try:
+        specs, generations = next_chunk(state['last_id'])
+        while specs:
+            futures, results = submit(specs)
+            last_id = specs[-1].lifeplan_id
+            # 計算中に次のチャンクを読み込む
+            upcoming = next_chunk(last_id)
+            if futures is not None:
+                results = {}
+                for future in futures:
+                    results.update(future.result())
+            
+            writing = time.perf_counter()
+            skipped += _write_chunk(results, generations)
+            collect_old_results(list(results.keys()))
+            try:
+                refresh_dependencies(specs)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            if pause_ratio:
+                time.sleep((time.perf_counter() - writing) * pause_ratio)
+            
+            processed_now += len(specs)
+            state.update(last_id=last_id, processed=state['processed'] + len(specs), updated_at=datetime.utcnow().isoformat())
+            _save_state(state_file, state)
+            
+            if progress is not None:
+                elapsed = time.perf_counter() - started
+                rate = processed_now / elapsed if elapsed > 0 else 0.0
+                progress({
+                    'processed': state['processed'],
+                    'total': total,
+                    'last_id': last_id,
+                    'elapsed': elapsed,
+                    'rate': rate,
+                    'eta': (total - state['processed']) / rate if rate else None,
+                    'skipped': skipped,
+                })
+            specs, generations = upcoming
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    
+    # 最後まで終わった場合は再開用の状態を削除
+    if state_file and os.path.exists(state_file):
+        os.remove(state_file)
+    
+    elapsed = time.perf_counter() - started
+    return {
+        'processed': state['processed'],
+        'processed_now': processed_now,
+        'total': total,
+        'skipped': skipped,
+        'elapsed': elapsed,
+        'rate': processed_now / elapsed if elapsed > 0 else 0.0,
+        'start_year': start_year,
+    }
@@ -0,0 +1,416 @@
+import logging
+import time
+from datetime import datetime
+import numpy as np
+from sqlalchemy import and_, delete, func, insert, literal, select, update
+from app import db
+from config import Config
+from models import LifePlan, SimulationResult, SimulationResultSet, SimulationCheckpoint
+from utils.codec import pack_arrays, unpack_arrays
+
+logger = logging.getLogger(__name__)
+
+# SimulationResult に保存する列（シミュレーション結果の配列名と同じ）
+RESULT_COLUMNS = ('year', 'age', 'income', 'expenses', 'savings', 'investments', 'balance')
+
+def result_rows(lifeplan_id, result, created_at=None):
+    """シミュレーション結果の配列を simulation_results への挿入用の辞書リストに変換"""
+    created_at = created_at or datetime.utcnow()
+    return [
+        dict(zip(RESULT_COLUMNS, values), lifeplan_id=lifeplan_id, created_at=created_at)
+        for values in zip(*(result[column].tolist() for column in RESULT_COLUMNS))
+    ]
+
+def checkpoint_row(lifeplan_id, result, updated_at=None):
+    """シミュレーション結果の各年末残高を simulation_checkpoints への挿入用の辞書に変換"""
+    return {
+        'lifeplan_id': lifeplan_id,
+        'start_year': result['start_year'],
+        'first_year': result['first_year'],
+        'savings_state': np.asarray(result['savings_state'], dtype='<f8').tobytes(),
+        'investments_state': np.asarray(result['investments_state'], dtype='<f8').tobytes(),
+        'updated_at': updated_at or datetime.utcnow(),
+    }
+
+def load_resume_state(lifeplan_id, start_year, from_year):
+    """from_year から再計算するためのチェックポイントを取得（使えない場合は None）"""
+    checkpoint = db.session.get(SimulationCheckpoint, lifeplan_id)
+    if checkpoint is None or checkpoint.start_year != start_year:
+        return None
+    
+    savings_state = np.frombuffer(checkpoint.savings_state, dtype='<f8')
+    investments_state = np.frombuffer(checkpoint.investments_state, dtype='<f8')
+    index = from_year - checkpoint.first_year
+    # 先頭の年からの場合や、保存済みの期間を外れる場合は全期間を計算し直す
+    if index <= 0 or index >= len(savings_state) or len(investments_state) != len(savings_state):
+        return None
+    
+    return {
+        'index': index,
+        'savings_state': savings_state,
+        'investments_state': investments_state,
+    }
+
+class ResultConflictError(RuntimeError):
+    """同じプランの結果が並行して書き込まれ、公開する世代を切り替えられなかった"""
+
+def _storage_order():
+    """結果を読む保存形式の順序（設定中の形式を先に読み、形式を切り替えた直後の結果も読めるようにする）"""
+    return ('columnar', 'rows') if Config.RESULT_STORAGE == 'columnar' else ('rows', 'columnar')
+
+def _published(table):
+    """公開中の世代の条件（プランの世代と同じ文で結合し、切り替えの前後どちらか一方の世代だけを読む）"""
+    lifeplans = LifePlan.__table__
+    return table.join(lifeplans, and_(lifeplans.c.id == table.c.lifeplan_id, lifeplans.c.result_generation == table.c.generation))
+
+def pack_result_set(result):
+    """結果の各列を差分符号化した1つのバイト列にまとめる"""
+    return pack_arrays({column: np.asarray(result[column], dtype=np.int64) for column in RESULT_COLUMNS}, delta=RESULT_COLUMNS)
+
+def final_assets(result):
+    """結果の最終年の総資産（預貯金＋投資資産。年がない場合は None）"""
+    if not len(result['year']):
+        return None
+    return int(result['savings'][-1]) + int(result['investments'][-1])
+
+def result_set_row(lifeplan_id, generation, result, created_at=None):
+    """シミュレーション結果の配列を simulation_result_sets への挿入用の辞書に変換"""
+    years = result['year']
+    return {
+        'lifeplan_id': lifeplan_id,
+        'generation': generation,
+        'first_year': int(years[0]) if len(years) else None,
+        'n_years': len(years),
+        'payload': pack_result_set(result),
+        'created_at': created_at or datetime.utcnow(),
+    }
+
+def _load_from_rows(lifeplan_id):
+    table = SimulationResult.__table__
+    rows = db.session.execute(
+        select(*(table.c[column] for column in RESULT_COLUMNS), table.c.created_at)
+        .select_from(_published(table))
+        .where(table.c.lifeplan_id == lifeplan_id)
+        .order_by(table.c.year.asc())
+    ).all()
+    if not rows:
+        return None
+    columns = list(zip(*rows))
+    arrays = {column: np.array(values, dtype=np.int64) for column, values in zip(RESULT_COLUMNS, columns)}
+    return arrays, rows[0].created_at
+
+def _load_from_result_set(lifeplan_id):
+    table = SimulationResultSet.__table__
+    row = db.session.execute(
+        select(table.c.payload, table.c.created_at)
+        .select_from(_published(table))
+        .where(table.c.lifeplan_id == lifeplan_id)
+    ).first()
+    if row is None:
+        return None
+    arrays, _ = unpack_arrays(row.payload)
+    return arrays, row.created_at
+
+def _load_published(lifeplan_id):
+    for storage in _storage_order():
+        loaded = _load_from_result_set(lifeplan_id) if storage == 'columnar' else _load_from_rows(lifeplan_id)
+        if loaded is not None:
+            return loaded
+    return None
+
+def load_result_arrays(lifeplan_id):
+    """公開中の世代の結果を列ごとのNumPy配列（int64）で取得（結果がない場合は None）"""
+    loaded = _load_published(lifeplan_id)
+    return loaded[0] if loaded else None
+
+def load_result_lists(lifeplan_id):
+    """公開中の世代の結果を列ごとのリストで取得（結果がない場合は各列が空のリスト）"""
+    arrays = load_result_arrays(lifeplan_id)
+    return {column: arrays[column].tolist() if arrays else [] for column in RESULT_COLUMNS}
+
+def current_results(lifeplan_id):
+    """公開中の世代のシミュレーション結果（年順の SimulationResult）
+    
+    プランの世代と結果を1つのクエリで結合して読むため、
+    書き込み中や世代の切り替え直後でも、常にどちらか一方の世代の全行が返る。
+    列形式で保存されている場合はセッションに追加しない SimulationResult を組み立てて返す。
+    """
+    for storage in _storage_order():
+        if storage == 'rows':
+            results = SimulationResult.query.join(
+                LifePlan,
+                and_(LifePlan.id == SimulationResult.lifeplan_id, LifePlan.result_generation == SimulationResult.generation),
+            ).filter(SimulationResult.lifeplan_id == lifeplan_id).order_by(SimulationResult.year.asc()).all()
+            if results:
+                return results
+        else:
+            loaded = _load_from_result_set(lifeplan_id)
+            if loaded is not None:
+                arrays, created_at = loaded
+                return [
+                    SimulationResult(lifeplan_id=lifeplan_id, created_at=created_at, **dict(zip(RESULT_COLUMNS, values)))
+                    for values in zip(*(arrays[column].tolist() for column in RESULT_COLUMNS))
+                ]
+    return []
+
+def _with_prefix(lifeplan_id, result):
+    """途中の年から再計算した結果に、公開中の世代のそれより前の年を補って全期間の結果にする"""
+    published = load_result_arrays(lifeplan_id)
+    if published is None:
+        return result
+    keep = published['year'] < result['resumed_from']
+    return dict(result, **{
+        column: np.concatenate([published[column][keep], np.asarray(result[column], dtype=np.int64)])
+        for column in RESULT_COLUMNS
+    })
+
+def _has_rows(lifeplan_id, generation):
+    table = SimulationResult.__table__
+    return db.session.execute(
+        select(table.c.id).where(table.c.lifeplan_id == lifeplan_id, table.c.generation == generation).limit(1)
+    ).first() is not None
+
+def write_results(results_by_plan, expected_generations=None):
+    """複数プランのシミュレーション結果を新しい世代として書き込み、1つのトランザクションで公開する
+    
+    Config.RESULT_STORAGE が 'rows' の場合は executemany による一括挿入で1年1行、
+    'columnar' の場合は1プラン1件の列形式で書き込む（どちらもORMオブジェクトは作らない）。
+    途中の年から再計算した結果（resumed_from が設定されたもの）は、それより前の年を
+    公開中の世代から補う（同じ行形式ならデータベース内でコピーする）。最後に LifePlan.result_generation を
+    切り替えるため、読み取り側は書き込みの途中でも前の世代の結果を読める。古い世代は collect_old_results で削除する。
+    同時に一覧の並べ替え用の LifePlan.final_assets（最終年の総資産）を更新する。
+    expected_generations（プランID→計算に使った入力を読んだ時点の公開中の世代）を渡すと、
+    その後に別の結果が公開されたプランは書き込まずに飛ばす。
+    戻り値は件数（飛ばしたプラン数 'skipped' を含む）と各段階の所要時間（秒）。
+    """
+    timings = {'plans': len(results_by_plan), 'rows': 0, 'skipped': 0}
+    if not results_by_plan:
+        return timings
+    
+    columnar = Config.RESULT_STORAGE == 'columnar'
+    table = SimulationResult.__table__
+    result_sets = SimulationResultSet.__table__
+    checkpoints = SimulationCheckpoint.__table__
+    lifeplans = LifePlan.__table__
+    started = time.perf_counter()
+    
+    created_at = datetime.utcnow()
+    plan_ids = list(results_by_plan.keys())
+    try:
+        current = dict(db.session.execute(
+            select(lifeplans.c.id, lifeplans.c.result_generation).where(lifeplans.c.id.in_(plan_ids))
+        ).all())
+        latest = {}
+        for generations_table in (table, result_sets):
+            for lifeplan_id, generation in db.session.execute(
+                select(generations_table.c.lifeplan_id, func.max(generations_table.c.generation))
+                .where(generations_table.c.lifeplan_id.in_(plan_ids)).group_by(generations_table.c.lifeplan_id)
+            ):
+                latest[lifeplan_id] = max(latest.get(lifeplan_id, 0), generation or 0)
+        
+        rows = []
+        set_rows = []
+        copies = []
+        checkpoint_rows = []
+        generations = {}
+        finals = {}
+        for lifeplan_id, result in results_by_plan.items():
+            if lifeplan_id not in current:
+                # 計算中にプランが削除された
+                continue
+            if expected_generations is not None and current[lifeplan_id] != expected_generations.get(lifeplan_id):
+                # 計算中に新しい結果が公開された（入力が変わっている可能性がある）
+                timings['skipped'] += 1
+                continue
+            generation = max(current[lifeplan_id] or 0, latest.get(lifeplan_id, 0)) + 1
+            generations[lifeplan_id] = generation
+            finals[lifeplan_id] = final_assets(result)
+            if result.get('resumed_from') is not None:
+                if not columnar and _has_rows(lifeplan_id, current[lifeplan_id]):
+                    copies.append((lifeplan_id, generation, result['resumed_from']))
+                else:
+                    result = _with_prefix(lifeplan_id, result)
+            if columnar:
+                set_rows.append(result_set_row(lifeplan_id, generation, result, created_at))
+            else:
+                for row in result_rows(lifeplan_id, result, created_at):
+                    row['generation'] = generation
+                    rows.append(row)
+            if result.get('first_year') is not None:
+                checkpoint_rows.append(checkpoint_row(lifeplan_id, result, created_at))
+        timings['rows'] = len(rows) + len(set_rows)
+        prepared = time.perf_counter()
+        
+        # 途中の年からの結果は、それより前の年の行を公開中の世代からコピー
+        copy_columns = ['lifeplan_id', 'generation', *RESULT_COLUMNS, 'created_at']
+        for lifeplan_id, generation, resumed_from in copies:
+            db.session.execute(insert(table).from_select(
+                copy_columns,
+                select(table.c.lifeplan_id, literal(generation), *(table.c[column] for column in RESULT_COLUMNS), table.c.created_at)
+                .where(table.c.lifeplan_id == lifeplan_id, table.c.generation == current[lifeplan_id], table.c.year < resumed_from),
+            ))
+        if rows:
+            db.session.execute(insert(table), rows)
+        if set_rows:
+            db.session.execute(insert(result_sets), set_rows)
+        db.session.execute(delete(checkpoints).where(checkpoints.c.lifeplan_id.in_(list(generations.keys()))))
+        if checkpoint_rows:
+            db.session.execute(insert(checkpoints), checkpoint_rows)
+        inserted = time.perf_counter()
+        
+        # 公開する世代と最終年の総資産を切り替え（読み込んだ後に他の書き込みで変わっていた場合は中止）
+        # 結果の書き込みはプランの編集ではないため updated_at（onupdate）は変えない
+        for lifeplan_id, generation in generations.items():
+            switched = db.session.execute(
+                update(lifeplans)
+                .where(lifeplans.c.id == lifeplan_id, lifeplans.c.result_generation == current[lifeplan_id])
+                .values(result_generation=generation, final_assets=finals[lifeplan_id], updated_at=lifeplans.c.updated_at)
+            ).rowcount
+            if not switched:
+                raise ResultConflictError(f'lifeplan {lifeplan_id}: results were published concurrently')
+        switched_at = time.perf_counter()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    committed = time.perf_counter()
+    
+    timings.update(
+        prepare=prepared - started,
+        insert=inserted - prepared,
+        switch=switched_at - inserted,
+        commit=committed - switched_at,
+        total=committed - started,
+    )
+    logger.debug('simulation results written: %s', timings)
+    return timings
+
+def replace_results(lifeplan_id, result):
+    """1プランのシミュレーション結果を置き換える"""
+    return write_results({lifeplan_id: result})
+
+def collect_old_results(lifeplan_ids=None, batch_size=None):
+    """公開中でなくなった世代の結果（行形式・列形式とも）を削除し、削除した件数を返す
+    
+    読み取りは公開中の世代だけを参照するため、書き込みとは別のトランザクションで後から削除できる。
+    lifeplan_ids を省略した場合は全プランが対象（batch_size 件ずつ削除してコミット）。
+    """
+    batch_size = batch_size or Config.RESULT_GC_BATCH_SIZE
+    lifeplans = LifePlan.__table__
+    
+    deleted = 0
+    for table in (SimulationResult.__table__, SimulationResultSet.__table__):
+        stale = select(table.c.id).where(
+            table.c.generation < select(lifeplans.c.result_generation)
+            .where(lifeplans.c.id == table.c.lifeplan_id).scalar_subquery()
+        )
+        if lifeplan_ids is not None:
+            stale = stale.where(table.c.lifeplan_id.in_(list(lifeplan_ids)))
+        
+        while True:
+            try:
+                ids = db.session.execute(stale.limit(batch_size)).scalars().all()
+                if ids:
+                    db.session.execute(delete(table).where(table.c.id.in_(ids)))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            deleted += len(ids)
+            if len(ids) < batch_size:
+                break
+    
+    if deleted:
+        logger.debug('collected %d old simulation results', deleted)
+    return deleted
+
+def convert_results(storage, batch_size=500):
+    """公開中の世代の結果を指定した保存形式（'rows' または 'columnar'）に移し替え、移したプラン数を返す
+    
+    世代は変えずに移し替えるため、変換中も読み取り側はどちらかの形式で同じ結果を読める。
+    batch_size プランずつコミットする。
+    """
+    if storage not in ('rows', 'columnar'):
+        raise ValueError(f'unknown result storage: {storage}')
+    
+    table = SimulationResult.__table__
+    result_sets = SimulationResultSet.__table__
+    lifeplans = LifePlan.__table__
+    source = result_sets if storage == 'rows' else table
+    
+    converted = 0
+    last_id = 0
+    while True:
+        plans = db.session.execute(
+            select(lifeplans.c.id, lifeplans.c.result_generation)
+            .where(lifeplans.c.id > last_id,
+                   select(source.c.id).where(source.c.lifeplan_id == lifeplans.c.id,
+                                             source.c.generation == lifeplans.c.result_generation).exists())
+            .order_by(lifeplans.c.id.asc()).limit(batch_size)
+        ).all()
+        if not plans:
+            break
+        
+        created_at = datetime.utcnow()
+        try:
+            rows = []
+            set_rows = []
+            for lifeplan_id, generation in plans:
+                loaded = _load_from_result_set(lifeplan_id) if storage == 'rows' else _load_from_rows(lifeplan_id)
+                if loaded is None:
+                    continue
+                arrays, _ = loaded
+                if storage == 'rows':
+                    for row in result_rows(lifeplan_id, arrays, created_at):
+                        row['generation'] = generation
+                        rows.append(row)
+                else:
+                    set_rows.append(result_set_row(lifeplan_id, generation, arrays, created_at))
+                db.session.execute(delete(source).where(source.c.lifeplan_id == lifeplan_id, source.c.generation == generation))
+            if rows:
+                db.session.execute(insert(table), rows)
+            if set_rows:
+                db.session.execute(insert(result_sets), set_rows)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        converted += len(plans)
+        last_id = plans[-1].id
+    
+    return converted
+
+def backfill_final_assets(batch_size=500):
+    """公開中の結果があるのに LifePlan.final_assets が未設定のプランに最終年の総資産を設定し、件数を返す
+    
+    final_assets を追加する前に計算した結果のためのもので、結果の世代は変えない（batch_size プランずつコミット）。
+    """
+    lifeplans = LifePlan.__table__
+    updated = 0
+    last_id = 0
+    while True:
+        plan_ids = db.session.execute(
+            select(lifeplans.c.id)
+            .where(lifeplans.c.id > last_id, lifeplans.c.final_assets.is_(None), lifeplans.c.result_generation > 0)
+            .order_by(lifeplans.c.id.asc()).limit(batch_size)
+        ).scalars().all()
+        if not plan_ids:
+            return updated
+        
+        try:
+            for lifeplan_id in plan_ids:
+                arrays = load_result_arrays(lifeplan_id)
+                if arrays is None:
+                    continue
+                value = final_assets(arrays)
+                if value is not None:
+                    db.session.execute(
+                        update(lifeplans).where(lifeplans.c.id == lifeplan_id)
+                        .values(final_assets=value, updated_at=lifeplans.c.updated_at)
+                    )
+                    updated += 1
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        last_id = plan_ids[-1]
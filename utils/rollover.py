@@ -0,0 +1,20 @@
+from datetime import datetime
+from config import Config
+from utils.resimulate import resimulate_plans
+
+def rollover_plans(start_year=None, chunk_size=None, workers=None, pause_ratio=None, state_file=None, restart=False, progress=None):
+    """全プランのシミュレーション結果を新しい開始年（既定は今年）で計算し直す
+    
+    年が変わると run_simulation の開始年（今年）が変わり、保存済みの結果は前年を基準にしたものになる。
+    新しい開始年の計算は入力した残高から始まり、前年の年末残高からは求められないため、
+    新しい開始年の結果がまだないプランだけを一括で再計算する（中断しても再実行すれば残りだけを計算する）。
+    アプリケーションと同じSQLiteのファイルを使う場合に備え、小さなチャンクに分けて書き込みの合間に待つ。
+    """
+    start_year = start_year or datetime.now().year
+    chunk_size = chunk_size or Config.ROLLOVER_CHUNK_SIZE
+    pause_ratio = Config.ROLLOVER_PAUSE_RATIO if pause_ratio is None else pause_ratio
+    
+    return resimulate_plans(
+        start_year=start_year, chunk_size=chunk_size, workers=workers, state_file=state_file,
+        restart=restart, progress=progress, stale_only=True, pause_ratio=pause_ratio,
+    )
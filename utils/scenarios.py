@@ -0,0 +1,252 @@
+import math
+from datetime import datetime
+import numpy as np
+from config import Config
+from utils.simulation import build_cashflows_batch, depletion_index_batch, simulate_batch
+
+# 一括比較（スイープ）で変化させる項目（クエリパラメータでも同じ名前で指定）
+SWEEP_AXES = ('investment_return_rate', 'income_increase_rate', 'retirement_year_self')
+
+def _finite(value):
+    """文字列を float に変換する（nan・inf は ValueError）"""
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError
+    return value
+
+def parse_axis(text, integer=False):
+    """軸の値の並びを解釈する（'0.01,0.02,0.03' のような列挙、または '開始:終了:個数' の等間隔）"""
+    try:
+        if ':' in text:
+            start, stop, count = text.split(':')
+            count = int(count)
+            if not 1 <= count <= Config.SWEEP_MAX_SCENARIOS:
+                raise ValueError
+            values = np.linspace(_finite(start), _finite(stop), count)
+            if integer:
+                values = np.unique(np.round(values).astype(np.int64))
+            return values.tolist()
+        values = [value.strip() for value in text.split(',') if value.strip()]
+        if not values:
+            raise ValueError
+        return [int(value) for value in values] if integer else [_finite(value) for value in values]
+    except ValueError:
+        raise ValueError(f'値の指定が正しくありません: {text}')
+
+def _depletion_ages(depletion_age):
+    """資産が枯渇しない場合（-1）を None にした入れ子のリスト"""
+    ages = depletion_age.astype(object)
+    ages[depletion_age < 0] = None
+    return ages.tolist()
+
+def run_sweep(spec, axes=None, start_year=None):
+    """投資収益率・昇給率・退職年の組み合わせ（格子）をまとめて計算する
+    
+    axes は項目名（SWEEP_AXES）→ 値のリスト。指定しない項目はプランの値のまま。
+    全組み合わせを1回のベクトル演算で計算し、最終年の総資産と資産が枯渇する年齢（しない場合は None）を
+    軸の順に並べた多次元のリストで返す。
+    """
+    axes = axes or {}
+    unknown = set(axes) - set(SWEEP_AXES)
+    if unknown:
+        raise ValueError(f'変化させられない項目です: {", ".join(sorted(unknown))}')
+    
+    values = []
+    for name in SWEEP_AXES:
+        default = getattr(spec, name)
+        values.append(list(axes[name]) if axes.get(name) else [default if default is not None else 0])
+    shape = tuple(len(axis) for axis in values)
+    scenarios = int(np.prod(shape))
+    if scenarios > Config.SWEEP_MAX_SCENARIOS:
+        raise ValueError(f'組み合わせの数は{Config.SWEEP_MAX_SCENARIOS}以下にしてください（指定: {scenarios}）。')
+    
+    grids = np.meshgrid(*(np.asarray(axis) for axis in values), indexing='ij')
+    result = simulate_batch(spec, {name: grid.reshape(-1) for name, grid in zip(SWEEP_AXES, grids)}, start_year)
+    return {
+        'axes': {name: axis for name, axis in zip(SWEEP_AXES, values)},
+        'scenarios': scenarios,
+        'final_year': int(result['year'][-1]) if len(result['year']) else None,
+        'final_assets': result['final_assets'].astype(np.int64).reshape(shape).tolist(),
+        'depletion_age': _depletion_ages(result['depletion_age'].reshape(shape)),
+    }
+
+# 目標値の逆算（ゴールシーク）の種類
+GOAL_SEEK_TARGETS = ('max_expenses', 'earliest_retirement')
+
+def solvent_batch(spec, overrides, until_age=None, start_year=None):
+    """メンバーごとに until_age 歳まで資産が枯渇しないか（until_age 歳より後の年は計算しない）"""
+    until_age = Config.GOAL_SEEK_AGE if until_age is None else until_age
+    cashflows = build_cashflows_batch(spec, overrides, start_year)
+    params = cashflows['params']
+    horizon = int(np.searchsorted(cashflows['age'], until_age, side='right'))
+    net = (cashflows['income'] - cashflows['expenses'])[:, :horizon]
+    returns = params['investment_return_rate'].astype(np.float64)[:, None]
+    return depletion_index_batch(net, returns, params['savings'], params['investments']) < 0
+
+def max_sustainable_expenses(spec, until_age=None, start_year=None, points=None):
+    """until_age 歳まで資産が枯渇しない年間の基本支出（教育費・税金・イベントを除く、万円）の最大値
+    
+    支出が多いほど資産は減るため、枯渇しない範囲と枯渇する範囲の境界を探す。
+    上限を倍々に広げて境界を挟んだ後、区間内の points 個の候補を1回のベクトル演算でまとめて判定し、
+    区間を (points + 1) 分の1ずつ狭める（1万円単位）。0円でも枯渇する場合は None。
+    """
+    points = points or Config.GOAL_SEEK_POINTS
+    evaluations = 0
+    
+    def solvent(values):
+        nonlocal evaluations
+        evaluations += len(values)
+        return solvent_batch(spec, {'base_expenses': np.asarray(values, dtype=np.int64)}, until_age, start_year)
+    
+    if not solvent([0])[0]:
+        return {'value': None, 'evaluations': evaluations}
+    
+    # 枯渇する支出額が見つかるまで上限を広げる
+    low = 0
+    high = max(int(spec.base_expenses), spec.income_self + spec.income_spouse, 100)
+    while solvent([high])[0]:
+        low = high
+        high *= 2
+        if high > Config.GOAL_SEEK_MAX_AMOUNT:
+            return {'value': low, 'evaluations': evaluations, 'capped': True}
+    
+    # low は枯渇しない、high は枯渇する支出額
+    while high - low > 1:
+        candidates = np.unique(np.linspace(low, high, points + 2).round().astype(np.int64)[1:-1])
+        candidates = candidates[(candidates > low) & (candidates < high)]
+        if not len(candidates):
+            break
+        ok = solvent(candidates)
+        if ok.any():
+            low = int(candidates[ok].max())
+        failing = candidates[~ok & (candidates > low)]
+        if len(failing):
+            high = int(failing.min())
+    return {'value': low, 'evaluations': evaluations}
+
+def earliest_retirement(spec, until_age=None, start_year=None):
+    """until_age 歳まで資産が枯渇しない最も早い本人の退職年（どの年でも枯渇する場合は None）
+    
+    候補となる全ての年（計算期間の各年）を1回のベクトル演算でまとめて判定する。
+    """
+    cashflows = build_cashflows_batch(spec, None, start_year)
+    years = cashflows['year']
+    if not len(years):
+        return {'value': None, 'evaluations': 0}
+    ok = solvent_batch(spec, {'retirement_year_self': years}, until_age, start_year)
+    return {'value': int(years[ok][0]) if ok.any() else None, 'evaluations': len(years)}
+
+def goal_seek(spec, target, until_age=None, start_year=None):
+    """目標値を逆算する（target: 'max_expenses' または 'earliest_retirement'）
+    
+    until_age は MIN_AGE〜MAX_AGE で、計算期間の最初の年齢（現在の年齢）以上であること。
+    """
+    until_age = Config.GOAL_SEEK_AGE if until_age is None else until_age
+    if not Config.MIN_AGE <= until_age <= Config.MAX_AGE:
+        raise ValueError(f'年齢は{Config.MIN_AGE}〜{Config.MAX_AGE}の範囲で指定してください。')
+    first_age = max(start_year or datetime.now().year, spec.birth_year + Config.MIN_AGE) - spec.birth_year
+    if until_age < first_age:
+        raise ValueError(f'年齢は計算を開始する年齢（{first_age}歳）以上で指定してください。')
+    if target == 'max_expenses':
+        result = max_sustainable_expenses(spec, until_age, start_year)
+        current = int(spec.base_expenses)
+    elif target == 'earliest_retirement':
+        result = earliest_retirement(spec, until_age, start_year)
+        current = spec.retirement_year_self
+    else:
+        raise ValueError(f'target には {", ".join(GOAL_SEEK_TARGETS)} のいずれかを指定してください。')
+    
+    result.update(target=target, age=until_age, current=current)
+    return result
+
+# 感度分析で変化させる入力項目（PlanSpec の項目名と表示名）
+SENSITIVITY_INPUTS = (
+    ('income_self', '本人年収'),
+    ('income_spouse', '配偶者年収'),
+    ('income_increase_rate', '昇給率'),
+    ('investment_return_rate', '投資収益率'),
+    ('income_after_retirement_self', '本人退職後年収'),
+    ('income_after_retirement_spouse', '配偶者退職後年収'),
+    ('savings', '預貯金'),
+    ('investments', '投資資産'),
+    ('retirement_year_self', '本人退職年'),
+    ('retirement_year_spouse', '配偶者退職年'),
+)
+
+def run_sensitivity(spec, expenses=None, percent=None, retirement_years=None, start_year=None):
+    """各入力を ±percent% 変化させた場合の、最終年の総資産と資産が枯渇する年齢への影響（トルネード図用）
+    
+    退職年は ±retirement_years 年変化させる。expenses（expense_breakdown の戻り値: キー → (カテゴリ名, 年額)）を渡すと
+    支出のカテゴリごとにも変化させる（基本支出の合計をそのカテゴリの増減分だけ変える）。
+    基準と全ての変化を1回のベクトル演算でまとめて計算し、最終年の総資産の変化幅が大きい順に並べて返す。
+    """
+    percent = Config.SENSITIVITY_PERCENT if percent is None else percent
+    retirement_years = Config.SENSITIVITY_RETIREMENT_YEARS if retirement_years is None else retirement_years
+    if not 0 < percent <= 100:
+        raise ValueError('変化率は0より大きく100以下の値（%）で指定してください。')
+    if retirement_years < 1:
+        raise ValueError('退職年の変化幅は1年以上で指定してください。')
+    ratio = percent / 100
+    
+    # (キー, 表示名, PlanSpec の項目名, 元の値, 減らした値, 増やした値)
+    cases = []
+    for field, label in SENSITIVITY_INPUTS:
+        base = getattr(spec, field)
+        if field.startswith('retirement_year'):
+            if not base:
+                continue
+            cases.append((field, label, field, base, base - retirement_years, base + retirement_years))
+        else:
+            base = base or 0
+            cases.append((field, label, field, base, base * (1 - ratio), base * (1 + ratio)))
+    for key, (name, amount) in (expenses or {}).items():
+        cases.append((f'expense:{key}', name, 'base_expenses', amount, amount * (1 - ratio), amount * (1 + ratio)))
+    
+    # 先頭を基準とし、入力ごとに減らした場合・増やした場合の2メンバーを並べる
+    n_members = 1 + 2 * len(cases)
+    overrides = {}
+    for _, _, field, _, _, _ in cases:
+        if field not in overrides:
+            base = getattr(spec, field) or 0
+            dtype = np.int64 if field.startswith('retirement_year') else np.float64
+            overrides[field] = np.full(n_members, base, dtype=dtype)
+    for i, (_, _, field, base, low, high) in enumerate(cases):
+        if field == 'base_expenses':
+            # カテゴリの増減分だけ基本支出の合計を変える
+            low, high = spec.base_expenses + (low - base), spec.base_expenses + (high - base)
+        overrides[field][1 + 2 * i] = low
+        overrides[field][2 + 2 * i] = high
+    result = simulate_batch(spec, overrides, start_year)
+    
+    final_assets = result['final_assets'].astype(np.int64)
+    depletion_age = result['depletion_age']
+    # 枯渇しない場合は計算期間の最後の翌年の年齢として影響の大きさを比べる
+    never = int(result['age'][-1]) + 1 if len(result['age']) else 0
+    comparable_age = np.where(depletion_age < 0, never, depletion_age)
+    
+    def age_or_none(index):
+        return int(depletion_age[index]) if depletion_age[index] >= 0 else None
+    
+    inputs = []
+    for i, (key, label, _, base, low, high) in enumerate(cases):
+        lower, upper = 1 + 2 * i, 2 + 2 * i
+        inputs.append({
+            'input': key,
+            'label': label,
+            'base': base,
+            'low': low,
+            'high': high,
+            'final_assets': [int(final_assets[lower]), int(final_assets[upper])],
+            'depletion_age': [age_or_none(lower), age_or_none(upper)],
+            'impact': int(abs(final_assets[upper] - final_assets[lower])),
+            'depletion_impact': int(abs(comparable_age[upper] - comparable_age[lower])),
+        })
+    inputs.sort(key=lambda item: (item['impact'], item['depletion_impact']), reverse=True)
+    
+    return {
+        'percent': percent,
+        'retirement_years': retirement_years,
+        'final_year': int(result['year'][-1]) if len(result['year']) else None,
+        'baseline': {'final_assets': int(final_assets[0]), 'depletion_age': age_or_none(0)},
+        'inputs': inputs,
+    }
@@ -0,0 +1,96 @@
+from app import db
+from models import (
+    LIFEPLAN_DICT_COLUMNS, LifePlan, ExpenseCategory, ExpenseItem, ExpenseValue, EducationSelection,
+    lifeplan_base_dict, detailed_expenses_dict, education_selections_dict,
+)
+
+# 列以外に指定できる項目（関連テーブルから読み込む）
+LIFEPLAN_RELATION_FIELDS = ('detailed_expenses', 'education_selections')
+LIFEPLAN_FIELDS = LIFEPLAN_DICT_COLUMNS + LIFEPLAN_RELATION_FIELDS
+
+# 表示形式ごとの項目（full は LifePlan.to_dict と同じ）
+LIFEPLAN_VIEWS = {
+    'full': LIFEPLAN_FIELDS,
+    'summary': (
+        'id', 'name', 'birth_year', 'family_structure',
+        'income_self', 'income_spouse', 'savings', 'investments', 'debt',
+        'final_assets', 'updated_at',
+    ),
+}
+
+def parse_fields(fields=None, view=None):
+    """クエリパラメータ（fields: カンマ区切りの項目名、view: 表示形式）から返す項目を決める
+    
+    fields を指定した場合は view より優先する。id は常に含める。出力の順序は LIFEPLAN_FIELDS の順。
+    """
+    if fields:
+        requested = {field.strip() for field in fields.split(',') if field.strip()}
+        unknown = requested - set(LIFEPLAN_FIELDS)
+        if unknown:
+            raise ValueError(f'指定できない項目です: {", ".join(sorted(unknown))}')
+    else:
+        view = view or 'full'
+        if view not in LIFEPLAN_VIEWS:
+            raise ValueError(f'view には {", ".join(LIFEPLAN_VIEWS)} のいずれかを指定してください。')
+        requested = set(LIFEPLAN_VIEWS[view])
+    requested.add('id')
+    return tuple(field for field in LIFEPLAN_FIELDS if field in requested)
+
+def lifeplan_dicts(*criteria, fields=LIFEPLAN_FIELDS):
+    """条件に合うライフプランを LifePlan.to_dict と同じ形式の辞書のリスト（ID順）で返す
+    
+    fields（parse_fields の結果）に含まれる列だけを読み込み、支出項目（カテゴリ・項目名つき）・教育選択は
+    指定された場合だけそれぞれ1回のクエリで読み込む。ORMオブジェクトを作らずに行から組み立てるため、
+    プランの件数によらずクエリは最大3回。
+    """
+    columns = tuple(field for field in fields if field in LIFEPLAN_DICT_COLUMNS)
+    selected = columns if 'id' in columns else ('id',) + columns
+    plans = (
+        db.session.query(*(getattr(LifePlan, column) for column in selected))
+        .filter(*criteria)
+        .order_by(LifePlan.id.asc())
+        .all()
+    )
+    if not plans:
+        return []
+    plan_ids = [plan.id for plan in plans]
+    
+    expenses = {}
+    if 'detailed_expenses' in fields:
+        for lifeplan_id, category_name, item_name, amount in (
+            db.session.query(ExpenseValue.lifeplan_id, ExpenseCategory.name, ExpenseItem.name, ExpenseValue.amount)
+            .join(ExpenseItem, ExpenseItem.id == ExpenseValue.item_id)
+            .join(ExpenseCategory, ExpenseCategory.id == ExpenseItem.category_id)
+            .filter(ExpenseValue.lifeplan_id.in_(plan_ids))
+            .order_by(ExpenseValue.id.asc())
+        ):
+            expenses.setdefault(lifeplan_id, []).append((category_name, item_name, amount))
+    
+    selections = {}
+    if 'education_selections' in fields:
+        for lifeplan_id, education_type, institution_type, academic_field in (
+            db.session.query(
+                EducationSelection.lifeplan_id, EducationSelection.education_type,
+                EducationSelection.institution_type, EducationSelection.academic_field,
+            )
+            .filter(EducationSelection.lifeplan_id.in_(plan_ids))
+            .order_by(EducationSelection.id.asc())
+        ):
+            selections.setdefault(lifeplan_id, []).append((education_type, institution_type, academic_field))
+    
+    result = []
+    for plan in plans:
+        data = lifeplan_base_dict(plan, columns)
+        if 'detailed_expenses' in fields:
+            data['detailed_expenses'] = detailed_expenses_dict(expenses.get(plan.id, ()))
+        if 'education_selections' in fields:
+            data['education_selections'] = education_selections_dict(selections.get(plan.id, ()))
+        result.append(data)
+    return result
+
+def lifeplan_dicts_by_ids(ids, fields=LIFEPLAN_FIELDS):
+    """ID のリストと同じ順序で lifeplan_dicts の辞書を返す（ページングで決めたページ用）"""
+    if not ids:
+        return []
+    dicts = {data['id']: data for data in lifeplan_dicts(LifePlan.id.in_(ids), fields=fields)}
+    return [dicts[plan_id] for plan_id in ids if plan_id in dicts]
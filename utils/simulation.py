@@ -1,8 +1,18 @@
+import logging
+import time
 import numpy as np
 from datetime import datetime
+from functools import lru_cache
 from app import db
-from models import LifeEvent, SimulationResult, Child, EducationSelection, EducationCost
+from models import EDUCATION_STAGES, LifeEvent, SimulationResult, SimulationResultSet, SimulationCheckpoint, Child, EducationSelection
 from config import Config
+from utils.education_costs import get_education_costs
+from utils.dependencies import refresh_dependencies
+from utils.plan_spec import compile_plan
+from utils.result_store import load_resume_state, replace_results
+from utils.simulation_cache import plan_fingerprint, get_cached_result, store_result
+
+logger = logging.getLogger(__name__)
 
 def calculate_age(birth_year, year):
     """指定年の年齢を計算"""
@@ -21,6 +31,7 @@ def calculate_education_expenses(lifeplan, year):
     
     # 子供ごとの教育費用を計算
     children = Child.query.filter_by(lifeplan_id=lifeplan.id).all()
+    education_costs = get_education_costs()
     
     print(f"Calculating education expenses for year {year}, found {len(children)} children")
     
@@ -43,42 +54,26 @@ def calculate_education_expenses(lifeplan, year):
             if education_selection:
                 print(f"Found education selection: {education_selection.education_type}, {education_selection.institution_type}")
                 # 教育費用を取得
-                if education_level == '大学':
-                    cost = EducationCost.query.filter_by(
-                        education_type=education_level,
-                        institution_type=education_selection.institution_type,
-                        academic_field=education_selection.academic_field
-                    ).first()
-                else:
-                    cost = EducationCost.query.filter_by(
-                        education_type=education_level,
-                        institution_type=education_selection.institution_type
-                    ).first()
+                cost = education_costs.annual_cost(
+                    education_level,
+                    education_selection.institution_type,
+                    education_selection.academic_field
+                )
                 
                 if cost:
-                    print(f"Found education cost: {cost.annual_cost} 万円/年")
-                    education_expenses += cost.annual_cost
+                    print(f"Found education cost: {cost} 万円/年")
+                    education_expenses += cost
                 else:
                     print(f"Education cost not found for {education_level}, {education_selection.institution_type}")
                     pass
             else:
                 # 教育選択がない場合は国公立をデフォルトとして使用
                 print(f"No education selection found, using default (国公立)")
-                if education_level == '大学':
-                    cost = EducationCost.query.filter_by(
-                        education_type=education_level,
-                        institution_type='国公立',
-                        academic_field='文系'
-                    ).first()
-                else:
-                    cost = EducationCost.query.filter_by(
-                        education_type=education_level,
-                        institution_type='国公立'
-                    ).first()
+                cost = education_costs.default_annual_cost(education_level)
                 
                 if cost:
-                    print(f"Using default education cost: {cost.annual_cost} 万円/年")
-                    education_expenses += cost.annual_cost
+                    print(f"Using default education cost: {cost} 万円/年")
+                    education_expenses += cost
     
     print(f"Total education expenses for year {year}: {education_expenses} 万円")
     return education_expenses
@@ -91,10 +86,9 @@ def calculate_expenses(
     recurring_events
 ):
     """年間支出の計算"""
-    # 詳細な支出項目がある場合はそちらを使用
-    if lifeplan.expense_values.count() > 0:
-        # 支出値の合計を取得
-        expenses_data = lifeplan.get_total_expenses()
+    # 詳細な支出項目がある場合はそちらを使用（カテゴリごとの合計を1回のクエリで取得）
+    expenses_data = lifeplan.get_total_expenses()
+    if expenses_data['by_category']:
         expenses = expenses_data['total']
         
         # 月間データの場合は年間に変換
@@ -163,8 +157,8 @@ def calculate_investment_return(investment_amount, return_rate):
     """投資収益の計算"""
     return investment_amount * return_rate
 
-def run_simulation(lifeplan):
-    """ライフプランのシミュレーションを実行し、結果をデータベースに保存"""
+def run_simulation_legacy(lifeplan):
+    """ライフプランのシミュレーションを1年ずつ実行し、結果をデータベースに保存（従来版）"""
     # 現在の年を取得
     current_year = datetime.now().year
     
@@ -265,6 +259,7 @@ def run_simulation(lifeplan):
         # シミュレーション結果をデータベースに保存
         result = SimulationResult(
             lifeplan_id=lifeplan.id,
+            generation=lifeplan.result_generation or 0,
             year=year,
             age=age,
             income=int(income),
@@ -276,4 +271,371 @@ def run_simulation(lifeplan):
         db.session.add(result)
     
     db.session.commit()
-    return True
\ No newline at end of file
+    return True
+
+# 教育段階の境界年齢（3, 6, 12, 15, 18, 22歳）
+_EDUCATION_AGE_BOUNDS = np.array([EDUCATION_STAGES[0][1]] + [age_to for _, _, age_to in EDUCATION_STAGES], dtype=np.int64)
+
+@lru_cache(maxsize=4096)
+def child_education_vector(child, first_year, n_years):
+    """子供1人分の教育費用を first_year から n_years 年分の配列として計算（子供の内容ごとにキャッシュ）"""
+    ages = np.arange(first_year - child.birth_year, first_year - child.birth_year + n_years, dtype=np.int64)
+    stage_index = np.searchsorted(_EDUCATION_AGE_BOUNDS, ages, side='right') - 1
+    in_school = (stage_index >= 0) & (stage_index < len(child.stages))
+    
+    stage_costs = np.array([stage.annual_cost for stage in child.stages], dtype=np.int64)
+    vector = np.zeros(n_years, dtype=np.int64)
+    vector[in_school] = stage_costs[stage_index[in_school]]
+    vector.setflags(write=False)
+    return vector
+
+@lru_cache(maxsize=1024)
+def household_education_vector(children, first_year, n_years):
+    """世帯全体の教育費用の配列（子供ごとの配列の合計をキャッシュ）"""
+    if not children:
+        vector = np.zeros(n_years, dtype=np.int64)
+    else:
+        vector = np.sum([child_education_vector(child, first_year, n_years) for child in children], axis=0, dtype=np.int64)
+    vector.setflags(write=False)
+    return vector
+
+def build_cashflows(spec, start_year=None):
+    """PlanSpec から各年の収入・支出（投資収益を除く）を配列で計算する"""
+    if start_year is None:
+        start_year = datetime.now().year
+    
+    # 対象年齢（MIN_AGE〜MAX_AGE）に含まれる年だけを連続した配列として扱う
+    first_year = max(start_year, spec.birth_year + Config.MIN_AGE)
+    last_year = min(spec.birth_year + 100, spec.birth_year + Config.MAX_AGE)
+    years = np.arange(first_year, max(first_year, last_year + 1), dtype=np.int64)
+    ages = years - spec.birth_year
+    n = len(years)
+    
+    # 昇給による収入の伸び（スカラー版とビット単位で一致させるためPythonの累乗で計算）
+    growth_base = 1 + spec.income_increase_rate
+    growth = np.array([growth_base ** (year - start_year) for year in range(first_year, first_year + n)], dtype=np.float64)
+    
+    # 退職年以降は退職後年収に切り替え
+    income_self = spec.income_self * growth
+    if spec.retirement_year_self:
+        income_self = np.where(years >= spec.retirement_year_self, spec.income_after_retirement_self, income_self)
+    income_spouse = spec.income_spouse * growth
+    if spec.retirement_year_spouse:
+        income_spouse = np.where(years >= spec.retirement_year_spouse, spec.income_after_retirement_spouse, income_spouse)
+    income = income_self + income_spouse
+    
+    # 支出 = 基本支出 + 教育費 + 税金・社会保険料 + イベント費用
+    expenses = spec.base_expenses + household_education_vector(spec.children, first_year, n)
+    total_income = spec.income_self + spec.income_spouse
+    expenses = expenses + (total_income * Config.INCOME_TAX_RATE + total_income * Config.SOCIAL_INSURANCE_RATE)
+    
+    # spec.events は単発 → 継続の順に並んでいる（スカラー版と同じ加算順序）
+    for event in spec.events:
+        if event.recurring:
+            active = years >= event.event_year
+            if event.recurring_end_year is not None:
+                active &= years <= event.recurring_end_year
+            expenses[active] += event.cost
+        elif first_year <= event.event_year < first_year + n:
+            expenses[event.event_year - first_year] += event.cost
+    
+    # 老後は生活費10%減と仮定
+    expenses = np.where(ages >= 65, expenses * 0.9, expenses)
+    
+    return {
+        'year': years,
+        'age': ages,
+        'income': income,
+        'expenses': expenses,
+    }
+
+# メンバーごとに値を変えて一括計算できる PlanSpec の項目（build_cashflows_batch 用）
+BATCH_FIELDS = (
+    'income_self',
+    'income_spouse',
+    'income_increase_rate',
+    'retirement_year_self',
+    'retirement_year_spouse',
+    'income_after_retirement_self',
+    'income_after_retirement_spouse',
+    'savings',
+    'investments',
+    'investment_return_rate',
+    'base_expenses',
+)
+
+def batch_parameters(spec, overrides=None):
+    """PlanSpec の値をメンバーごとの上書き値（項目名 → 形状 (B,) の配列）で置き換えた各項目の配列
+    
+    退職年は None の代わりに 0（退職なし）を使う。
+    """
+    overrides = overrides or {}
+    unknown = set(overrides) - set(BATCH_FIELDS)
+    if unknown:
+        raise ValueError(f'一括計算で変更できない項目です: {", ".join(sorted(unknown))}')
+    
+    values = {}
+    for field in BATCH_FIELDS:
+        value = overrides.get(field, getattr(spec, field))
+        if field.startswith('retirement_year') and value is None:
+            value = 0
+        values[field] = np.asarray(value)
+    shape = np.broadcast_shapes(*(value.shape for value in values.values()), (1,))
+    return {field: np.broadcast_to(value, shape) for field, value in values.items()}
+
+def build_cashflows_batch(spec, overrides=None, start_year=None):
+    """PlanSpec の一部の値をメンバーごとに変えた場合の各年の収入・支出を形状 (B, T) の配列で計算する
+    
+    年・教育費・イベントは全メンバー共通（生年は変えない）。各メンバーの値は、同じ値の PlanSpec を
+    build_cashflows で計算した場合とビット単位で一致する。
+    """
+    if start_year is None:
+        start_year = datetime.now().year
+    params = batch_parameters(spec, overrides)
+    
+    first_year = max(start_year, spec.birth_year + Config.MIN_AGE)
+    last_year = min(spec.birth_year + 100, spec.birth_year + Config.MAX_AGE)
+    years = np.arange(first_year, max(first_year, last_year + 1), dtype=np.int64)
+    ages = years - spec.birth_year
+    n = len(years)
+    
+    # 昇給率ごとの伸び（build_cashflows と同じくPythonの累乗で計算し、同じ昇給率のメンバーで共有）
+    rates, inverse = np.unique(params['income_increase_rate'], return_inverse=True)
+    growth = np.array(
+        [[(1 + rate) ** (year - start_year) for year in range(first_year, first_year + n)] for rate in rates.tolist()],
+        dtype=np.float64,
+    ).reshape(len(rates), n)[inverse.reshape(-1)]
+    
+    def income_of(base, retirement_year, after_retirement):
+        income = base[:, None] * growth
+        retired = (retirement_year[:, None] != 0) & (years[None, :] >= retirement_year[:, None])
+        return np.where(retired, np.broadcast_to(after_retirement[:, None], income.shape), income)
+    
+    income = (
+        income_of(params['income_self'], params['retirement_year_self'], params['income_after_retirement_self']) +
+        income_of(params['income_spouse'], params['retirement_year_spouse'], params['income_after_retirement_spouse'])
+    )
+    
+    # 支出の加算順序は build_cashflows と同じ
+    expenses = params['base_expenses'][:, None] + household_education_vector(spec.children, first_year, n)[None, :]
+    total_income = params['income_self'] + params['income_spouse']
+    expenses = expenses + (total_income * Config.INCOME_TAX_RATE + total_income * Config.SOCIAL_INSURANCE_RATE)[:, None]
+    for event in spec.events:
+        if event.recurring:
+            active = years >= event.event_year
+            if event.recurring_end_year is not None:
+                active &= years <= event.recurring_end_year
+            expenses[:, active] += event.cost
+        elif first_year <= event.event_year < first_year + n:
+            expenses[:, event.event_year - first_year] += event.cost
+    expenses = np.where(ages >= 65, expenses * 0.9, expenses)
+    
+    return {
+        'year': years,
+        'age': ages,
+        'income': income,
+        'expenses': expenses,
+        'params': params,
+    }
+
+def simulate_spec(spec, start_year=None, resume=None):
+    """コンパイル済みの PlanSpec から全期間をNumPy配列で一括計算する
+    
+    run_simulation_legacy と同じ演算順序で計算するため、保存される各年の値は完全に一致する。
+    データベースにはアクセスしないため、リクエスト外やワーカープロセスからも呼び出せる。
+    
+    resume に前回のチェックポイント（'index' と各年末の 'savings_state' / 'investments_state'）を
+    渡すと、index 年目の前年末の残高から計算を再開し、index 年目以降の行だけを返す。
+    """
+    if start_year is None:
+        start_year = datetime.now().year
+    cashflows = build_cashflows(spec, start_year)
+    income, expenses = cashflows['income'], cashflows['expenses']
+    n = len(income)
+    
+    # 貯蓄・投資残高の繰り越し（前年の残高に依存するため年順に計算）
+    resume_index = resume['index'] if resume else 0
+    if resume_index > 0:
+        savings = float(resume['savings_state'][resume_index - 1])
+        investments = float(resume['investments_state'][resume_index - 1])
+    else:
+        savings = max(0, spec.savings)
+        investments = max(0, spec.investments)
+    return_rate = spec.investment_return_rate
+    balances = np.empty(n, dtype=np.float64)
+    savings_path = np.empty(n, dtype=np.float64)
+    investments_path = np.empty(n, dtype=np.float64)
+    for i, net in enumerate((income[resume_index:] - expenses[resume_index:]).tolist(), start=resume_index):
+        balance = net + investments * return_rate
+        if balance > 0:
+            # 余剰金の半分を投資に回す
+            investments += balance * 0.5
+            savings += balance * 0.5
+        else:
+            # 赤字の場合は貯蓄、足りなければ投資から取り崩す
+            savings += balance
+            if savings < 0:
+                investments -= abs(savings)
+                savings = 0
+                if investments < 0:
+                    investments = 0
+        balances[i] = balance
+        savings_path[i] = savings
+        investments_path[i] = investments
+    
+    if resume_index > 0:
+        savings_path[:resume_index] = resume['savings_state'][:resume_index]
+        investments_path[:resume_index] = resume['investments_state'][:resume_index]
+    
+    rows = slice(resume_index, n)
+    return {
+        'start_year': start_year,
+        'resumed_from': int(cashflows['year'][resume_index]) if resume_index > 0 else None,
+        'year': cashflows['year'][rows],
+        'age': cashflows['age'][rows],
+        'income': income[rows].astype(np.int64),
+        'expenses': expenses[rows].astype(np.int64),
+        'savings': savings_path[rows].astype(np.int64),
+        'investments': investments_path[rows].astype(np.int64),
+        'balance': balances[rows].astype(np.int64),
+        # 各年末の残高（チェックポイント用に丸めずに保持）
+        'first_year': int(cashflows['year'][0]) if n else None,
+        'savings_state': savings_path,
+        'investments_state': investments_path,
+    }
+
+def rollforward_batch(net, returns, savings, investments):
+    """複数の経路（パラメータ）の貯蓄・投資残高を年ごとにまとめて繰り越す
+    
+    net は各年の収入 - 支出（形状 (T,) または (B, T)）、returns は各経路・各年の投資収益率（形状 (B, T)）。
+    経路ごとのループは行わず、年ごとに全経路をベクトル演算で更新する。
+    戻り値は各年末の総資産（貯蓄 + 投資、形状 (B, T)）と、資産が尽きて赤字を補えなくなった
+    最初の年のインデックス（枯渇しない経路は -1）。
+    """
+    returns = np.asarray(returns, dtype=np.float64)
+    n_paths, n_years = returns.shape
+    net = np.broadcast_to(np.asarray(net, dtype=np.float64), (n_paths, n_years))
+    savings = np.broadcast_to(np.maximum(0, np.asarray(savings, dtype=np.float64)), (n_paths,)).copy()
+    investments = np.broadcast_to(np.maximum(0, np.asarray(investments, dtype=np.float64)), (n_paths,)).copy()
+    
+    assets = np.empty((n_paths, n_years), dtype=np.float64)
+    depleted_index = np.full(n_paths, -1, dtype=np.int64)
+    for t in range(n_years):
+        balance = net[:, t] + investments * returns[:, t]
+        surplus = balance > 0
+        # 黒字は半分ずつ投資と貯蓄へ、赤字は貯蓄から取り崩す
+        investments = np.where(surplus, investments + balance * 0.5, investments)
+        savings = savings + np.where(surplus, balance * 0.5, balance)
+        # 貯蓄で足りない分は投資から取り崩す
+        shortfall = savings < 0
+        investments = np.where(shortfall, investments + savings, investments)
+        savings[shortfall] = 0
+        # 投資でも補えない場合は資産枯渇
+        exhausted = investments < 0
+        investments[exhausted] = 0
+        depleted_index[exhausted & (depleted_index < 0)] = t
+        assets[:, t] = savings + investments
+    
+    return assets, depleted_index
+
+def depletion_index_batch(net, returns, savings, investments):
+    """各メンバーの資産が枯渇する最初の年のインデックス（しない場合は -1）だけを求める
+    
+    rollforward_batch と同じ演算で繰り越すが、総資産の推移は保持せず、枯渇したメンバーはその年で計算から外す
+    （全メンバーが枯渇した時点で終了する）。
+    """
+    net = np.asarray(net, dtype=np.float64)
+    n_members, n_years = net.shape
+    returns = np.broadcast_to(np.asarray(returns, dtype=np.float64), (n_members, n_years))
+    savings = np.broadcast_to(np.maximum(0, np.asarray(savings, dtype=np.float64)), (n_members,)).copy()
+    investments = np.broadcast_to(np.maximum(0, np.asarray(investments, dtype=np.float64)), (n_members,)).copy()
+    
+    depleted_index = np.full(n_members, -1, dtype=np.int64)
+    active = np.arange(n_members)
+    for t in range(n_years):
+        if not len(active):
+            break
+        balance = net[active, t] + investments * returns[active, t]
+        surplus = balance > 0
+        investments = np.where(surplus, investments + balance * 0.5, investments)
+        savings = savings + np.where(surplus, balance * 0.5, balance)
+        shortfall = savings < 0
+        investments = np.where(shortfall, investments + savings, investments)
+        savings[shortfall] = 0
+        exhausted = investments < 0
+        depleted_index[active[exhausted]] = t
+        keep = ~exhausted
+        active, savings, investments = active[keep], savings[keep], investments[keep]
+    
+    return depleted_index
+
+def simulate_batch(spec, overrides=None, start_year=None):
+    """PlanSpec の一部の値をメンバーごとに変えた計算を1回のベクトル演算でまとめて行う
+    
+    overrides は項目名（BATCH_FIELDS）→ 形状 (B,) の配列。データベースにはアクセスしない。
+    戻り値は各年末の総資産（形状 (B, T)）、最終年の総資産、資産が枯渇した年のインデックス（しない場合は -1）と年齢。
+    """
+    cashflows = build_cashflows_batch(spec, overrides, start_year)
+    params = cashflows['params']
+    net = cashflows['income'] - cashflows['expenses']
+    returns = np.broadcast_to(params['investment_return_rate'].astype(np.float64)[:, None], net.shape)
+    assets, depleted_index = rollforward_batch(net, returns, params['savings'], params['investments'])
+    
+    ages = cashflows['age']
+    if len(ages):
+        final_assets = assets[:, -1]
+        depletion_age = np.where(depleted_index >= 0, ages[np.maximum(depleted_index, 0)], -1)
+    else:
+        final_assets = np.maximum(0, params['savings']) + np.maximum(0, params['investments'])
+        depletion_age = np.full(len(depleted_index), -1, dtype=np.int64)
+    return {
+        'year': cashflows['year'],
+        'age': ages,
+        'assets': assets,
+        'final_assets': final_assets,
+        'depleted_index': depleted_index,
+        'depletion_age': depletion_age,
+    }
+
+def simulate_lifeplan(lifeplan, start_year=None):
+    """ライフプランをコンパイルして全期間を一括計算する"""
+    return simulate_spec(compile_plan(lifeplan), start_year)
+
+def run_simulation(lifeplan, from_year=None):
+    """ライフプランのシミュレーションを実行し、結果をデータベースに保存（既存の結果は置き換え）
+    
+    from_year を指定すると、前回実行時のチェックポイントが使える場合はその年から再計算し、
+    その年以降の結果だけを書き換える（それより前の年に影響しない変更の場合に使用）。
+    全期間を計算する場合は、入力値が同じ結果をキャッシュから再利用する。
+    """
+    if Config.SIMULATION_ENGINE == 'legacy':
+        SimulationResult.query.filter_by(lifeplan_id=lifeplan.id).delete()
+        SimulationResultSet.query.filter_by(lifeplan_id=lifeplan.id).delete()
+        SimulationCheckpoint.query.filter_by(lifeplan_id=lifeplan.id).delete()
+        return run_simulation_legacy(lifeplan)
+    
+    started = time.perf_counter()
+    start_year = datetime.now().year
+    spec = compile_plan(lifeplan)
+    resume = load_resume_state(lifeplan.id, start_year, from_year) if from_year is not None else None
+    
+    result = None
+    if resume is None and Config.SIMULATION_CACHE_ENABLED:
+        # 同じ入力値の結果が保存済みなら計算を省略
+        fingerprint = plan_fingerprint(spec, start_year)
+        result = get_cached_result(fingerprint)
+        cached = result is not None
+        if not cached:
+            result = simulate_spec(spec, start_year)
+            store_result(fingerprint, result)
+    else:
+        cached = False
+        result = simulate_spec(spec, start_year, resume=resume)
+    simulated = time.perf_counter()
+    
+    # 使用したマスターデータの索引を更新（結果と同じトランザクションでコミット）
+    refresh_dependencies([spec])
+    timings = replace_results(lifeplan.id, result)
+    logger.debug('lifeplan %s simulated in %.4fs (from %s, cached %s), written in %.4fs',
+                 lifeplan.id, simulated - started, result['resumed_from'], cached, timings.get('total', 0))
+    return True
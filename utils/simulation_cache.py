@@ -0,0 +1,153 @@
+import hashlib
+import json
+import logging
+import threading
+from datetime import datetime
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from app import db
+from config import Config
+from models import SimulationCache
+from utils.codec import pack_arrays, unpack_arrays
+
+logger = logging.getLogger(__name__)
+
+# 計算ロジックを変更して過去の結果が使えなくなった場合はこの値を上げる
+CACHE_VERSION = 1
+
+# キャッシュに保存する結果配列と、それ以外のスカラー値
+_CACHED_ARRAYS = ('year', 'age', 'income', 'expenses', 'savings', 'investments', 'balance',
+                  'savings_state', 'investments_state')
+_CACHED_SCALARS = ('start_year', 'first_year')
+
+# このプロセスでのヒット・ミスなどの件数
+_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+_stats_lock = threading.Lock()
+
+def _count(name, value=1):
+    with _stats_lock:
+        _stats[name] += value
+
+def _canonical(value):
+    """namedtuple を含む入力値を、JSONで一意に表せる形に変換"""
+    if hasattr(value, '_asdict'):
+        return {key: _canonical(item) for key, item in value._asdict().items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(item) for item in value]
+    return value
+
+def plan_fingerprint(spec, start_year):
+    """シミュレーション結果を決める入力値全体のハッシュ（プランIDは含めない）
+    
+    PlanSpec には支出額・イベント・子供の教育選択と教育費が含まれるため、
+    これに計算で参照する Config の定数と開始年を加えれば結果が一意に決まる。
+    """
+    payload = {
+        'version': CACHE_VERSION,
+        'spec': _canonical(spec._replace(lifeplan_id=None)),
+        'config': {
+            'MIN_AGE': Config.MIN_AGE,
+            'MAX_AGE': Config.MAX_AGE,
+            'INCOME_TAX_RATE': Config.INCOME_TAX_RATE,
+            'SOCIAL_INSURANCE_RATE': Config.SOCIAL_INSURANCE_RATE,
+        },
+        'start_year': start_year,
+    }
+    canonical = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def get_cached_result(fingerprint):
+    """キャッシュ済みの結果を取得（ない場合は None）
+    
+    ヒットした場合は利用回数と最終利用日時を更新する（コミットは呼び出し側の書き込みと一緒に行う）。
+    """
+    table = SimulationCache.__table__
+    payload = db.session.execute(select(table.c.payload).where(table.c.fingerprint == fingerprint)).scalar()
+    if payload is None:
+        _count('misses')
+        return None
+    
+    db.session.execute(
+        update(table)
+        .where(table.c.fingerprint == fingerprint)
+        .values(hits=table.c.hits + 1, last_used_at=datetime.utcnow())
+    )
+    _count('hits')
+    
+    arrays, scalars = unpack_arrays(payload)
+    result = dict(arrays, **scalars)
+    result['resumed_from'] = None
+    return result
+
+def store_result(fingerprint, result):
+    """全期間の計算結果をキャッシュに追加し、上限を超えた分を削除する（途中の年からの結果は保存しない）"""
+    if result.get('resumed_from') is not None:
+        return False
+    
+    table = SimulationCache.__table__
+    payload = pack_arrays(
+        {name: result[name] for name in _CACHED_ARRAYS},
+        {name: result[name] for name in _CACHED_SCALARS},
+    )
+    now = datetime.utcnow()
+    try:
+        # 同じ入力値を別のリクエストが先に保存した場合は何もしない
+        with db.session.begin_nested():
+            db.session.execute(insert(table).values(
+                fingerprint=fingerprint, payload=payload, size_bytes=len(payload),
+                hits=0, created_at=now, last_used_at=now,
+            ))
+    except IntegrityError:
+        return False
+    
+    _count('stores')
+    evict()
+    return True
+
+def evict(max_entries=None, max_bytes=None):
+    """件数・合計サイズの上限を超えた分を、最終利用日時が古い順に削除する"""
+    max_entries = Config.SIMULATION_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+    max_bytes = Config.SIMULATION_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    table = SimulationCache.__table__
+    
+    entries, total_bytes = db.session.execute(
+        select(func.count(), func.coalesce(func.sum(table.c.size_bytes), 0)).select_from(table)
+    ).one()
+    if entries <= max_entries and total_bytes <= max_bytes:
+        return 0
+    
+    evicted = []
+    oldest = db.session.execute(
+        select(table.c.fingerprint, table.c.size_bytes).order_by(table.c.last_used_at.asc())
+    )
+    for fingerprint, size_bytes in oldest:
+        if entries <= max_entries and total_bytes <= max_bytes:
+            break
+        evicted.append(fingerprint)
+        entries -= 1
+        total_bytes -= size_bytes
+    oldest.close()
+    
+    if evicted:
+        db.session.execute(delete(table).where(table.c.fingerprint.in_(evicted)))
+        _count('evictions', len(evicted))
+        logger.debug('simulation cache evicted %d entries', len(evicted))
+    return len(evicted)
+
+def cache_stats():
+    """このプロセスでのヒット・ミス件数と、キャッシュ全体の件数・サイズ・累計ヒット数"""
+    table = SimulationCache.__table__
+    entries, total_bytes, total_hits = db.session.execute(
+        select(func.count(), func.coalesce(func.sum(table.c.size_bytes), 0), func.coalesce(func.sum(table.c.hits), 0))
+        .select_from(table)
+    ).one()
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats.update(
+        hit_rate=stats['hits'] / lookups if lookups else 0.0,
+        entries=entries,
+        bytes=total_bytes,
+        total_hits=total_hits,
+    )
+    return stats
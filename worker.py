@@ -0,0 +1,125 @@
+"""シミュレーションジョブのワーカー
+
+simulation_jobs テーブルからジョブをリース付きで取得し、シミュレーションを実行する。
+アプリケーションと同じデータベースを SQLALCHEMY_DATABASE_URI で指定し、必要な数だけ起動する。
+
+    SIMULATION_QUEUE=database SQLALCHEMY_DATABASE_URI=sqlite:////path/to/lifeplan.db python worker.py
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from sqlalchemy.exc import SQLAlchemyError
+from app import create_app, db
+from config import Config
+from models import LifePlan
+from utils.job_queue import claim_job, heartbeat, complete_job, fail_job, purge_jobs
+from utils.result_store import collect_old_results
+from utils.simulation import run_simulation
+
+logger = logging.getLogger('worker')
+
+def _heartbeat_loop(app, job_id, worker_id, stop):
+    """実行中のジョブのリースを定期的に延長する
+    
+    データベースのロック待ちなど一時的なエラーで延長できなかった場合は、記録して次の間隔で再試行する
+    （スレッドが止まるとリースが切れ、他のワーカーが同じジョブを実行してしまうため）。
+    """
+    while not stop.wait(Config.SIMULATION_JOB_HEARTBEAT_SECONDS):
+        with app.app_context():
+            try:
+                extended = heartbeat(job_id, worker_id)
+            except SQLAlchemyError:
+                db.session.rollback()
+                logger.exception('job %s: heartbeat failed, retrying', job_id)
+                continue
+            if not extended:
+                logger.warning('job %s: lease lost', job_id)
+                return
+
+def run_job(app, job, worker_id):
+    """取得したジョブを実行し、結果をジョブテーブルに記録する"""
+    stop = threading.Event()
+    beat = threading.Thread(target=_heartbeat_loop, args=(app, job.id, worker_id, stop), daemon=True)
+    beat.start()
+    try:
+        lifeplan = db.session.get(LifePlan, job.lifeplan_id)
+        # 登録後にプランが削除された場合は何もせず完了にする
+        if lifeplan is not None:
+            run_simulation(lifeplan, from_year=job.from_year)
+    except Exception as e:
+        db.session.rollback()
+        logger.exception('job %s for lifeplan %s failed', job.id, job.lifeplan_id)
+        fail_job(job.id, worker_id, e)
+        return False
+    finally:
+        stop.set()
+        beat.join()
+    
+    if not complete_job(job.id, worker_id):
+        # リース切れで他のワーカーが再実行中（結果は同じ内容で置き換えられる）
+        logger.warning('job %s finished after its lease was lost', job.id)
+    
+    # 公開中でなくなった世代の結果を削除
+    try:
+        collect_old_results([job.lifeplan_id])
+    except Exception:
+        db.session.rollback()
+        logger.exception('failed to collect old results for lifeplan %s', job.lifeplan_id)
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description='シミュレーションジョブのワーカー')
+    parser.add_argument('--worker-id', help='ワーカーの識別名（既定: ホスト名:プロセスID）')
+    parser.add_argument('--once', action='store_true', help='実行待ちのジョブがなくなったら終了')
+    parser.add_argument('--poll', type=float, default=Config.SIMULATION_WORKER_POLL_SECONDS, help='ジョブがない場合の待機秒数')
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    
+    uri = Config.SQLALCHEMY_DATABASE_URI
+    if uri in ('sqlite://', 'sqlite:///:memory:'):
+        print('インメモリのデータベースはワーカーと共有できません。SQLALCHEMY_DATABASE_URI を指定してください。')
+        sys.exit(1)
+    
+    worker_id = args.worker_id or f'{socket.gethostname()}:{os.getpid()}'
+    stopping = threading.Event()
+    
+    def request_stop(signum, frame):
+        # 実行中のジョブは完了させてから終了
+        logger.info('stopping after the current job')
+        stopping.set()
+    
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+    
+    app = create_app()
+    logger.info('worker %s started', worker_id)
+    processed = 0
+    purged_at = None
+    while not stopping.is_set():
+        with app.app_context():
+            # 終了してから保持期間を過ぎたジョブの行を定期的に削除
+            if purged_at is None or time.monotonic() - purged_at >= Config.SIMULATION_JOB_PURGE_INTERVAL_SECONDS:
+                purged_at = time.monotonic()
+                try:
+                    purge_jobs()
+                except SQLAlchemyError:
+                    logger.exception('failed to purge finished jobs')
+            job = claim_job(worker_id)
+            if job is not None:
+                run_job(app, job, worker_id)
+                processed += 1
+                continue
+        if args.once:
+            break
+        stopping.wait(args.poll)
+    
+    logger.info('worker %s stopped (%d jobs)', worker_id, processed)
+
+if __name__ == '__main__':
+    main()